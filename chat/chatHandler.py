@@ -1,19 +1,23 @@
 import logging
-import sqlite3
 import os
-import base64
+import html
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 
 import providers.miscHandler as miscHandler
-import providers.gptHandler as gpt
-import providers.claudeHandler as claude
-import providers.geminiHandler as gemini
-import providers.ollamaHandler as ollama
+from providers.providerRegistry import load_provider, ProviderUnavailableError
 import settings.chatCompletionHandler as chatCompletionHandler
 import settings.imageGenHandler as imageGenHandler
-from helpers.chatHelper import smart_split
+from helpers.chatHelper import smart_split, StreamEditor
+from helpers.dbHelper import chats_db
+from helpers.historyHelper import get_chat_history, get_chat_summary, save_chat_message, add_token_usage
+from helpers.contextHelper import fit_to_budget, apply_summary
+from helpers.imageHelper import store_image, resolve_images, set_image_file_id
+from helpers.queueHelper import provider_slot
+from helpers.resilienceHelper import request_deadline, call_with_retries, describe_error
+from helpers.messageListHelper import cached_message_lists
+from chat.hedgeHandler import hedged_stream
 
 # Define conversation states
 SELECTING_CHAT, CREATE_NEW_CHAT, CHATTING, RETURN_TO_MENU = range(4)
@@ -22,13 +26,6 @@ SELECTING_CHAT, CREATE_NEW_CHAT, CHATTING, RETURN_TO_MENU = range(4)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialise path to db
-DB_DIR = os.getenv('DB_DIR')
-DB_FILE = 'chats.db'
-DB_PATH = os.path.join(DB_DIR, DB_FILE)
-
-os.makedirs(DB_DIR, exist_ok=True)
-
 # Initialise path to title system prompt
 PROMPT_DIR = os.getenv('PROMPT_DIR')
 PROMPT_FILE = 'title_system_prompt.txt'
@@ -36,63 +33,32 @@ TITLE_PROMPT_PATH = os.path.join(PROMPT_DIR, PROMPT_FILE)
 
 os.makedirs(PROMPT_DIR, exist_ok=True)
 
-# Initialize sqlite database to store and retrieve the chat history
-conn_chats = sqlite3.connect(DB_PATH)
-
-c = conn_chats.cursor()
-
-c.execute('''
-    CREATE TABLE IF NOT EXISTS chats(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        chat_title TEXT,
-        input_tokens INTEGER DEFAULT 0,
-        output_tokens INTEGER DEFAULT 0)
-''')
-conn_chats.commit()
-
-# Create chat history table
-c.execute('''
-    CREATE TABLE IF NOT EXISTS chat_history (
-        chat_id INTEGER,
-        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        type TEXT DEFAULT 'text',
-        message TEXT,
-        role TEXT,
-        FOREIGN KEY (chat_id) REFERENCES chats(id)
-    )
-''')
-conn_chats.commit()
+# Price of cached input tokens relative to uncached ones, reading is cheaper and writing costs extra
+CACHE_READ_PRICE_RATIO = float(os.getenv('CACHE_READ_PRICE_RATIO', 0.1))
+CACHE_WRITE_PRICE_RATIO = float(os.getenv('CACHE_WRITE_PRICE_RATIO', 1.25))
 
 async def handle_save_new_chat(prompt, user_id):
     # Generate a title for the new chat
     title_prompt = open(TITLE_PROMPT_PATH, "r").read()
     gen_prompt = "The user has asked: " + str(prompt)
-    messages = []
-    messages = miscHandler.build_message_list("text", title_prompt, "system", messages)
-    messages = miscHandler.build_message_list("text", gen_prompt, "user", messages)
-
-    response = await gpt.chat_with_gpt(messages, model='gpt-3.5-turbo', temperature=1, max_tokens=15, n=1)
-    chat_title = response[3]
-    
-    c.execute("INSERT INTO chats (user_id, chat_title) VALUES (?, ?)", 
-            (user_id, chat_title))
-    conn_chats.commit()
+    chat_history = [
+        ("text", title_prompt, "system"),
+        ("text", gen_prompt, "user"),
+    ]
+
+    gpt = await load_provider('openai')
+    response = await gpt.complete(chat_history, model='gpt-3.5-turbo', temperature=1, max_tokens=15, n=1, system=title_prompt)
+    chat_title = response.message
     
-    c.execute("SELECT id FROM chats WHERE user_id = ? AND chat_title = ?", 
+    chat_id = await chats_db.execute("INSERT INTO chats (user_id, chat_title) VALUES (?, ?)", 
             (user_id, chat_title))
-    chat_id = c.fetchone()[0]
 
     return chat_id, chat_title
 
-def check_if_chat_history_exists(chat_id: int, SYSTEM_PROMPT: str) -> None:
-    c.execute("SELECT COUNT(*) FROM chat_history WHERE chat_id = ?", (chat_id,))
-    count = c.fetchone()[0]
-    if count == 0:
+async def check_if_chat_history_exists(chat_id: int, SYSTEM_PROMPT: str) -> None:
+    if len(await get_chat_history(chat_id)) == 0:
         # If chat history is empty add system prompt to chat history
-        c.execute("INSERT INTO chat_history (chat_id, message, role) VALUES (?, ?, ?)", 
-                (chat_id, SYSTEM_PROMPT, 'system'))
-        conn_chats.commit()
+        await save_chat_message(chat_id, SYSTEM_PROMPT, 'system')
         # print(f"Chat history for chat {chat_id} created") DEBUG_USE
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -100,7 +66,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     print(f"{user_id}: {user_message}") # DEBUG_USE
     # Get current settings
-    _, provider, model, temperature, max_tokens, n, start_prompt = chatCompletionHandler.get_current_settings(user_id)
+    _, provider, model, temperature, max_tokens, n, start_prompt = await chatCompletionHandler.get_current_settings(user_id)
     chat_id = context.user_data.get('current_chat_id')
     if chat_id is None:
         chat_id, chat_title = await handle_save_new_chat(user_message, user_id)
@@ -111,19 +77,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         pass
     # Check if chat history is empty for the current chat
-    check_if_chat_history_exists(chat_id, start_prompt)
+    await check_if_chat_history_exists(chat_id, start_prompt)
     
     # Save user message to database
-    c.execute("INSERT INTO chat_history (chat_id, message, role) VALUES (?, ?, ?)", 
-            (chat_id, user_message, 'user'))
-    conn_chats.commit()
+    await save_chat_message(chat_id, user_message, 'user')
     
-    # Retrieve chat history
-    c.execute("SELECT type, message, role FROM chat_history WHERE chat_id = ? ORDER BY rowid", (chat_id,))
-    chat_history = c.fetchall()
+    # Retrieve the summary and recent turns that fit the model's context window
+    chat_history, start_prompt = apply_summary(await get_chat_history(chat_id), await get_chat_summary(chat_id), start_prompt)
+    chat_history = fit_to_budget(chat_history, model, max_tokens)
+    chat_history = await resolve_images(chat_history)
 
     # Generate AI response chat completion
-    return await handle_chat_completion(provider, model, temperature, max_tokens, n, start_prompt, chat_history, user_message, chat_id, update, context)
+    return await handle_chat_completion(provider, model, temperature, max_tokens, n, start_prompt, chat_history, chat_id, update, context)
 
 async def handle_gen_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat_id = context.user_data.get('current_chat_id')
@@ -137,27 +102,41 @@ async def handle_gen_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     stored_message = "Generate an image prompt: " + prompt
     
     # Save user message to database
-    c.execute("INSERT INTO chat_history (chat_id, message, role) VALUES (?, ?, ?)", 
-            (chat_id, stored_message, 'user'))
-    conn_chats.commit()
+    await save_chat_message(chat_id, stored_message, 'user')
 
     # Retrieve image gen settings from database
-    _, model, size = imageGenHandler.get_image_settings(update.effective_user.id)
+    _, model, size = await imageGenHandler.get_image_settings(update.effective_user.id)
+
+    # Tell the user where they are while waiting for a free image generation slot
+    queue_messages = []
+    async def show_queue_position(position):
+        text = f"Waiting to generate your image... You are number {position} in the queue."
+        if queue_messages:
+            await queue_messages[0].edit_text(text)
+        else:
+            queue_messages.append(await update.message.reply_text(text))
+            context.user_data.setdefault('sent_messages', []).append(queue_messages[0].message_id)
 
     # Call dalle API
-    img_base64 = await gpt.image_gen_with_openai(prompt=prompt, model=model,n=1, size=size)
-
-    if img_base64:
-        # Save AI response to database in base64 format
-        c.execute("INSERT INTO chat_history (chat_id, type, message, role) VALUES (?, ?, ?, ?)", 
-                (chat_id, 'image_url', img_base64, 'assistant'))
-        conn_chats.commit()
+    gpt = await load_provider('openai')
+    try:
+        async with provider_slot('openai', model, update.effective_user.id, show_queue_position):
+            with request_deadline():
+                img_bytes = await call_with_retries('openai', lambda: gpt.generate_image(prompt, model=model, n=1, size=size))
+    except Exception as e:
+        logger.warning(f"Image generation failed: {e!r}")
+        message = await update.message.reply_text(describe_error('openai', e))
+        context.user_data.setdefault('sent_messages', []).append(message.message_id)
+        return CHATTING
 
-        # Convert base64 to bytes
-        img_bytes = base64.b64decode(img_base64)
+    if img_bytes:
+        # Save AI response to the image store and reference it in the chat history
+        image_hash = await store_image(img_bytes)
+        await save_chat_message(chat_id, image_hash, 'assistant', 'image_url')
 
-        # Send the image
+        # Send the image and remember its file_id for later resends
         message = await update.message.reply_photo(photo=img_bytes)
+        set_image_file_id(image_hash, message.photo[-1].file_id)
     else:
         message = await update.message.reply_text("Sorry, I couldn't generate the image. Please try again.")
     
@@ -205,7 +184,7 @@ async def handle_gen_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 #     return CHATTING
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    _, provider, model, temperature, max_tokens, n, start_prompt = chatCompletionHandler.get_current_settings(update.effective_user.id)
+    _, provider, model, temperature, max_tokens, n, start_prompt = await chatCompletionHandler.get_current_settings(update.effective_user.id)
     # Check the model being used, if it is not a vision model as listed tell user to change the model choice
     if model not in miscHandler.VISION_MODELS:
         message =await update.message.reply_text(f"Please select a model from the list: {', '.join(miscHandler.VISION_MODELS)}")
@@ -220,17 +199,18 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Download the photo as a variable
     image_bytes = await photo_file.download_as_bytearray()
-    image_in_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    image_hash = await store_image(bytes(image_bytes)) if image_bytes else None
+    if image_hash is not None:
+        # Remember the file_id so the photo can be resent without uploading it again
+        set_image_file_id(image_hash, update.message.photo[-1].file_id)
 
     # Save photo info to chat history
-    if image_in_base64 is not None:
+    if image_hash is not None:
         print(f"User uploaded caption with image: {update.message.caption}")
         if update.message.caption is not None:
             user_message = update.message.caption
             user_id = update.effective_user.id
             print(f"{user_id}: {user_message}") # DEBUG_USE
-            # Get current settings
-            _, provider, model, temperature, max_tokens, n, start_prompt = chatCompletionHandler.get_current_settings(user_id)
             chat_id = context.user_data.get('current_chat_id')
             if chat_id is None:
                 chat_id, chat_title = await handle_save_new_chat(user_message, user_id)
@@ -241,33 +221,28 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 pass
             # Check if chat history is empty for the current chat
-            check_if_chat_history_exists(chat_id, start_prompt)
+            await check_if_chat_history_exists(chat_id, start_prompt)
 
-            c.execute("INSERT INTO chat_history (chat_id, type, message, role) VALUES (?, ?, ?, ?)", 
-                    (chat_id, "image_url", image_in_base64, 'user'))
-            conn_chats.commit()
+            await save_chat_message(chat_id, image_hash, 'user', 'image_url')
             
             # Save user message to database
-            c.execute("INSERT INTO chat_history (chat_id, message, role) VALUES (?, ?, ?)", 
-                    (chat_id, user_message, 'user'))
-            conn_chats.commit()
+            await save_chat_message(chat_id, user_message, 'user')
             
-            # Retrieve chat history
-            c.execute("SELECT type, message, role FROM chat_history WHERE chat_id = ? ORDER BY rowid", (chat_id,))
-            chat_history = c.fetchall()
+            # Retrieve the summary and recent turns that fit the model's context window
+            chat_history, start_prompt = apply_summary(await get_chat_history(chat_id), await get_chat_summary(chat_id), start_prompt)
+            chat_history = fit_to_budget(chat_history, model, max_tokens)
+            chat_history = await resolve_images(chat_history)
 
             # Generate AI response
-            return await handle_chat_completion(provider, model, temperature, max_tokens, n, start_prompt, chat_history, user_message, chat_id, update, context)
+            return await handle_chat_completion(provider, model, temperature, max_tokens, n, start_prompt, chat_history, chat_id, update, context)
         chat_id = context.user_data.get('current_chat_id')
-        check_if_chat_history_exists(chat_id, start_prompt)
-        c.execute("INSERT INTO chat_history (chat_id, type, message, role) VALUES (?, ?, ?, ?)", 
-                (chat_id, "image_url", image_in_base64, 'user'))
-        conn_chats.commit()
+        await check_if_chat_history_exists(chat_id, start_prompt)
+        await save_chat_message(chat_id, image_hash, 'user', 'image_url')
         message = await update.message.reply_text("Photo received. Continue typing your message.")
         context.user_data.setdefault('sent_messages', []).append(message.message_id)
         return CHATTING
 
-    if image_in_base64 is None:
+    if image_hash is None:
         message = await update.message.reply_text("Failed to download image.")
         context.user_data.setdefault('sent_messages', []).append(message.message_id)
         return CHATTING
@@ -275,72 +250,68 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # os.remove(file_path)  # Clean up the downloaded file
     return CHATTING
 
-async def handle_chat_completion(provider, model, temperature, max_tokens, n, start_prompt, chat_history, user_message, chat_id, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if provider == 'openai':
-        messages = gpt.build_message_list_gpt(chat_history)
-        bot_message = await update.message.reply_text("Working hard...")
-        context.user_data.setdefault('sent_messages', []).append(bot_message.message_id)
-        input_tokens, output_tokens, role, message = await gpt.chat_with_gpt(messages, model=model, temperature=temperature, max_tokens=max_tokens, n=n)
-    elif provider == 'claude':
-        messages = claude.build_message_list_claude(chat_history)
-        bot_message = await update.message.reply_text("Working hard...")
-        context.user_data.setdefault('sent_messages', []).append(bot_message.message_id)
-        input_tokens, output_tokens, role, message = await claude.chat_with_claude(messages, model=model, temperature=temperature, max_tokens=max_tokens, system=start_prompt)
-    elif provider == 'google':
-        # Add user message to chat history for gemini only
-        chat_history = gemini.build_message_list_gemini(chat_history, user_message)
-        bot_message = await update.message.reply_text("Working hard...")
-        context.user_data.setdefault('sent_messages', []).append(bot_message.message_id)
-        input_tokens, output_tokens, role, message = await gemini.chat_with_gemini(model=model, temperature=temperature, max_tokens=max_tokens, message_history=chat_history, system=start_prompt)
-    elif provider == 'ollama':
-        chat_history = ollama.build_message_list_ollama(chat_history)
-        bot_message = await update.message.reply_text("Working hard...")
-        context.user_data.setdefault('sent_messages', []).append(bot_message.message_id)
-        input_tokens, output_tokens, role, message = await ollama.chat_with_ollama(chat_history, model=model, temperature=temperature, max_tokens=max_tokens)
-        if input_tokens == -1 and output_tokens == -1:
-            await bot_message.edit_text("<u><b>Universalis</b></u>: \nSorry Ollama is currently unavailable. \nPlease /end and change model in settings.")
-            return CHATTING
+def cache_savings(input_tokens: int, cache_read_tokens: int, cache_write_tokens: int) -> float:
+    # Share of the input price saved compared to sending the whole prompt uncached, negative on turns that only write
+    prompt_tokens = input_tokens + cache_read_tokens + cache_write_tokens
+    cost = input_tokens + cache_read_tokens * CACHE_READ_PRICE_RATIO + cache_write_tokens * CACHE_WRITE_PRICE_RATIO
+    return (prompt_tokens - cost) / prompt_tokens if prompt_tokens else 0.0
+
+async def handle_chat_completion(provider, model, temperature, max_tokens, n, start_prompt, chat_history, chat_id, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    reply_heading = "<u><b>Universalis</b></u>: \n"
+    bot_message = await update.message.reply_text("Working hard...")
+    context.user_data.setdefault('sent_messages', []).append(bot_message.message_id)
+    # Partial replies are streamed into the placeholder message as they arrive
+    streamer = StreamEditor(bot_message, context.user_data['sent_messages'], heading=reply_heading)
+    # Show the queue position in the placeholder while waiting for a free slot
+    queued = []
+    async def show_queue_position(position):
+        queued.append(position)
+        await bot_message.edit_text(f"Working hard... You are number {position} in the queue.")
+    try:
+        async with provider_slot(provider, model, update.effective_user.id, show_queue_position) as slot:
+            if queued:
+                await bot_message.edit_text("Working hard...")
+            # The deadline covers every retry of this message
+            with request_deadline(), cached_message_lists(chat_id):
+                # A slow or failing model is backed up by the HEDGE_FALLBACK model
+                response, answered_provider, answered_model = await hedged_stream(provider, model, chat_history, streamer.push, chat_id, slot, update.effective_user.id, temperature=temperature, max_tokens=max_tokens, n=n, system=start_prompt)
+                input_tokens, output_tokens, role, message, cache_read_tokens, cache_write_tokens = response
+    except ProviderUnavailableError:
+        await bot_message.edit_text(f"<u><b>Universalis</b></u>: \nSorry {provider.title()} is currently unavailable. \nPlease /end and change model in settings.", parse_mode=ParseMode.HTML)
+        return CHATTING
+    except Exception as e:
+        # Keep whatever was streamed and explain the failure instead of dumping a traceback
+        logger.warning(f"{provider} failed to answer: {e!r}")
+        error_text = describe_error(provider, e)
+        message_parts = smart_split(html.escape(streamer.text)) if streamer.text.strip() else [""]
+        message_parts[0] = reply_heading + message_parts[0]
+        message_parts[-1] = message_parts[-1] + f"\n\n<i>{error_text}</i>"
+        await streamer.finish(message_parts, fallback_text=error_text)
+        return CHATTING
 
     # Save AI response to database
-    c.execute("INSERT INTO chat_history (chat_id, message, role) VALUES (?, ?, ?)", 
-            (chat_id, message, role))
-    conn_chats.commit()
+    await save_chat_message(chat_id, message, role)
     
-    # Get current token counts from database
-    c.execute('SELECT input_tokens, output_tokens FROM chats WHERE id = ?', (chat_id,))
-    row = c.fetchone()
-    total_input_tokens, total_output_tokens = row
-
     # Update token counts in database
-    total_input_tokens += input_tokens
-    total_output_tokens += output_tokens
-    c.execute('UPDATE chats SET input_tokens = ?, output_tokens = ? WHERE id = ?', 
-            (total_input_tokens, total_output_tokens, chat_id))
-    conn_chats.commit()
+    total_input_tokens, total_output_tokens = await add_token_usage(chat_id, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
 
-    reply_heading = "<u><b>Universalis</b></u>: \n"
     reply_end = (
         f"\n\nInput: <code>{input_tokens}</code> tokens | Output: <code>{output_tokens}</code> tokens\n"
         f"Total input used: <code>{total_input_tokens}</code> tokens | Total output used: <code>{total_output_tokens}</code> tokens\n"
     )
+    if cache_read_tokens or cache_write_tokens:
+        reply_end += (
+            f"Cached input: <code>{cache_read_tokens}</code> read | <code>{cache_write_tokens}</code> written | "
+            f"<code>{cache_savings(input_tokens, cache_read_tokens, cache_write_tokens):.0%}</code> of the input cost saved\n"
+        )
+    if (answered_provider, answered_model) != (provider, model):
+        reply_end += f"Answered by <code>{html.escape(answered_model)}</code> because {provider.title()} was slow or unavailable\n"
     message_parts = smart_split(message)
     message_parts[0] = reply_heading + message_parts[0]
     message_parts[-1] = message_parts[-1] + reply_end
-    for i, message_part in enumerate(message_parts):
-        if i == 0:
-            try:
-                await bot_message.edit_text(message_part, parse_mode=ParseMode.HTML)
-            except Exception as e:
-                message = await bot_message.reply_text(f"Message unable to format properly: {message}")
-                context.user_data.setdefault('sent_messages', []).append(message.message_id)
-        else:
-            try:
-                message = await bot_message.reply_text(message_part, parse_mode=ParseMode.HTML)
-                context.user_data.setdefault('sent_messages', []).append(message.message_id)
-            except Exception as e:
-                message = await bot_message.reply_text(f"Message unable to format properly: {message}")
-                context.user_data.setdefault('sent_messages', []).append(message.message_id)
-        return CHATTING
+    # Replace the streamed preview with the final formatted reply
+    await streamer.finish(message_parts, fallback_text=message)
+    return CHATTING
 
 
 def get_chat_handlers():
@@ -383,7 +354,3 @@ def get_chat_handlers():
         ],
 
     }
-
-def kill_connection():
-    conn_chats.close()
-    print("chatHandler DB Connection Closed")
\ No newline at end of file
@@ -1,10 +1,13 @@
-import sqlite3
 import logging
-import os
-import base64
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
+from helpers.dbHelper import chats_db, chat_writes
+from helpers.historyHelper import get_chat_history, get_token_totals, invalidate_history, invalidate_summary
+from helpers.messageListHelper import invalidate_message_list
+from helpers.imageHelper import get_image_bytes, get_image_file_id, set_image_file_id, delete_unused_images
+from helpers.metricsHelper import increment
 
 # Define conversation states
 SELECTING_CHAT, CREATE_NEW_CHAT, CHATTING, RETURN_TO_MENU = range(4)
@@ -13,16 +16,6 @@ SELECTING_CHAT, CREATE_NEW_CHAT, CHATTING, RETURN_TO_MENU = range(4)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-DB_DIR = os.getenv('DB_DIR')
-DB_FILE = 'chats.db'
-DB_PATH = os.path.join(DB_DIR, DB_FILE)
-
-os.makedirs(DB_DIR, exist_ok=True)
-
-# Initialize sqlite database to store and retrieve the chat history
-conn_chats = sqlite3.connect(DB_PATH)
-
-c = conn_chats.cursor()
 
 # Define start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -34,8 +27,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # Chats Menu 
 async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    c.execute("SELECT id, chat_title FROM chats WHERE user_id = ?", (user_id,))
-    chats = c.fetchall()
+    chats = await chats_db.fetchall("SELECT id, chat_title FROM chats WHERE user_id = ? ORDER BY id", (user_id,))
 
     keyboard = []
     for chat_id, chat_title in chats:
@@ -83,12 +75,24 @@ async def create_new_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return CREATE_NEW_CHAT
 
+async def reply_with_stored_image(message, image_hash: str, caption: str) -> tuple:
+    # Resend by file_id when Telegram still knows the photo, only upload the bytes when it does not
+    file_id = await get_image_file_id(image_hash)
+    if file_id:
+        try:
+            return await message.reply_photo(file_id, caption=caption, parse_mode=ParseMode.HTML), 0
+        except BadRequest as e:
+            logger.info(f"Stored file_id rejected, uploading image instead: {e}")
+    image_bytes = await get_image_bytes(image_hash)
+    sent_message = await message.reply_photo(image_bytes, caption=caption, parse_mode=ParseMode.HTML)
+    set_image_file_id(image_hash, sent_message.photo[-1].file_id)
+    return sent_message, len(image_bytes)
+
 async def open_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     chat_id = int(query.data.split('_')[-1])
     
-    c.execute("SELECT chat_title FROM chats WHERE id = ?", (chat_id,))
-    chat_title = c.fetchone()[0]
+    chat_title = (await chats_db.fetchone("SELECT chat_title FROM chats WHERE id = ?", (chat_id,)))[0]
     
     context.user_data['current_chat_id'] = chat_id
     context.user_data['current_chat_title'] = chat_title
@@ -97,12 +101,12 @@ async def open_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.edit_message_text(f"You are now chatting in: {chat_title}! You can save and exit using /end or /delete to delete the chat.")
     
     # Print the chat history if there is any
-    c.execute("SELECT type, message, role FROM chat_history WHERE chat_id = ?", (chat_id,))
-    chat_history = c.fetchall()
-    c.execute("SELECT input_tokens, output_tokens FROM chats WHERE id = ?", (chat_id,))
-    row = c.fetchone()
-    input_tokens, output_tokens = row
+    chat_history = [row[1:4] for row in await get_chat_history(chat_id)]
+    input_tokens, output_tokens = await get_token_totals(chat_id)
+    bytes_uploaded = 0
     if chat_history:
+        # File ids saved on earlier replays may still be queued, flushed once instead of per image
+        await chat_writes.flush()
         for message_type, message, role in chat_history:
             # print(f"{role}: {message}") # DEBUG_USE
             if role == 'user':
@@ -115,8 +119,8 @@ async def open_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                         context.user_data.setdefault('sent_messages', []).append(add_to_message_list.message_id)
                 if message_type == 'image_url':
                     try:
-                        decoded_bytes = base64.b64decode(message)
-                        add_to_message_list = await query.message.reply_photo(decoded_bytes, caption=f"<u><b>You</b></u>: \n", parse_mode=ParseMode.HTML)
+                        add_to_message_list, uploaded = await reply_with_stored_image(query.message, message, f"<u><b>You</b></u>: \n")
+                        bytes_uploaded += uploaded
                         context.user_data.setdefault('sent_messages', []).append(add_to_message_list.message_id)
                     except Exception as e:
                         add_to_message_list = await query.message.reply_text(f"Error sending the image")
@@ -138,14 +142,18 @@ async def open_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                             context.user_data.setdefault('sent_messages', []).append(add_to_message_list.message_id)
                 if message_type == 'image_url':
                     try:
-                        decoded_bytes = base64.b64decode(message)
-                        add_to_message_list = await query.message.reply_photo(decoded_bytes, caption=f"<u><b>Universalis</b></u>: \n", parse_mode=ParseMode.HTML)
+                        add_to_message_list, uploaded = await reply_with_stored_image(query.message, message, f"<u><b>Universalis</b></u>: \n")
+                        bytes_uploaded += uploaded
                         context.user_data.setdefault('sent_messages', []).append(add_to_message_list.message_id)
                     except Exception as e:
                         add_to_message_list = await query.message.reply_text(f"Error sending the image")
                         context.user_data.setdefault('sent_messages', []).append(add_to_message_list.message_id)
             else:
                 pass
+        # Track how much image data had to be uploaded to replay the chat
+        increment('replays')
+        increment('replay_bytes_uploaded', bytes_uploaded)
+        logger.info(f"Replayed chat {chat_id}, uploaded {bytes_uploaded} bytes of images")
         add_to_message_list = await query.message.reply_text(f"Continue messaging or /end to safely exit or /delete to delete this conversation. \nCurrent usage of tokens(I/O): <code>{input_tokens}</code> / <code>{output_tokens}</code>", parse_mode=ParseMode.HTML)
         context.user_data.setdefault('sent_messages', []).append(add_to_message_list.message_id)
     else:
@@ -169,9 +177,20 @@ async def del_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     from helpers.mainHelper import cleanup
     chat_id = context.user_data.get('current_chat_id')
     
-    c.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
-    c.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-    conn_chats.commit()
+    def _delete_chat(conn):
+        # The chat's images may be unused once its messages are gone
+        image_hashes = [row[0] for row in conn.execute("SELECT DISTINCT message FROM chat_history WHERE chat_id = ? AND type = 'image_url'", (chat_id,))]
+        conn.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        return image_hashes
+    # Queued writes for this chat must land before it is deleted
+    await chat_writes.flush()
+    image_hashes = await chats_db.transaction(_delete_chat)
+    invalidate_history(chat_id)
+    invalidate_summary(chat_id)
+    invalidate_message_list(chat_id)
+    await delete_unused_images(image_hashes)
     
     # print(f"Chat {chat_id} deleted successfully!") DEBUG_USE
 
@@ -214,6 +233,3 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.setdefault('sent_messages', []).append(message.message_id)
         return RETURN_TO_MENU
     
-def kill_connection():
-    conn_chats.close()
-    print("chatMenu DB Connection Closed")
\ No newline at end of file
@@ -0,0 +1,137 @@
+import logging
+import os
+from telegram.ext import ContextTypes
+
+from providers.providerRegistry import load_provider, ResilientProvider
+from helpers.contextHelper import count_tokens, turn_start
+from helpers.dbHelper import chats_db, chat_writes
+from helpers.historyHelper import set_chat_summary
+from helpers.messageListHelper import invalidate_message_list
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Chats are compacted once the turns not yet summarized exceed this many tokens, 0 disables compaction
+COMPACTION_TOKEN_THRESHOLD = int(os.getenv('COMPACTION_TOKEN_THRESHOLD', 8000))
+# Number of newest turns that are always left out of the summary
+COMPACTION_KEEP_TURNS = int(os.getenv('COMPACTION_KEEP_TURNS', 6))
+# Seconds between two compaction runs
+COMPACTION_INTERVAL = int(os.getenv('COMPACTION_INTERVAL', 600))
+# Cheap model used to write the summaries, either on openai or on ollama
+COMPACTION_PROVIDER = os.getenv('COMPACTION_PROVIDER', 'openai')
+COMPACTION_MODEL = os.getenv('COMPACTION_MODEL', 'gpt-4o-mini')
+COMPACTION_MAX_TOKENS = int(os.getenv('COMPACTION_MAX_TOKENS', 512))
+# Tokens of conversation sent per summary request, longer backlogs are folded into the summary in chunks
+COMPACTION_CHUNK_TOKENS = int(os.getenv('COMPACTION_CHUNK_TOKENS', 8000))
+
+DEFAULT_SUMMARY_PROMPT = (
+    "You summarize conversations between a user and an AI assistant. "
+    "Write a concise summary of the conversation below that keeps every fact, decision, "
+    "name, number and open question needed to continue it. "
+    "If a previous summary is given, merge it into the new summary."
+)
+
+# Initialise path to the optional summary system prompt
+PROMPT_DIR = os.getenv('PROMPT_DIR')
+PROMPT_FILE = 'summary_system_prompt.txt'
+SUMMARY_PROMPT_PATH = os.path.join(PROMPT_DIR, PROMPT_FILE)
+
+# The compaction provider wrapped with its own circuit breaker, so failing summaries never
+# open the circuit that users' replies go through
+compaction_provider = None
+
+async def get_compaction_provider() -> ResilientProvider:
+    global compaction_provider
+    if compaction_provider is None or compaction_provider.name != COMPACTION_PROVIDER:
+        registered = await load_provider(COMPACTION_PROVIDER)
+        compaction_provider = ResilientProvider(COMPACTION_PROVIDER, registered.provider)
+    return compaction_provider
+
+def get_summary_prompt() -> str:
+    if os.path.exists(SUMMARY_PROMPT_PATH):
+        return open(SUMMARY_PROMPT_PATH, 'r').read()
+    return DEFAULT_SUMMARY_PROMPT
+
+async def get_chats_to_compact() -> list:
+    # Chats whose turns after the last summary exceed the threshold
+    await chat_writes.flush()
+    rows = await chats_db.fetchall('''
+        SELECT h.chat_id FROM chat_history h
+        LEFT JOIN chat_summaries s ON s.chat_id = h.chat_id
+        WHERE h.role != 'system' AND h.message_id > COALESCE(s.last_message_id, 0)
+        GROUP BY h.chat_id
+        HAVING SUM(COALESCE(h.tokens, 0)) > ?
+    ''', (COMPACTION_TOKEN_THRESHOLD,))
+    return [row[0] for row in rows]
+
+async def summarize(previous_summary: str, transcript: str) -> str:
+    prompt = ""
+    if previous_summary:
+        prompt += f"Previous summary:\n{previous_summary}\n\n"
+    prompt += f"Conversation:\n{transcript}"
+    summary_prompt = get_summary_prompt()
+    chat_history = [
+        ("text", summary_prompt, "system"),
+        ("text", prompt, "user"),
+    ]
+    provider = await get_compaction_provider()
+    response = await provider.complete(chat_history, model=COMPACTION_MODEL, temperature=0.2, max_tokens=COMPACTION_MAX_TOKENS, n=1, system=summary_prompt)
+    return response.message
+
+def transcript_chunks(turns: list, budget: int):
+    # Yield transcripts of at most about budget tokens, using the token counts stored with the rows
+    lines, tokens = [], 0
+    for _, message_type, message, role, row_tokens in turns:
+        if message_type == 'image_url':
+            message, row_tokens = "[image]", None
+        line = f"{role}: {message}"
+        line_tokens = row_tokens if row_tokens is not None else count_tokens('text', line)
+        if line_tokens > budget:
+            # A single message longer than a chunk is cut to fit
+            line = line[:len(line) * budget // line_tokens]
+            line_tokens = budget
+        if lines and tokens + line_tokens > budget:
+            yield "\n".join(lines)
+            lines, tokens = [], 0
+        lines.append(line)
+        tokens += line_tokens
+    if lines:
+        yield "\n".join(lines)
+
+async def compact_chat(chat_id: int) -> None:
+    row = await chats_db.fetchone("SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+    previous_summary, last_message_id = row if row else ("", 0)
+    turns = await chats_db.fetchall(
+        "SELECT message_id, type, message, role, tokens FROM chat_history WHERE chat_id = ? AND message_id > ? AND role != 'system' ORDER BY message_id",
+        (chat_id, last_message_id))
+    # Keep whole turns, the kept history must start with a user message and keep images with their captions
+    older_turns = turns[:turn_start(turns, max(len(turns) - COMPACTION_KEEP_TURNS, 0))] if COMPACTION_KEEP_TURNS > 0 else turns
+    if not older_turns:
+        return
+
+    summary = previous_summary
+    for transcript in transcript_chunks(older_turns, COMPACTION_CHUNK_TOKENS):
+        summary = await summarize(summary, transcript)
+        if not summary:
+            logger.warning(f"Failed to summarize chat {chat_id}")
+            return
+
+    new_last_message_id = older_turns[-1][0]
+    tokens = count_tokens('text', summary)
+    await chats_db.execute(
+        "INSERT OR REPLACE INTO chat_summaries (chat_id, summary, last_message_id, tokens) VALUES (?, ?, ?, ?)",
+        (chat_id, summary, new_last_message_id, tokens))
+    set_chat_summary(chat_id, (summary, new_last_message_id, tokens))
+    invalidate_message_list(chat_id)
+    logger.info(f"Compacted {len(older_turns)} turns of chat {chat_id} into a {tokens} token summary")
+
+async def compact_chats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Runs on the job queue so summarizing never delays a user's message
+    if COMPACTION_TOKEN_THRESHOLD <= 0:
+        return
+    for chat_id in await get_chats_to_compact():
+        try:
+            await compact_chat(chat_id)
+        except Exception as e:
+            logger.error(f"Error compacting chat {chat_id}: {e}")
@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+import logging
+from collections import defaultdict, deque
+
+from providers.providerRegistry import load_provider, ProviderResponse
+from helpers.metricsHelper import increment, observe
+from helpers.dbHelper import chat_writes
+from helpers.contextHelper import count_tokens
+from helpers.queueHelper import provider_slot, try_provider_slot
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# provider:model asked as well when the selected model is slow or failing, empty disables hedging
+HEDGE_FALLBACK = os.getenv('HEDGE_FALLBACK', '')
+# Percentile of the observed first-token latency after which the fallback is asked too
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+# Seconds waited before hedging until enough latencies were observed, and the shortest wait ever used
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 10))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 2))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+# Number of recent first-token latencies kept per model
+HEDGE_WINDOW = int(os.getenv('HEDGE_WINDOW', 200))
+
+# (provider, model) -> recent first-token latencies in seconds
+first_token_latencies = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+
+def get_fallback():
+    if ':' not in HEDGE_FALLBACK:
+        return None
+    provider, model = HEDGE_FALLBACK.split(':', 1)
+    return provider.strip(), model.strip()
+
+def get_hedge_delay(provider: str, model: str) -> float:
+    latencies = first_token_latencies[(provider, model)]
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))
+    return max(HEDGE_MIN_DELAY, ordered[index])
+
+class Attempt:
+    """
+    One streamed request of a hedged reply.
+
+    Deltas are held back until the attempt is picked as the winner, then the held
+    text is passed on and every later delta goes straight to the user.
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.buffer = []
+        self.forward = None
+        self.first_token_at = None
+        self.started_at = time.monotonic()
+        # Set on the first delta or when the request ends, whichever comes first
+        self.ready = asyncio.Event()
+        self.task = None
+
+    async def on_delta(self, text: str) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            first_token_latencies[(self.provider, self.model)].append(self.first_token_at - self.started_at)
+            observe(f"first_token_seconds.{self.provider}", self.first_token_at - self.started_at)
+            self.ready.set()
+        if self.forward is None:
+            self.buffer.append(text)
+            return
+        if self.buffer:
+            text = "".join(self.buffer) + text
+            self.buffer.clear()
+        await self.forward(text)
+
+    def start(self, chat_provider, chat_history, slot=None, user_id=None, **kwargs) -> None:
+        # The attempt holds slot until it ends, or with user_id first waits for a slot like any other request
+        async def stream():
+            if slot is None and user_id is not None:
+                async with provider_slot(self.provider, self.model, user_id):
+                    self.started_at = time.monotonic()
+                    return await chat_provider.stream(chat_history, self.on_delta, model=self.model, **kwargs)
+            try:
+                return await chat_provider.stream(chat_history, self.on_delta, model=self.model, **kwargs)
+            finally:
+                if slot is not None:
+                    slot.release()
+        self.task = asyncio.create_task(stream())
+        self.task.add_done_callback(lambda _: self.ready.set())
+
+    @property
+    def failed(self) -> bool:
+        return self.task.done() and (self.task.cancelled() or self.task.exception() is not None)
+
+    async def win(self, on_delta) -> ProviderResponse:
+        self.forward = on_delta
+        if self.buffer:
+            text = "".join(self.buffer)
+            self.buffer.clear()
+            await on_delta(text)
+        return await self.task
+
+async def wait_until_ready(attempts: list, timeout: float = None) -> list:
+    waiters = {asyncio.create_task(attempt.ready.wait()): attempt for attempt in attempts}
+    done, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    for waiter in pending:
+        waiter.cancel()
+    return [waiters[waiter] for waiter in done]
+
+def estimate_wasted_tokens(attempt: Attempt, response: ProviderResponse) -> int:
+    # A cancelled stream reports no usage. It was sent the same prompt as the winner, whose usage
+    # is reused instead of tokenizing the history again, plus the little it produced so far
+    prompt_tokens = response.input_tokens + response.cache_read_tokens + response.cache_write_tokens
+    return prompt_tokens + count_tokens('text', "".join(attempt.buffer))
+
+def log_request(chat_id: int, attempt: Attempt, hedged: bool, wasted_tokens: int) -> None:
+    first_token_ms = int((attempt.first_token_at - attempt.started_at) * 1000) if attempt.first_token_at else None
+    chat_writes.add(
+        "INSERT INTO request_log (chat_id, provider, model, hedged, first_token_ms, wasted_tokens) VALUES (?, ?, ?, ?, ?, ?)",
+        (chat_id, attempt.provider, attempt.model, int(hedged), first_token_ms, wasted_tokens))
+
+async def hedged_stream(provider: str, model: str, chat_history: list, on_delta, chat_id: int, slot, user_id, **kwargs) -> tuple:
+    """
+    Stream a reply, asking the HEDGE_FALLBACK model too when the selected one is slow or down.
+
+    The fallback is started when the selected model has not produced a first token by the
+    HEDGE_PERCENTILE of its observed first-token latency, or straight away when the selected
+    provider's circuit is open or it fails before answering. The first attempt to produce a
+    token is shown to the user and the other one is cancelled.
+
+    slot is the caller's slot of the selected model. A hedge only runs when the fallback model
+    has a free slot without queueing; a failover gives slot back and queues for the fallback's
+    as user_id, so the fallback's concurrency limits and fairness hold either way.
+
+    Returns:
+    - (ProviderResponse, provider, model) of the attempt that answered
+    """
+    fallback = get_fallback()
+    chat_provider = await load_provider(provider)
+    primary = Attempt(provider, model)
+    if fallback is None or fallback == (provider, model):
+        primary.forward = on_delta
+        response = await chat_provider.stream(chat_history, primary.on_delta, model=model, **kwargs)
+        log_request(chat_id, primary, False, 0)
+        return response, provider, model
+
+    fallback_attempt = Attempt(*fallback)
+    fallback_provider = await load_provider(fallback_attempt.provider)
+    fallback_slot = None
+    candidates = []
+    try:
+        if chat_provider.breaker.state == "open":
+            # Fail over without waiting for a request that would be rejected anyway
+            increment(f"hedge_failovers.{provider}")
+        else:
+            primary.start(chat_provider, chat_history, **kwargs)
+            candidates.append(primary)
+            ready = await wait_until_ready(candidates, timeout=get_hedge_delay(provider, model))
+            if not ready:
+                fallback_slot = try_provider_slot(fallback_attempt.provider, fallback_attempt.model)
+                if fallback_slot is None:
+                    # Hedging now would jump the fallback's queue, keep waiting for the selected model
+                    increment(f"hedges_skipped.{provider}")
+                    ready = await wait_until_ready(candidates)
+            if ready and not primary.failed:
+                log_request(chat_id, primary, False, 0)
+                return await primary.win(on_delta), provider, model
+            increment(f"hedge_failovers.{provider}" if ready else f"hedges.{provider}")
+            if ready:
+                candidates.remove(primary)
+
+        if fallback_slot is None:
+            # The selected model is out of the race, its slot is given back before queueing for the fallback's
+            slot.release()
+        fallback_attempt.start(fallback_provider, chat_history, fallback_slot, user_id, **kwargs)
+        candidates.append(fallback_attempt)
+        winner = None
+        last_error = None
+        while candidates and winner is None:
+            for attempt in await wait_until_ready(candidates):
+                if attempt.failed:
+                    candidates.remove(attempt)
+                    last_error = attempt.task.exception() if not attempt.task.cancelled() else asyncio.CancelledError()
+                elif winner is None:
+                    winner = attempt
+        if winner is None:
+            raise last_error
+
+        losers = [attempt for attempt in candidates if attempt is not winner]
+        for attempt in losers:
+            attempt.task.cancel()
+        increment(f"hedge_wins.{winner.provider}")
+        try:
+            response = await winner.win(on_delta)
+        except Exception:
+            log_request(chat_id, winner, True, 0)
+            raise
+        # Estimated once the reply is complete, so it never holds up the text shown to the user
+        wasted_tokens = sum(estimate_wasted_tokens(attempt, response) for attempt in losers)
+        if wasted_tokens:
+            increment(f"hedge_wasted_tokens.{winner.provider}", wasted_tokens)
+        log_request(chat_id, winner, True, wasted_tokens)
+        return response, winner.provider, winner.model
+    finally:
+        if fallback_slot is not None and fallback_attempt.task is None:
+            fallback_slot.release()
+        # Never leave a request running once the reply is decided or the caller gave up
+        for attempt in (primary, fallback_attempt):
+            if attempt.task is not None and not attempt.task.done() and attempt.forward is None:
+                attempt.task.cancel()
@@ -1,12 +1,60 @@
-from typing import List
+import os
+import re
+import html
+import time
+import asyncio
+import logging
+from typing import List, NamedTuple
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+from helpers.metricsHelper import increment
+
+logger = logging.getLogger(__name__)
+
 MAX_MESSAGE_LENGTH = 3850
+# Minimum seconds between two edits of a streamed reply
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+
+# Opening or closing tag, entity, or one of the separators a message is preferably split after
+SPLIT_TOKEN_PATTERN = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^<>]*>|&#?\w+;|\n|\. | ')
+TAG_PATTERN = re.compile(r'<[^<>]*>')
+# Separators in the order they are preferred as a split point
+SPLIT_SEPARATORS = {"\n": 0, ". ": 1, " ": 2}
+
+class OpenTag(NamedTuple):
+    # Tags are kept as a linked stack so the open tags at a split point can be remembered cheaply
+    name: str
+    tag: str
+    close_length: int
+    parent: "OpenTag"
+
+def opening_tags(stack: OpenTag) -> str:
+    tags = []
+    while stack is not None:
+        tags.append(stack.tag)
+        stack = stack.parent
+    return "".join(reversed(tags))
+
+def closing_tags(stack: OpenTag) -> str:
+    tags = []
+    while stack is not None:
+        tags.append(f"</{stack.name}>")
+        stack = stack.parent
+    return "".join(tags)
 
-def smart_split(text: str, chars_per_string: int = MAX_MESSAGE_LENGTH) -> List[str]:
+def close_length(stack: OpenTag) -> int:
+    return stack.close_length if stack is not None else 0
+
+def smart_split(text: str, chars_per_string: int = MAX_MESSAGE_LENGTH, parse_html: bool = True) -> List[str]:
     r"""
     Splits one string into multiple strings, with a maximum amount of `chars_per_string` characters per string.
     This is very useful for splitting one giant message into multiples.
-    If `chars_per_string` > 4096: `chars_per_string` = 4096.
-    Splits by '\n', '. ' or ' ' in exactly this priority.
+    If `chars_per_string` > MAX_MESSAGE_LENGTH: `chars_per_string` = MAX_MESSAGE_LENGTH.
+    Splits after '\n', '. ' or ' ' in exactly this priority, and anywhere in the text if none of them is found.
+
+    With `parse_html` the text is treated as Telegram HTML: tags and entities are never cut, and tags that are
+    open at a split point are closed at the end of the part and reopened at the start of the next one, so every
+    part can be sent with parse_mode=HTML on its own. The text is scanned once.
 
     :param text: The text to split
     :type text: :obj:`str`
@@ -14,29 +62,197 @@ def smart_split(text: str, chars_per_string: int = MAX_MESSAGE_LENGTH) -> List[s
     :param chars_per_string: The number of maximum characters per part the text is split to.
     :type chars_per_string: :obj:`int`
 
+    :param parse_html: Whether the text is HTML whose tags and entities must be kept intact.
+    :type parse_html: :obj:`bool`
+
     :return: The splitted text as a list of strings.
     :rtype: :obj:`list` of :obj:`str`
     """
 
-    def _text_before_last(substr: str) -> str:
-        return substr.join(part.split(substr)[:-1]) + substr
-
     if chars_per_string > MAX_MESSAGE_LENGTH: chars_per_string = MAX_MESSAGE_LENGTH
 
+    # (prefix, start, end, open tags at end) of every finished part
     parts = []
-    while True:
-        if len(text) < chars_per_string:
-            parts.append(text)
-            return parts
-
-        part = text[:chars_per_string]
-
-        if "\n" in part:
-            part = _text_before_last("\n")
-        elif ". " in part:
-            part = _text_before_last(". ")
-        elif " " in part:
-            part = _text_before_last(" ")
-
-        parts.append(part)
-        text = text[len(part):]
\ No newline at end of file
+    prefix = ""
+    part_start = 0
+    stack = None
+    # separator priority -> (position after the separator, open tags there), latest of each in the current part
+    split_points = {}
+    # End of the last visible text, a part is only ended after it holds some
+    last_visible = 0
+
+    def split_at(position: int, open_tags: OpenTag) -> None:
+        nonlocal prefix, part_start
+        parts.append((prefix, part_start, position, open_tags))
+        prefix = opening_tags(open_tags)
+        part_start = position
+        for priority in [p for p, (point, _) in split_points.items() if point <= position]:
+            del split_points[priority]
+
+    def fit(segment_start: int, segment_end: int, stack_after: OpenTag, atomic: bool) -> None:
+        # Split until the part would fit if it ended after this segment, a lone segment that does not fit is kept whole
+        while len(prefix) + segment_end - part_start + close_length(stack_after) > chars_per_string:
+            if split_points:
+                position, open_tags = split_points[min(split_points)]
+            elif atomic:
+                position, open_tags = (segment_start if last_visible > part_start else part_start), stack
+            else:
+                position, open_tags = max(segment_start, part_start + chars_per_string - len(prefix) - close_length(stack)), stack
+            if position <= part_start:
+                return
+            split_at(position, open_tags)
+
+    position = 0
+    for match in SPLIT_TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        if match.start() > position:
+            fit(position, match.start(), stack, atomic=False)
+            last_visible = match.start()
+        if token in SPLIT_SEPARATORS:
+            fit(match.start(), match.end(), stack, atomic=False)
+            if token == ". ":
+                last_visible = match.start() + 1
+            if last_visible > part_start:
+                split_points[SPLIT_SEPARATORS[token]] = (match.end(), stack)
+        elif not parse_html:
+            fit(match.start(), match.end(), stack, atomic=False)
+            last_visible = match.end()
+        elif token.startswith("&"):
+            fit(match.start(), match.end(), stack, atomic=True)
+            last_visible = match.end()
+        elif match.group(1):
+            # Closing tag, close everything up to the matching opening tag and ignore it if there is none
+            name = match.group(2).lower()
+            closed = stack
+            while closed is not None and closed.name != name:
+                closed = closed.parent
+            stack_after = closed.parent if closed is not None else stack
+            fit(match.start(), match.end(), stack_after, atomic=True)
+            stack = stack_after
+        else:
+            name = match.group(2).lower()
+            stack_after = OpenTag(name, token, len(name) + 3 + close_length(stack), stack)
+            fit(match.start(), match.end(), stack_after, atomic=True)
+            stack = stack_after
+        position = match.end()
+    if len(text) > position:
+        fit(position, len(text), stack, atomic=False)
+        last_visible = len(text)
+
+    remainder = text[part_start:]
+    if parse_html:
+        remainder = TAG_PATTERN.sub("", remainder)
+    if parts and not remainder.strip():
+        # Do not send a last part that only closes tags, let the previous part run to the end instead
+        last_prefix, last_start, _, _ = parts.pop()
+        parts.append((last_prefix, last_start, len(text), stack))
+    else:
+        parts.append((prefix, part_start, len(text), stack))
+    return [part_prefix + text[start:end] + (closing_tags(open_tags) if parse_html else "") for part_prefix, start, end, open_tags in parts]
+
+def split_escaped(text: str, limit: int) -> str:
+    # First smart_split part of text that is at most limit characters once HTML escaped
+    length = limit
+    part = smart_split(text, length, parse_html=False)[0]
+    while len(html.escape(part)) > limit and length > 1:
+        length = max(length - (len(html.escape(part)) - limit), 1)
+        part = smart_split(text, length, parse_html=False)[0]
+    return part
+
+class StreamEditor:
+    r"""
+    Shows a streamed reply by editing the "Working hard..." placeholder as text arrives.
+    Edits are rate limited to one every `interval` seconds per message to stay within Telegram's edit limits.
+    When the streamed text grows past the `smart_split` boundary the current message is frozen and
+    streaming rolls over into a new reply message.
+
+    :param bot_message: The placeholder message to edit.
+    :param sent_messages: List that new message ids are appended to so they get cleaned up later.
+    :param heading: HTML heading shown at the top of the first message.
+    :param interval: Minimum number of seconds between two edits.
+    """
+
+    def __init__(self, bot_message, sent_messages: list, heading: str = "", interval: float = STREAM_EDIT_INTERVAL):
+        self.messages = [bot_message]
+        self.sent_messages = sent_messages
+        self.heading = heading
+        self.interval = interval
+        self.text = ""
+        self._offset = 0
+        self._last_edit = 0.0
+        self._last_shown = ""
+        self._task = None
+
+    async def push(self, delta: str) -> None:
+        self.text += delta
+        # Only one edit in flight at a time and never more often than the interval allows
+        if self._task is not None and not self._task.done():
+            return
+        if time.monotonic() - self._last_edit < self.interval:
+            return
+        self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        current = self.text[self._offset:]
+        header = self.heading if len(self.messages) == 1 else ""
+        # Measured escaped, as Telegram counts it, and repeated since a burst of deltas can fill several messages
+        while len(header) + len(html.escape(current)) > MAX_MESSAGE_LENGTH:
+            # Freeze the current message at the split boundary and continue in a new one
+            part = split_escaped(current, MAX_MESSAGE_LENGTH - len(header))
+            await self._edit(self.messages[-1], header + html.escape(part))
+            self._offset += len(part)
+            message = await self.messages[-1].reply_text("...")
+            self.messages.append(message)
+            self.sent_messages.append(message.message_id)
+            self._last_shown = ""
+            current = self.text[self._offset:]
+            header = ""
+        if current.strip() and current != self._last_shown:
+            await self._edit(self.messages[-1], header + html.escape(current))
+            self._last_shown = current
+
+    async def _edit(self, message, text: str) -> None:
+        self._last_edit = time.monotonic()
+        try:
+            await message.edit_text(text, parse_mode=ParseMode.HTML)
+        except RetryAfter as e:
+            # Back off for as long as Telegram asks before the next edit
+            self._last_edit = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            if 'Message is not modified' not in str(e):
+                logger.warning(f"Failed to edit streamed message: {e}")
+
+    async def finish(self, message_parts: List[str], fallback_text: str = "") -> None:
+        r"""
+        Replaces the streamed preview with the final formatted `message_parts`, reusing the messages already
+        sent while streaming and sending or deleting messages so that there is exactly one per part.
+        """
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:
+                # The final parts replace whatever the failed edit left behind
+                logger.warning(f"Failed to update the streamed reply: {e}")
+        for i, message_part in enumerate(message_parts):
+            try:
+                if i < len(self.messages):
+                    await self.messages[i].edit_text(message_part, parse_mode=ParseMode.HTML)
+                else:
+                    message = await self.messages[0].reply_text(message_part, parse_mode=ParseMode.HTML)
+                    self.messages.append(message)
+                    self.sent_messages.append(message.message_id)
+            except Exception as e:
+                if 'Message is not modified' in str(e):
+                    continue
+                # Counted so the share of replies Telegram rejects as invalid HTML can be watched
+                logger.warning(f"Telegram rejected the formatted reply: {e}")
+                increment("format_fallbacks")
+                message = await self.messages[0].reply_text(f"Message unable to format properly: {fallback_text}")
+                self.sent_messages.append(message.message_id)
+                return
+        for message in self.messages[len(message_parts):]:
+            try:
+                await message.delete()
+            except Exception:
+                pass
+        self.messages = self.messages[:len(message_parts)]
@@ -0,0 +1,163 @@
+import os
+import logging
+from typing import Final
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Tokenizer used to estimate token counts locally, either a local tokenizer.json or a Hugging Face hub name
+TOKENIZER_PATH = os.getenv('TOKENIZER_PATH')
+TOKENIZER_NAME = os.getenv('TOKENIZER_NAME', 'gpt2')
+# Flat token cost assumed for each image
+IMAGE_TOKENS = int(os.getenv('IMAGE_TOKENS', 765))
+# Only the newest images are sent to the provider, older ones are dropped first
+MAX_CONTEXT_IMAGES = int(os.getenv('MAX_CONTEXT_IMAGES', 2))
+# Optional hard cap on the context budget for every model
+CONTEXT_TOKEN_BUDGET = os.getenv('CONTEXT_TOKEN_BUDGET')
+# Headroom kept free because the local tokenizer only approximates the provider's
+CONTEXT_SAFETY_RATIO = float(os.getenv('CONTEXT_SAFETY_RATIO', 0.9))
+
+# Context window sizes by model name prefix, the longest matching prefix wins
+MODEL_CONTEXT_WINDOWS: Final = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'claude-3': 200000,
+    'gemini-1.5': 1000000,
+}
+DEFAULT_CONTEXT_WINDOW: Final = 8192
+
+tokenizer = None
+
+def load_tokenizer() -> None:
+    """
+    Load the tokenizer, from TOKENIZER_PATH or the Hugging Face hub.
+
+    Loading from the hub may download it, so this is run once at startup off the event loop.
+    Until it is loaded, or if it cannot be, token counts are estimated from the length.
+    """
+    global tokenizer
+    try:
+        from tokenizers import Tokenizer
+        if TOKENIZER_PATH:
+            tokenizer = Tokenizer.from_file(TOKENIZER_PATH)
+        else:
+            tokenizer = Tokenizer.from_pretrained(TOKENIZER_NAME)
+    except Exception as e:
+        logger.warning(f"Tokenizer unavailable, estimating token counts from length: {e}")
+
+def count_tokens(message_type: str, message: str) -> int:
+    if message_type == 'image_url':
+        return IMAGE_TOKENS
+    if not message:
+        return 0
+    if tokenizer is None:
+        return len(message) // 4 + 1
+    return len(tokenizer.encode(message).ids)
+
+def count_history_tokens(chat_history: list) -> int:
+    # chat_history is a list of (type, message, role) rows
+    return sum(count_tokens(message_type, message) for message_type, message, _ in chat_history)
+
+def get_context_budget(model: str, max_tokens: int) -> int:
+    window = DEFAULT_CONTEXT_WINDOW
+    matched = ""
+    for prefix, size in MODEL_CONTEXT_WINDOWS.items():
+        if model.startswith(prefix) and len(prefix) > len(matched):
+            window, matched = size, prefix
+    budget = int(window * CONTEXT_SAFETY_RATIO) - max_tokens
+    if CONTEXT_TOKEN_BUDGET:
+        budget = min(budget, int(CONTEXT_TOKEN_BUDGET))
+    return max(budget, 0)
+
+def turn_start(rows: list, index: int) -> int:
+    """
+    Move a cut in a list of history rows back to the start of a turn.
+
+    Claude and Gemini reject a history that starts with an assistant message, and an image
+    belongs with the caption after it, so the first row from index on must be a user row
+    that does not follow an image.
+
+    Parameters:
+    - rows: list of (message_id, type, message, role, ...) rows in chat order
+    - index: the first row that would be kept
+
+    Returns:
+    - the first row to keep, at most index
+    """
+    while 0 < index < len(rows) and (rows[index][3] != 'user' or rows[index - 1][1] == 'image_url'):
+        index -= 1
+    return index
+
+def fit_to_budget(chat_history: list, model: str, max_tokens: int) -> list:
+    """
+    Select the rows of a chat history that fit the context budget of a model.
+
+    The system prompt is always kept, followed by as many of the newest turns as fit.
+    A history that fits is kept whole; otherwise images older than the newest
+    MAX_CONTEXT_IMAGES are dropped before any text is.
+
+    Parameters:
+    - chat_history: list of (message_id, type, message, role, tokens) rows in chat order
+    - model: the model the messages are sent to
+    - max_tokens: the number of tokens reserved for the reply
+
+    Returns:
+    - list of (type, message, role) rows ready for the build_message_list functions
+    """
+    system_rows = []
+    rows = chat_history
+    if rows and rows[0][3] == 'system':
+        system_rows, rows = [rows[0]], rows[1:]
+    budget = get_context_budget(model, max_tokens) - sum(row[4] or 0 for row in system_rows)
+
+    if sum(row[4] or 0 for row in rows) <= budget:
+        # Everything fits, old images are only dropped to make room
+        return [(message_type, message, role) for _, message_type, message, role, _ in system_rows + rows]
+
+    selected = []
+    images = 0
+    for row in reversed(rows):
+        _, message_type, _, _, tokens = row
+        if message_type == 'image_url':
+            if images >= MAX_CONTEXT_IMAGES:
+                continue
+            images += 1
+        tokens = tokens or 0
+        # Always keep the newest message even if it alone exceeds the budget
+        if tokens > budget and selected:
+            break
+        budget -= tokens
+        selected.append(row)
+    selected.reverse()
+    # Rows that were cut off from the start of their turn are dropped as well
+    while len(selected) > 1 and selected[0][3] != 'user':
+        selected.pop(0)
+    return [(message_type, message, role) for _, message_type, message, role, _ in system_rows + selected]
+
+def apply_summary(chat_history: list, summary, start_prompt: str) -> tuple:
+    """
+    Replace the turns covered by a chat summary with the summary itself.
+
+    The summary is appended to the system prompt so every provider receives it,
+    and only the turns newer than the summary are kept.
+
+    Parameters:
+    - chat_history: list of (message_id, type, message, role, tokens) rows in chat order
+    - summary: (summary, last_message_id, tokens) or None
+    - start_prompt: the system prompt passed separately to Claude and Gemini
+
+    Returns:
+    - (chat_history, start_prompt) with the summary applied
+    """
+    if summary is None:
+        return chat_history, start_prompt
+    summary_text, last_message_id, summary_tokens = summary
+    addition = f"\n\nSummary of the earlier conversation:\n{summary_text}"
+    rows = [row for row in chat_history if row[0] > last_message_id and row[3] != 'system']
+    if chat_history and chat_history[0][3] == 'system':
+        message_id, message_type, message, role, tokens = chat_history[0]
+        rows.insert(0, (message_id, message_type, message + addition, role, (tokens or 0) + (summary_tokens or 0)))
+    return rows, start_prompt + addition
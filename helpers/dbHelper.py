@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import base64
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Initialise path to db
+DB_DIR = os.getenv('DB_DIR')
+os.makedirs(DB_DIR, exist_ok=True)
+
+# Number of compiled statements sqlite keeps per connection
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 256))
+# Queued writes are committed together after this many seconds or once this many are queued
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', 0.5))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 100))
+
+def move_images_to_store(conn: sqlite3.Connection) -> None:
+    # Replace base64 images in chat_history with the SHA-256 of the bytes stored in the images table
+    rows = conn.execute("SELECT message_id, message FROM chat_history WHERE type = 'image_url'").fetchall()
+    for message_id, message in rows:
+        image_bytes = base64.b64decode(message)
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        conn.execute("INSERT OR IGNORE INTO images (hash, data) VALUES (?, ?)", (image_hash, image_bytes))
+        conn.execute("UPDATE chat_history SET message = ? WHERE message_id = ?", (image_hash, message_id))
+
+# Schema of chats.db, one list of statements per version.
+# A statement is either SQL or a function called with the connection.
+# Never edit a released version, append a new one instead.
+CHATS_MIGRATIONS = [
+    # Version 1: initial tables
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS chats(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_title TEXT,
+            input_tokens INTEGER DEFAULT 0,
+            output_tokens INTEGER DEFAULT 0)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            chat_id INTEGER,
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT DEFAULT 'text',
+            message TEXT,
+            role TEXT,
+            FOREIGN KEY (chat_id) REFERENCES chats(id)
+        )
+        ''',
+    ],
+    # Version 2: index lookups by chat and by user
+    [
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_chat_id ON chat_history(chat_id, message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_user_id ON chats(user_id, id)",
+    ],
+    # Version 3: per message token counts, filled in lazily for older rows
+    [
+        "ALTER TABLE chat_history ADD COLUMN tokens INTEGER",
+    ],
+    # Version 4: rolling summary of the older turns of each chat
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            last_message_id INTEGER,
+            tokens INTEGER,
+            FOREIGN KEY (chat_id) REFERENCES chats(id)
+        )
+        ''',
+    ],
+    # Version 5: images are stored once as bytes and chat_history keeps their hash
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS images (
+            hash TEXT PRIMARY KEY,
+            data BLOB
+        )
+        ''',
+        move_images_to_store,
+    ],
+    # Version 6: Telegram file_id of each image so it can be resent without uploading
+    [
+        "ALTER TABLE images ADD COLUMN file_id TEXT",
+    ],
+    # Version 7: which provider answered each reply and what hedging cost
+    [
+        '''CREATE TABLE IF NOT EXISTS request_log
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        provider TEXT,
+        model TEXT,
+        hedged INTEGER DEFAULT 0,
+        first_token_ms INTEGER,
+        wasted_tokens INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ],
+    # Version 8: input tokens read from and written to the provider's prompt cache
+    [
+        "ALTER TABLE chats ADD COLUMN cache_read_tokens INTEGER DEFAULT 0",
+        "ALTER TABLE chats ADD COLUMN cache_write_tokens INTEGER DEFAULT 0",
+    ],
+    # Version 9: look up the messages that reference an image
+    [
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_images ON chat_history(message) WHERE type = 'image_url'",
+    ],
+]
+
+# Schema of user_preferences.db
+USERS_MIGRATIONS = [
+    # Version 1: initial tables
+    [
+        '''CREATE TABLE IF NOT EXISTS user_preferences 
+        (user_id INTEGER PRIMARY KEY, 
+        provider TEXT DEFAULT "openai", 
+        model TEXT DEFAULT "gpt-3.5-turbo", 
+        temperature FLOAT DEFAULT 0.7, 
+        max_tokens INTEGER DEFAULT 512, 
+        n INTEGER DEFAULT 1, 
+        start_prompt TEXT DEFAULT ""
+        )''',
+        '''CREATE TABLE IF NOT EXISTS image_gen_user_preferences 
+        (user_id INTEGER PRIMARY KEY,
+        model TEXT DEFAULT "dall-e-2", 
+        size TEXT DEFAULT "256x256"
+        )''',
+    ],
+]
+
+def migrate(conn: sqlite3.Connection, migrations: list) -> None:
+    # The applied schema version is tracked in sqlite's user_version pragma
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target in range(version + 1, len(migrations) + 1):
+        with conn:
+            for statement in migrations[target - 1]:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+        logger.info(f"Migrated database to schema version {target}")
+
+class Database:
+    """
+    Owns the connection to one sqlite database.
+
+    Every query runs on a single dedicated thread so disk I/O never blocks the event loop
+    and writers to the same file are serialized instead of contending for the lock.
+    The connection is opened in WAL mode with synchronous=NORMAL and migrated on first use.
+    """
+
+    def __init__(self, path: str, migrations: list):
+        self.path = path
+        self.migrations = migrations
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=os.path.basename(path))
+        self.conn = None
+
+    def connect(self) -> sqlite3.Connection:
+        # Only ever called from the database thread
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            migrate(conn, self.migrations)
+            self.conn = conn
+        return self.conn
+
+    async def run(self, function, *args):
+        # Run function(connection, *args) on the database thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: function(self.connect(), *args))
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).lastrowid
+        return await self.run(_execute)
+
+    async def executemany(self, sql: str, params: list) -> None:
+        def _executemany(conn):
+            with conn:
+                conn.executemany(sql, params)
+        await self.run(_executemany)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def transaction(self, function):
+        # Run function(connection) inside a single transaction
+        def _transaction(conn):
+            with conn:
+                return function(conn)
+        return await self.run(_transaction)
+
+    async def close(self) -> None:
+        def _close(conn):
+            conn.close()
+            self.conn = None
+        if self.conn is not None:
+            await self.run(_close)
+        self.executor.shutdown(wait=True)
+        print(f"{os.path.basename(self.path)} DB Connection Closed")
+
+class WriteBehindQueue:
+    """
+    Collects writes that nothing reads back immediately and commits them in a single transaction
+    every `flush_interval` seconds or as soon as `batch_size` writes are queued.
+
+    Writes are applied in the order they were queued. Call flush before reading rows that may
+    still be queued and close on shutdown so nothing is lost.
+    """
+
+    def __init__(self, database: Database, flush_interval: float = WRITE_FLUSH_INTERVAL, batch_size: int = WRITE_BATCH_SIZE):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.timer = None
+        # Flushes started by add, kept so they are not garbage collected and their errors are logged
+        self.tasks = set()
+
+    def add(self, sql: str, params: tuple = ()) -> None:
+        self.pending.append((sql, params))
+        if len(self.pending) >= self.batch_size:
+            self.schedule_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_interval, self.schedule_flush)
+
+    def schedule_flush(self) -> None:
+        task = asyncio.ensure_future(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.flush_done)
+
+    def flush_done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Flushing queued writes failed: {task.exception()!r}")
+
+    async def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # Take the batch before awaiting so later writes go into the next one, batches run in order on the database thread
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        def _write(conn):
+            try:
+                with conn:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+                return []
+            except sqlite3.Error:
+                # One bad write must not take the rest of the batch with it, replay them one at a time
+                failed = []
+                for sql, params in batch:
+                    try:
+                        with conn:
+                            conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        failed.append((sql, params, e))
+                return failed
+        for sql, params, error in await self.database.run(_write):
+            logger.error(f"Dropped queued write {sql!r} {params!r}: {error!r}")
+
+    async def close(self) -> None:
+        await self.flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+chats_db = Database(os.path.join(DB_DIR, 'chats.db'), CHATS_MIGRATIONS)
+users_db = Database(os.path.join(DB_DIR, 'user_preferences.db'), USERS_MIGRATIONS)
+
+# Write-behind queue for chat messages and token counters
+chat_writes = WriteBehindQueue(chats_db)
+
+async def close_databases() -> None:
+    # Flush queued writes before the connections go away
+    await chat_writes.close()
+    await chats_db.close()
+    await users_db.close()
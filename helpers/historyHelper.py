@@ -0,0 +1,101 @@
+import os
+import asyncio
+from cachetools import LRUCache
+from helpers.contextHelper import count_tokens
+from helpers.dbHelper import chats_db, chat_writes
+
+# Number of chats whose history is kept in memory
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', 256))
+
+# chat_id -> list of (message_id, type, message, role, tokens) rows in insertion order
+history_cache = LRUCache(maxsize=HISTORY_CACHE_SIZE)
+# chat_id -> (summary, last_message_id, tokens) or None if the chat has not been compacted
+summary_cache = LRUCache(maxsize=HISTORY_CACHE_SIZE)
+# chat_id -> [total_input_tokens, total_output_tokens]
+token_totals_cache = LRUCache(maxsize=HISTORY_CACHE_SIZE)
+
+# Message ids are handed out here so inserts can be queued without waiting for their rowid
+last_message_id = None
+message_id_lock = asyncio.Lock()
+
+async def next_message_id() -> int:
+    global last_message_id
+    async with message_id_lock:
+        if last_message_id is None:
+            row = await chats_db.fetchone(
+                "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'chat_history'), 0), "
+                "COALESCE((SELECT MAX(message_id) FROM chat_history), 0))")
+            last_message_id = row[0]
+        last_message_id += 1
+        return last_message_id
+
+async def save_chat_message(chat_id: int, message: str, role: str, message_type: str = 'text') -> None:
+    # Queue the message for the database and add it to the cached history of the chat straight away
+    tokens = count_tokens(message_type, message)
+    message_id = await next_message_id()
+    chat_writes.add("INSERT INTO chat_history (message_id, chat_id, type, message, role, tokens) VALUES (?, ?, ?, ?, ?, ?)", 
+            (message_id, chat_id, message_type, message, role, tokens))
+    append_to_history(chat_id, (message_id, message_type, message, role, tokens))
+
+async def get_token_totals(chat_id: int) -> list:
+    totals = token_totals_cache.get(chat_id)
+    if totals is None:
+        # Make sure queued increments are in the database before reading it
+        await chat_writes.flush()
+        row = await chats_db.fetchone('SELECT input_tokens, output_tokens FROM chats WHERE id = ?', (chat_id,))
+        totals = list(row) if row else [0, 0]
+        token_totals_cache[chat_id] = totals
+    return totals
+
+async def add_token_usage(chat_id: int, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> tuple:
+    # Increment atomically in the database and return the new input and output totals
+    # Providers that did not report usage count as 0 instead of failing the reply
+    input_tokens, output_tokens = input_tokens or 0, output_tokens or 0
+    cache_read_tokens, cache_write_tokens = cache_read_tokens or 0, cache_write_tokens or 0
+    totals = await get_token_totals(chat_id)
+    totals[0] += input_tokens
+    totals[1] += output_tokens
+    chat_writes.add('UPDATE chats SET input_tokens = input_tokens + ?, output_tokens = output_tokens + ?, '
+            'cache_read_tokens = cache_read_tokens + ?, cache_write_tokens = cache_write_tokens + ? WHERE id = ?', 
+            (input_tokens, output_tokens, cache_read_tokens, cache_write_tokens, chat_id))
+    return totals[0], totals[1]
+
+async def get_chat_history(chat_id: int) -> list:
+    # Load the full history once, afterwards new rows are appended as they are saved
+    history = history_cache.get(chat_id)
+    if history is None:
+        await chat_writes.flush()
+        history = await chats_db.fetchall("SELECT message_id, type, message, role, tokens FROM chat_history WHERE chat_id = ? ORDER BY message_id", (chat_id,))
+        # Count tokens once for rows saved before token counts were stored
+        missing = [i for i, row in enumerate(history) if row[4] is None]
+        if missing:
+            # A long chat can take a while to tokenize, keep it off the event loop
+            counts = await asyncio.to_thread(lambda: [count_tokens(history[i][1], history[i][2]) for i in missing])
+            for i, tokens in zip(missing, counts):
+                message_id, message_type, message, role, _ = history[i]
+                history[i] = (message_id, message_type, message, role, tokens)
+        if missing:
+            await chats_db.executemany("UPDATE chat_history SET tokens = ? WHERE message_id = ?", [(history[i][4], history[i][0]) for i in missing])
+        history_cache[chat_id] = history
+    return history
+
+def append_to_history(chat_id: int, row: tuple) -> None:
+    # Chats that are not cached will pick the row up when they are next loaded
+    history = history_cache.get(chat_id)
+    if history is not None:
+        history.append(row)
+
+def invalidate_history(chat_id: int) -> None:
+    history_cache.pop(chat_id, None)
+    token_totals_cache.pop(chat_id, None)
+
+async def get_chat_summary(chat_id: int):
+    if chat_id not in summary_cache:
+        summary_cache[chat_id] = await chats_db.fetchone("SELECT summary, last_message_id, tokens FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+    return summary_cache[chat_id]
+
+def set_chat_summary(chat_id: int, summary: tuple) -> None:
+    summary_cache[chat_id] = summary
+
+def invalidate_summary(chat_id: int) -> None:
+    summary_cache.pop(chat_id, None)
@@ -0,0 +1,209 @@
+import os
+import re
+import html
+from collections import Counter
+from functools import lru_cache
+
+# Convert Markdown in replies to Telegram HTML before sanitizing, for models that ignore the HTML prompt
+MARKDOWN_TO_HTML = os.getenv('MARKDOWN_TO_HTML', 'false').lower() in ('1', 'true', 'yes')
+
+# Tags Telegram accepts, with the attributes kept for each
+ALLOWED_TAGS = {
+    'b': (), 'strong': (), 'i': (), 'em': (), 'u': (), 'ins': (), 's': (), 'strike': (), 'del': (),
+    'tg-spoiler': (), 'span': ('class',), 'a': ('href',), 'code': ('class',), 'pre': (),
+    'blockquote': ('expandable',), 'tg-emoji': ('emoji-id',),
+}
+# Tags models like to use, rewritten to what Telegram shows best
+MAPPED_TAGS = {
+    'h1': ('b', 'u'), 'h2': ('b',), 'h3': ('u',), 'h4': ('i',), 'h5': (), 'h6': (),
+    'big': ('b',), 'mark': ('b',), 'kbd': ('code',), 'samp': ('code',), 'tt': ('code',),
+}
+# HTML tags Telegram rejects, dropped while their content stays
+STRIPPED_TAGS = {
+    'p', 'div', 'article', 'section', 'header', 'footer', 'main', 'nav', 'aside', 'ul', 'ol', 'li', 'dl', 'dt', 'dd',
+    'sup', 'sub', 'abbr', 'small', 'font', 'center', 'cite', 'q', 'table', 'thead', 'tbody', 'tr', 'td', 'th',
+    'figure', 'figcaption', 'details', 'summary', 'label', 'img',
+}
+# Tags replaced by a line break
+LINE_BREAK_TAGS = {'br', 'hr'}
+CLOSING_TAGS = {name: f'</{name}>' for name in ALLOWED_TAGS}
+# Mapped tag -> (opening markup, closing markup) of its replacements
+MAPPED_MARKUP = {
+    name: (''.join(f'<{tag}>' for tag in tags), ''.join(f'</{tag}>' for tag in reversed(tags)))
+    for name, tags in MAPPED_TAGS.items() if tags
+}
+KNOWN_TAGS = set(ALLOWED_TAGS) | set(MAPPED_TAGS) | STRIPPED_TAGS | LINE_BREAK_TAGS
+# Named entities Telegram understands, every other & is escaped
+ALLOWED_ENTITIES = {'lt', 'gt', 'amp', 'quot'}
+ENTITY_TOKENS = {f'&{entity};' for entity in ALLOWED_ENTITIES}
+# Opening tags that are kept exactly as written
+PLAIN_TAGS = {f'<{name}>' for name in ALLOWED_TAGS if name not in ('a', 'span', 'tg-emoji')}
+# Tokens a reply that is already valid Telegram HTML usually consists of
+SAFE_TOKENS = ENTITY_TOKENS | PLAIN_TAGS | {f'</{name}>' for name in ALLOWED_TAGS}
+SAFE_TOKEN_PATTERN = re.compile(r'<[^<>]*>|&#?\w*;?|[<>]')
+NUMERIC_ENTITY_PATTERN = re.compile(r'&#(\d+|[xX][0-9a-fA-F]+);')
+
+TOKEN_PATTERN = re.compile(r'<(/?)([a-zA-Z][\w-]*)((?:[^<>"\']|"[^"]*"|\'[^\']*\')*)>|&(#\d+|#[xX][0-9a-fA-F]+|\w+);|[<>&]')
+ATTRIBUTE_PATTERN = re.compile(r'([\w-]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+)))?')
+
+MARKDOWN_PATTERN = re.compile(
+    r'```[ \t]*([\w+-]*)[ \t]*\n(.*?)```'      # fenced code block
+    r'|`([^`\n]+)`'                             # inline code
+    r'|^[ \t]*#{1,6}[ \t]+([^\n]+?)[ \t]*#*[ \t]*$'  # heading
+    r'|\*\*(?=\S)([^\n]+?)(?<=\S)\*\*'              # bold
+    r'|(?<!\w)__(?=\S)([^\n]+?)(?<=\S)__(?!\w)'     # bold
+    r'|~~(?=\S)([^\n]+?)(?<=\S)~~'                  # strikethrough
+    r'|(?<![\w*])\*(?=[^\s*])([^\n]+?)(?<=[^\s*])\*(?![\w*])'  # italic
+    r'|(?<!\w)_(?=[^\s_])([^\n]+?)(?<=[^\s_])_(?!\w)'          # italic
+    r'|\[([^\]\n]+)\]\((https?://[^)\s]+)\)',   # link
+    re.DOTALL | re.MULTILINE)
+
+def markdown_to_html(text: str) -> str:
+    r"""
+    Converts the Markdown models commonly produce to Telegram HTML.
+    Code is escaped so the sanitizer keeps it as text, everything else is left for the sanitizer.
+    """
+    def replace(match: re.Match) -> str:
+        language, block, inline, heading, bold, bold_underscore, strike, italic, italic_underscore, link_text, link_url = match.groups()
+        if block is not None:
+            code_class = f' class="language-{language}"' if language else ''
+            return f'<pre><code{code_class}>{html.escape(block.rstrip(), quote=False)}</code></pre>'
+        if inline is not None:
+            return f'<code>{html.escape(inline, quote=False)}</code>'
+        if heading is not None:
+            return f'<b>{markdown_to_html(heading)}</b>'
+        if bold is not None or bold_underscore is not None:
+            return f'<b>{markdown_to_html(bold or bold_underscore)}</b>'
+        if strike is not None:
+            return f'<s>{markdown_to_html(strike)}</s>'
+        if italic is not None or italic_underscore is not None:
+            return f'<i>{markdown_to_html(italic or italic_underscore)}</i>'
+        return f'<a href="{html.escape(link_url)}">{markdown_to_html(link_text)}</a>'
+
+    return MARKDOWN_PATTERN.sub(replace, text)
+
+@lru_cache(maxsize=1024)
+def build_tag(name: str, attributes: str) -> str:
+    # Keep only the attributes Telegram accepts for the tag, None when the tag itself is not acceptable
+    allowed = ALLOWED_TAGS[name]
+    kept = {}
+    for match in ATTRIBUTE_PATTERN.finditer(attributes):
+        attribute = match.group(1).lower()
+        if attribute in allowed:
+            value = next((group for group in match.groups()[1:] if group is not None), '')
+            kept[attribute] = html.unescape(value)
+    if name == 'a' and not kept.get('href'):
+        return None
+    if name == 'span' and kept.get('class') != 'tg-spoiler':
+        return None
+    if name == 'tg-emoji' and not kept.get('emoji-id'):
+        return None
+    if name == 'code' and not kept.get('class', '').startswith('language-'):
+        kept.pop('class', None)
+    rendered = ''.join(f' {attribute}="{html.escape(value)}"' if value or attribute != 'expandable' else f' {attribute}' for attribute, value in kept.items())
+    return f'<{name}{rendered}>'
+
+def is_telegram_html(text: str) -> bool:
+    # Quick check for replies that need no changes: only plain supported tags, properly nested,
+    # nothing inside code and no stray '<', '>' or '&'. Most of the work happens in the regex engine
+    tokens = SAFE_TOKEN_PATTERN.findall(text)
+    unknown = set(tokens) - SAFE_TOKENS
+    if unknown and not all(NUMERIC_ENTITY_PATTERN.fullmatch(token) for token in unknown):
+        return False
+    stack = []
+    for token in tokens:
+        if token[0] != '<':
+            continue
+        if token[1] == '/':
+            if not stack or stack.pop() != token:
+                return False
+        elif stack and stack[-1] in ('</code>', '</pre>') and not (token == '<code>' and stack[-1] == '</pre>'):
+            return False
+        else:
+            stack.append(f'</{token[1:]}')
+    return not stack
+
+def sanitize_html(text: str, markdown: bool = MARKDOWN_TO_HTML) -> str:
+    r"""
+    Turns a model's reply into HTML Telegram accepts, in a single pass over the text.
+
+    Supported tags are kept with their supported attributes, headings and similar tags are mapped to
+    supported ones and other HTML tags are dropped while keeping their content. Anything else that
+    looks like a tag, such as List<String>, is escaped and shown as text. Closing tags without an
+    opening tag are dropped and tags left open are closed. Inside code only the closing tag is
+    markup, so code showing HTML is kept as text. Stray '<', '>' and '&' are escaped.
+
+    :param text: The reply to sanitize.
+    :param markdown: Whether to convert Markdown to HTML first.
+    :return: The sanitized reply.
+    """
+    if markdown:
+        text = markdown_to_html(text)
+
+    # Most replies are plain text or already valid, those are returned as they are
+    if ('<' not in text and '>' not in text and '&' not in text) or is_telegram_html(text):
+        return text
+
+    output = []
+    append = output.append
+    # Open tags as (name, closing markup), the closing markup of a mapped tag closes all its replacements
+    stack = []
+    # name -> number of open tags with that name
+    open_counts = Counter()
+    position = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        start = match.start()
+        if start != position:
+            append(text[position:start])
+        position = match.end()
+        token = match.group()
+        if token in ENTITY_TOKENS:
+            # Most tokens of a reply are one of a handful of entities or plain tags
+            append(token)
+            continue
+        closing, name, attributes, entity = match.groups()
+        if name is None:
+            if entity is not None and entity.startswith('#'):
+                append(token)
+            else:
+                append(html.escape(token[0]) + token[1:])
+            continue
+
+        name = name.lower()
+        if stack and stack[-1][0] in ('code', 'pre') and not (closing and open_counts[name]) and not (name == 'code' and not closing and stack[-1][0] == 'pre'):
+            # Markup inside code is shown as text
+            append(html.escape(token, quote=False))
+            continue
+
+        if name not in KNOWN_TAGS:
+            append(html.escape(token, quote=False))
+            continue
+
+        if closing:
+            if not open_counts[name]:
+                continue
+            while stack:
+                open_name, close_markup = stack.pop()
+                open_counts[open_name] -= 1
+                append(close_markup)
+                if open_name == name:
+                    break
+            continue
+
+        if name in ALLOWED_TAGS:
+            tag = token if token in PLAIN_TAGS else build_tag(name, attributes)
+            if tag is not None:
+                append(tag)
+                stack.append((name, CLOSING_TAGS[name]))
+                open_counts[name] += 1
+        elif name in LINE_BREAK_TAGS:
+            append('\n')
+        elif name in MAPPED_MARKUP:
+            opening, closing_markup = MAPPED_MARKUP[name]
+            append(opening)
+            stack.append((name, closing_markup))
+            open_counts[name] += 1
+    append(text[position:])
+    while stack:
+        append(stack.pop()[1])
+    return ''.join(output)
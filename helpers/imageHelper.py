@@ -0,0 +1,77 @@
+import os
+import base64
+import time
+import hashlib
+from cachetools import LRUCache
+from helpers.dbHelper import chats_db, chat_writes
+
+# Number of base64 encoded images kept in memory for provider payloads
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', 64))
+
+# Seconds a newly stored image is kept even before a message references it
+IMAGE_DELETE_GRACE = float(os.getenv('IMAGE_DELETE_GRACE', 600))
+
+# image hash -> base64 string
+base64_cache = LRUCache(maxsize=IMAGE_CACHE_SIZE)
+# image hash -> monotonic time it was last stored, its message may still be on the way
+recently_stored = {}
+
+async def store_image(image_bytes: bytes) -> str:
+    # Images are stored once under the SHA-256 of their bytes, repeated uploads reuse the same row
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    recently_stored[image_hash] = time.monotonic()
+    await chats_db.execute("INSERT OR IGNORE INTO images (hash, data) VALUES (?, ?)", (image_hash, image_bytes))
+    return image_hash
+
+async def get_image_bytes(image_hash: str) -> bytes:
+    row = await chats_db.fetchone("SELECT data FROM images WHERE hash = ?", (image_hash,))
+    return row[0] if row else None
+
+async def get_image_file_id(image_hash: str) -> str:
+    # File ids are saved through chat_writes, flush it first when the latest ones must be seen
+    row = await chats_db.fetchone("SELECT file_id FROM images WHERE hash = ?", (image_hash,))
+    return row[0] if row else None
+
+def set_image_file_id(image_hash: str, file_id: str) -> None:
+    chat_writes.add("UPDATE images SET file_id = ? WHERE hash = ?", (file_id, image_hash))
+
+async def get_image_base64(image_hash: str) -> str:
+    image = base64_cache.get(image_hash)
+    if image is None:
+        image_bytes = await get_image_bytes(image_hash)
+        if image_bytes is None:
+            return None
+        image = base64.b64encode(image_bytes).decode('utf-8')
+        base64_cache[image_hash] = image
+    return image
+
+async def resolve_images(chat_history: list) -> list:
+    # Swap image references for base64 data, only for the images that made it into the context window
+    resolved = []
+    for message_type, message, role in chat_history:
+        if message_type == 'image_url':
+            message = await get_image_base64(message)
+            if message is None:
+                continue
+        resolved.append((message_type, message, role))
+    return resolved
+
+async def delete_unused_images(image_hashes) -> None:
+    """
+    Delete the images no message references any more, out of the given hashes.
+
+    The deletes are queued behind the pending writes, so messages saved before them are committed
+    first, and each delete re-checks the references in the same statement. An image that was just
+    uploaded again is kept while its message may still be on the way.
+    """
+    now = time.monotonic()
+    for image_hash, stored_at in list(recently_stored.items()):
+        if now - stored_at >= IMAGE_DELETE_GRACE:
+            del recently_stored[image_hash]
+    for image_hash in image_hashes:
+        if image_hash in recently_stored:
+            continue
+        chat_writes.add("DELETE FROM images WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM chat_history WHERE type = 'image_url' AND message = ?)",
+                (image_hash, image_hash))
+        base64_cache.pop(image_hash, None)
+    await chat_writes.flush()
@@ -6,25 +6,32 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ApplicationHandlerStop, ConversationHandler
 
 from helpers.userHelper import (
+    on_start,
     add_user,
     get_all_user_ids,
 )
 
 from settings.chatCompletionHandler import reset_user_settings
 from settings.imageGenHandler import reset_user_image_settings
+from helpers.metricsHelper import snapshot
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load whitelisted telegram ids
+# Load whitelisted telegram ids, filled in by load_whitelist once the application starts
 admin_telegram_id = int(os.getenv('TELEGRAM_ADMIN_ID'))
-whitelisted_telegram_id = get_all_user_ids()
+whitelisted_telegram_id = []
 
 # Define shared states
 SELECTING_CHAT, CREATE_NEW_CHAT, CHATTING, RETURN_TO_MENU = range(4)
 
 ## Main Helper Functions
 
+async def load_whitelist() -> None:
+    # Add the whitelisted users from the environment and load every known user id
+    await on_start()
+    whitelisted_telegram_id.extend(await get_all_user_ids())
+
 async def admin_add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Ensure that there is a user ID in the message
     if len(update.message.text.split(" ")) < 2:
@@ -35,7 +42,7 @@ async def admin_add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         user_id = update.message.text.split(" ")[1].strip()
         print(f"User id: {user_id}")
         if user_id.isdigit() and int(user_id) not in whitelisted_telegram_id and not None:
-            add_user(user_id)
+            await add_user(user_id)
             whitelisted_telegram_id.append(int(user_id))
             message = await update.effective_message.reply_text(f"User id <code>{user_id}</code> added successfully", parse_mode=ParseMode.HTML)
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
@@ -53,8 +60,8 @@ async def admin_reset_user_settings(update: Update, context: ContextTypes.DEFAUL
         user_id = update.message.text.split(" ")[1].strip()
         print(f"User id: {user_id}")
         if user_id.isdigit() and int(user_id) in whitelisted_telegram_id:
-            success_reset_settings = reset_user_settings(user_id)
-            success_reset_image_settings = reset_user_image_settings(user_id)
+            success_reset_settings = await reset_user_settings(user_id)
+            success_reset_image_settings = await reset_user_image_settings(user_id)
             if success_reset_settings and success_reset_image_settings:
                 message = await update.effective_message.reply_text(f"User id <code>{user_id}</code> settings reset successfully", parse_mode=ParseMode.HTML)
                 context.user_data.setdefault('sent_messages', []).append(message.message_id)
@@ -66,6 +73,21 @@ async def admin_reset_user_settings(update: Update, context: ContextTypes.DEFAUL
         message = await update.effective_message.reply_text("You are not allowed to use me!", parse_mode=ParseMode.HTML)
         context.user_data.setdefault('sent_messages', []).append(message.message_id)
 
+async def admin_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != admin_telegram_id:
+        message = await update.effective_message.reply_text("You are not allowed to use me!", parse_mode=ParseMode.HTML)
+        context.user_data.setdefault('sent_messages', []).append(message.message_id)
+        return
+    metrics = snapshot()
+    lines = ["<b>Counters</b>"]
+    lines += [f"{name}: <code>{value:g}</code>" for name, value in sorted(metrics['counters'].items())]
+    lines.append("\n<b>Gauges</b>")
+    lines += [f"{name}: <code>{value:g}</code>" for name, value in sorted(metrics['gauges'].items())]
+    lines.append("\n<b>Observations</b> (count / avg / max)")
+    lines += [f"{name}: <code>{stats['count']} / {stats['avg']:.3f} / {stats['max']:.3f}</code>" for name, stats in sorted(metrics['observations'].items())]
+    message = await update.effective_message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    context.user_data.setdefault('sent_messages', []).append(message.message_id)
+
 async def cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Delete all messages before the next message
     if 'sent_messages' in context.user_data:
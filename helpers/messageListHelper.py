@@ -0,0 +1,135 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cachetools import LRUCache
+from helpers.metricsHelper import increment
+
+# Number of (chat, provider) message lists kept in memory
+MESSAGE_LIST_CACHE_SIZE = int(os.getenv('MESSAGE_LIST_CACHE_SIZE', 64))
+
+# Chat whose message lists may be cached, only set while answering that chat
+current_chat_id = ContextVar('current_chat_id', default=None)
+
+class MessageList:
+    def __init__(self, provider: str):
+        self.provider = provider
+        # (type, message, role) rows already turned into messages
+        self.rows = []
+        self.messages = []
+        # index in rows -> index in messages, for rows that start a turn and so always start a new message
+        self.turn_starts = {}
+
+    def append(self, rows: list, append_messages) -> None:
+        # Appended a turn at a time, so each turn's first message is known when older turns are dropped
+        position = 0
+        while position < len(rows):
+            end = next((index for index in range(position + 1, len(rows)) if is_turn_start(rows, index)), len(rows))
+            if not self.rows or is_turn_start([self.rows[-1], rows[position]], 1):
+                self.turn_starts[len(self.rows)] = len(self.messages)
+            consumed = append_messages(self.messages, rows[position:end])
+            self.rows.extend(rows[position:position + consumed])
+            position += consumed
+            if position < end:
+                # A trailing row is waiting for the next one
+                return
+
+    def drop_head(self, index: int, append_messages) -> bool:
+        # Forget the rows before rows[index] after they fell out of the context window,
+        # False when the rest cannot be reused
+        next_start = min((row for row in self.turn_starts if row >= index), default=len(self.rows))
+        head = MessageList(self.provider)
+        if next_start > index:
+            # The history starts inside a turn whose first rows were merged with the ones dropped, build that turn again
+            head.append(self.rows[index:next_start], append_messages)
+            if len(head.rows) < next_start - index:
+                return False
+        message_index = self.turn_starts.get(next_start, len(self.messages))
+        head.turn_starts.update({row - index: message - message_index + len(head.messages) for row, message in self.turn_starts.items() if row >= next_start})
+        self.rows = self.rows[index:]
+        self.messages = head.messages + self.messages[message_index:]
+        self.turn_starts = head.turn_starts
+        return True
+
+# (chat_id, provider) -> MessageList, a hedged request builds the fallback's list next to the primary's
+message_list_cache = LRUCache(maxsize=MESSAGE_LIST_CACHE_SIZE)
+
+@contextmanager
+def cached_message_lists(chat_id: int):
+    # Message lists built inside are cached per provider for the chat and extended on its next turn
+    token = current_chat_id.set(chat_id)
+    try:
+        yield
+    finally:
+        current_chat_id.reset(token)
+
+def is_turn_start(rows: list, index: int) -> bool:
+    # A user row after a row of another role, no provider merges it into the message before
+    return rows[index][2] == 'user' and rows[index - 1][2] != 'user'
+
+def is_prefix(rows: list, chat_history: list) -> bool:
+    # Cached rows share their strings with the history cache, so this mostly compares pointers
+    return len(rows) <= len(chat_history) and all(a == b for a, b in zip(rows, chat_history))
+
+def build_message_list(provider: str, chat_history: list, append_messages) -> list:
+    """
+    Build a provider's message list, reusing what was built for the chat on earlier turns.
+
+    append_messages(messages, rows) appends the messages for rows and returns how many rows
+    it turned into messages, a trailing row waiting for the next one is picked up again on the
+    next turn. Only rows that are new since the cached list are passed to it.
+
+    When old turns fall out of the context window the history starts at a later row of the
+    cached rows, the messages before it are dropped and the rest is reused. Only a turn the
+    cut lands inside of is built again, its first rows may share a message with dropped ones. Each
+    provider has its own cached list for the chat, so a hedged request does not evict the primary's.
+    A cached list is rebuilt when the history no longer extends its rows, e.g. after compaction or when an old image is dropped from the
+    middle of the window once it holds more than MAX_CONTEXT_IMAGES. Hits, slides and
+    rebuilds are counted in the message_list_* metrics.
+
+    A leading system row is built fresh every time, it can depend on the date.
+
+    Parameters:
+    - provider: name of the message format
+    - chat_history: list of (type, message, role) rows in chat order
+    - append_messages: the provider's per-row builder
+
+    Returns:
+    - list of messages in the provider's format
+    """
+    system_messages = []
+    if chat_history and chat_history[0][2] == 'system':
+        append_messages(system_messages, chat_history[:1])
+        chat_history = chat_history[1:]
+
+    chat_id = current_chat_id.get()
+    entry = message_list_cache.get((chat_id, provider)) if chat_id is not None else None
+    head = find_head(entry, chat_history) if entry is not None else None
+    if head:
+        if entry.drop_head(head, append_messages):
+            increment(f"message_list_slides.{provider}")
+        else:
+            head = None
+    elif head == 0:
+        increment(f"message_list_hits.{provider}")
+    if head is None:
+        if chat_id is not None:
+            increment(f"message_list_rebuilds.{provider}")
+        entry = MessageList(provider)
+    entry.append(chat_history[len(entry.rows):], append_messages)
+    if chat_id is not None:
+        message_list_cache[(chat_id, provider)] = entry
+    return system_messages + entry.messages
+
+def find_head(entry: MessageList, chat_history: list):
+    # Index of the cached row the history starts at, None when the history does not extend the cached rows
+    if not chat_history:
+        return None if entry.rows else 0
+    first_row = chat_history[0]
+    for index, row in enumerate(entry.rows):
+        if row == first_row and is_prefix(entry.rows[index:], chat_history):
+            return index
+    return None
+
+def invalidate_message_list(chat_id: int) -> None:
+    for key in [key for key in message_list_cache if key[0] == chat_id]:
+        message_list_cache.pop(key, None)
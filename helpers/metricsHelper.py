@@ -0,0 +1,30 @@
+from collections import defaultdict
+
+# name -> running total
+counters = defaultdict(float)
+# name -> [count, total, max] of observed values
+observations = defaultdict(lambda: [0, 0.0, 0.0])
+# name -> latest value
+gauges = {}
+
+def increment(name: str, value: float = 1) -> None:
+    counters[name] += value
+
+def observe(name: str, value: float) -> None:
+    stats = observations[name]
+    stats[0] += 1
+    stats[1] += value
+    stats[2] = max(stats[2], value)
+
+def set_gauge(name: str, value: float) -> None:
+    gauges[name] = value
+
+def snapshot() -> dict:
+    return {
+        "counters": dict(counters),
+        "observations": {
+            name: {"count": count, "avg": total / count if count else 0, "max": maximum}
+            for name, (count, total, maximum) in observations.items()
+        },
+        "gauges": dict(gauges),
+    }
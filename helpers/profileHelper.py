@@ -0,0 +1,103 @@
+import sys
+import time
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+
+# Number of modules listed in the startup report
+PROFILE_TOP_MODULES = 30
+
+profiling = False
+started_at = None
+# module -> (inclusive seconds, seconds spent in the module itself)
+import_times = {}
+# (step, seconds) in the order the steps ran
+init_times = []
+# Time spent in nested imports, one entry per module currently executing
+import_stack = []
+
+class ImportTimer(MetaPathFinder):
+    """
+    Times how long each module takes to execute on import.
+
+    It asks the other finders for the module spec and wraps the loader's exec_module,
+    so nested imports are measured too and charged to the module that caused them.
+    """
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        loader = spec.loader
+        # Builtin and frozen modules are loaded by a class shared by every module, leave them alone
+        if loader is None or isinstance(loader, type) or not hasattr(loader, 'exec_module'):
+            return spec
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module):
+            import_stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = import_stack.pop()
+                if import_stack:
+                    import_stack[-1] += elapsed
+                import_times[fullname] = (elapsed, elapsed - nested)
+
+        try:
+            loader.exec_module = timed_exec_module
+        except AttributeError:
+            pass
+        return spec
+
+def start_startup_profiling() -> None:
+    # Must run before the bot's own imports for them to be measured
+    global profiling, started_at
+    if profiling:
+        return
+    profiling = True
+    started_at = time.perf_counter()
+    sys.meta_path.insert(0, ImportTimer())
+
+@contextmanager
+def profile_step(name: str):
+    if not profiling:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        init_times.append((name, time.perf_counter() - start))
+
+def startup_report() -> str:
+    total = time.perf_counter() - started_at
+    imports_total = sum(own for _, own in import_times.values())
+    lines = [
+        f"Startup took {total * 1000:.0f} ms, {imports_total * 1000:.0f} ms of it importing {len(import_times)} modules",
+        "",
+        "Slowest imports (self / cumulative ms):",
+    ]
+    slowest = sorted(import_times.items(), key=lambda item: item[1][1], reverse=True)[:PROFILE_TOP_MODULES]
+    for module, (cumulative, own) in slowest:
+        lines.append(f"  {own * 1000:8.1f} {cumulative * 1000:8.1f}  {module}")
+    lines.append("")
+    lines.append("Init steps (ms):")
+    for name, elapsed in init_times:
+        lines.append(f"  {elapsed * 1000:8.1f}  {name}")
+    return "\n".join(lines)
+
+def stop_startup_profiling() -> None:
+    # Print the report once the bot is ready and stop timing imports made afterwards
+    global profiling
+    if not profiling:
+        return
+    profiling = False
+    sys.meta_path[:] = [finder for finder in sys.meta_path if not isinstance(finder, ImportTimer)]
+    print(startup_report())
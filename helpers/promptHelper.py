@@ -0,0 +1,14 @@
+import os
+from functools import lru_cache
+
+# Initialise path to the prompts
+PROMPT_DIR = os.getenv('PROMPT_DIR')
+SYSTEM_PROMPT_FILE = 'system_prompt.txt'
+
+def get_prompt_path(prompt_file: str) -> str:
+    return os.path.join(PROMPT_DIR, prompt_file)
+
+@lru_cache(maxsize=None)
+def get_default_system_prompt() -> str:
+    # Read on first use instead of at import, then kept for the life of the process
+    return open(get_prompt_path(SYSTEM_PROMPT_FILE), 'r').read()
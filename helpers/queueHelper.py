@@ -0,0 +1,189 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from helpers.metricsHelper import observe, set_gauge
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def parse_limits(value: str, cast=int) -> dict:
+    # "openai=8,ollama=2" -> {"openai": 8, "ollama": 2}
+    limits = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        name, limit = item.rsplit('=', 1)
+        limits[name.strip()] = cast(limit)
+    return limits
+
+# Requests allowed in flight per provider and per model, missing or 0 means unlimited
+PROVIDER_CONCURRENCY = parse_limits(os.getenv('PROVIDER_CONCURRENCY', ''))
+MODEL_CONCURRENCY = parse_limits(os.getenv('MODEL_CONCURRENCY', ''))
+# Seconds between two updates of a queued user's position
+QUEUE_POSITION_INTERVAL = float(os.getenv('QUEUE_POSITION_INTERVAL', 2))
+
+class Waiter:
+    def __init__(self, user_id, model: str):
+        self.user_id = user_id
+        self.model = model
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+class FairScheduler:
+    """
+    Concurrency limit of one provider with round-robin queueing across users.
+
+    Every user has their own queue and free slots are handed out one user at a time,
+    so a user sending many messages cannot starve the others. A request also needs a
+    free slot for its model, waiters whose model is full are skipped until it frees up.
+    """
+
+    def __init__(self, name: str, limit: int, model_limits: dict):
+        self.name = name
+        self.limit = limit
+        self.model_limits = model_limits
+        self.active = 0
+        self.active_models = Counter()
+        # user_id -> waiters of that user, in the order users get their next turn
+        self.queues = OrderedDict()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def can_run(self, model: str) -> bool:
+        if self.limit and self.active >= self.limit:
+            return False
+        model_limit = self.model_limits.get(model)
+        return not model_limit or self.active_models[model] < model_limit
+
+    def start(self, model: str) -> None:
+        self.active += 1
+        self.active_models[model] += 1
+
+    def release(self, model: str) -> None:
+        self.active -= 1
+        self.active_models[model] -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        # Hand free slots to the first waiting user whose next request can run, then move them to the back
+        granted = True
+        while granted:
+            granted = False
+            for user_id, queue in self.queues.items():
+                waiter = queue[0]
+                if not self.can_run(waiter.model):
+                    continue
+                queue.popleft()
+                if queue:
+                    self.queues.move_to_end(user_id)
+                else:
+                    del self.queues[user_id]
+                self.start(waiter.model)
+                waiter.future.set_result(None)
+                granted = True
+                break
+        set_gauge(f"queue_depth.{self.name}", self.depth)
+
+    def position(self, waiter: Waiter) -> int:
+        # Position in the round-robin order the queued requests will be served in
+        queues = [list(queue) for queue in self.queues.values()]
+        position = 0
+        for turn in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if turn < len(queue):
+                    position += 1
+                    if queue[turn] is waiter:
+                        return position
+        return 0
+
+    def remove(self, waiter: Waiter) -> None:
+        queue = self.queues.get(waiter.user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.user_id]
+        set_gauge(f"queue_depth.{self.name}", self.depth)
+
+    def try_acquire(self, model: str) -> bool:
+        # Take a slot only if one is free and nobody is waiting, never jumping the queue
+        if self.queues or not self.can_run(model):
+            return False
+        self.start(model)
+        return True
+
+    async def acquire(self, user_id, model: str, on_position=None) -> None:
+        if not self.queues and self.can_run(model):
+            self.start(model)
+            observe(f"queue_wait_seconds.{self.name}", 0)
+            return
+        waiter = Waiter(user_id, model)
+        self.queues.setdefault(user_id, deque()).append(waiter)
+        # Others may only be waiting on a full model, this one can run straight away if its model has room
+        self.dispatch()
+        last_position = None
+        try:
+            while not waiter.future.done():
+                position = self.position(waiter)
+                if on_position is not None and position and position != last_position:
+                    last_position = position
+                    try:
+                        await on_position(position)
+                    except Exception as e:
+                        logger.warning(f"Could not show queue position: {e!r}")
+                await asyncio.wait({waiter.future}, timeout=QUEUE_POSITION_INTERVAL)
+        except asyncio.CancelledError:
+            # Give the slot back if it was granted while the caller was being cancelled
+            if waiter.future.done():
+                self.release(model)
+            else:
+                self.remove(waiter)
+            raise
+        observe(f"queue_wait_seconds.{self.name}", time.monotonic() - waiter.enqueued_at)
+
+# provider -> scheduler, created on first use
+schedulers = {}
+
+def get_scheduler(provider: str) -> FairScheduler:
+    if provider not in schedulers:
+        schedulers[provider] = FairScheduler(provider, PROVIDER_CONCURRENCY.get(provider, 0), MODEL_CONCURRENCY)
+    return schedulers[provider]
+
+class Slot:
+    """A granted slot of a provider and model, released once however often release is called."""
+
+    def __init__(self, scheduler: FairScheduler, model: str):
+        self.scheduler = scheduler
+        self.model = model
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.scheduler.release(self.model)
+
+def try_provider_slot(provider: str, model: str):
+    # A free slot of provider and model, or None when the request would have to queue
+    scheduler = get_scheduler(provider)
+    return Slot(scheduler, model) if scheduler.try_acquire(model) else None
+
+@asynccontextmanager
+async def provider_slot(provider: str, model: str, user_id, on_position=None):
+    """
+    Wait for a free slot of provider and model, in fair order across users.
+
+    on_position is awaited with the 1-based queue position whenever it changes
+    while the request is waiting. The Slot is yielded so it can be given back early.
+    """
+    scheduler = get_scheduler(provider)
+    await scheduler.acquire(user_id, model, on_position)
+    slot = Slot(scheduler, model)
+    try:
+        yield slot
+    finally:
+        slot.release()
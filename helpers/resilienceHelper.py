@@ -0,0 +1,230 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from helpers.metricsHelper import increment
+from helpers.queueHelper import parse_limits
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds a single provider call may take, per provider with a default for the rest
+PROVIDER_TIMEOUTS = parse_limits(os.getenv('PROVIDER_TIMEOUT', ''), float)
+DEFAULT_PROVIDER_TIMEOUT = float(os.getenv('DEFAULT_PROVIDER_TIMEOUT', 120))
+# Seconds a streamed reply may go without a new chunk once it has started
+STREAM_IDLE_TIMEOUT = float(os.getenv('STREAM_IDLE_TIMEOUT', 60))
+# Seconds a user's message may take until its reply starts, across every retry
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', 180))
+# Attempts per provider call and the exponential backoff between them
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 20))
+
+# Consecutive failed calls that open a provider's circuit, and seconds before it is tried again
+PROVIDER_FAILURE_THRESHOLD = int(os.getenv('PROVIDER_FAILURE_THRESHOLD', 5))
+PROVIDER_RESET_TIMEOUT = float(os.getenv('PROVIDER_RESET_TIMEOUT', 60))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Monotonic time by which the current user request must be answered
+current_deadline = ContextVar('current_deadline', default=None)
+
+class ProviderError(Exception):
+    """A provider answered with an HTTP error status."""
+
+    def __init__(self, message: str, status_code: int = None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency that keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and every call is
+    rejected for reset_timeout seconds. Then a single trial call is let through:
+    success closes the circuit again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self) -> None:
+        # A call that was cancelled says nothing about the dependency, let another trial through
+        self.trial_running = False
+
+@contextmanager
+def request_deadline(seconds: float = REQUEST_DEADLINE):
+    # Every provider call made inside shares this budget, nested deadlines can only shorten it
+    deadline = time.monotonic() + seconds
+    outer = current_deadline.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+    token = current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+def remaining_time() -> float:
+    deadline = current_deadline.get()
+    if deadline is None:
+        return float('inf')
+    return deadline - time.monotonic()
+
+class StreamProgress:
+    """
+    Tracks whether a streamed reply has started and when its last chunk arrived.
+
+    Once a stream has started, its timeout restarts with every chunk, so a long reply
+    that keeps arriving is never cut off by the timeout or the request's deadline.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.last_chunk_at = None
+
+    def touch(self) -> None:
+        self.started = True
+        self.last_chunk_at = time.monotonic()
+
+async def wait_with_progress(awaitable, timeout: float, progress: StreamProgress):
+    # Like asyncio.wait_for, but only until the first chunk, then at most STREAM_IDLE_TIMEOUT between chunks
+    task = asyncio.ensure_future(awaitable)
+    expires_at = time.monotonic() + timeout
+    try:
+        while True:
+            if progress.started:
+                expires_at = progress.last_chunk_at + STREAM_IDLE_TIMEOUT
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError("Stream stopped sending chunks" if progress.started else "Stream did not start in time")
+            done, _ = await asyncio.wait({task}, timeout=remaining)
+            if done:
+                return task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+def get_status_code(error: Exception):
+    for attribute in ('status_code', 'status', 'code'):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+def get_retry_after(error: Exception):
+    # Seconds the provider asked us to wait, from Retry-After or retry-after-ms
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def is_timeout(error: Exception) -> bool:
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError)) or 'Timeout' in type(error).__name__
+
+def is_retryable(error: Exception) -> bool:
+    if is_timeout(error) or 'Connection' in type(error).__name__:
+        return True
+    return get_status_code(error) in RETRYABLE_STATUS_CODES
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        return retry_after
+    # Full jitter keeps retries of many users from arriving at the same moment
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+async def call_with_retries(provider: str, call, can_retry=lambda: True, progress: StreamProgress = None):
+    """
+    Await call() with the provider's timeout, retrying retryable failures.
+
+    For a stream, progress is touched by every chunk, the timeout and deadline then only
+    bound the time to the first chunk and the gaps between chunks, not the whole reply.
+
+    Timeouts, connection errors and 408/409/429/5xx answers are retried with jittered
+    exponential backoff or after the provider's Retry-After, as long as can_retry()
+    allows it and the request's deadline leaves room for another attempt.
+    """
+    attempt = 0
+    while True:
+        timeout = min(PROVIDER_TIMEOUTS.get(provider, DEFAULT_PROVIDER_TIMEOUT), remaining_time())
+        if timeout <= 0:
+            increment(f"provider_deadline_exceeded.{provider}")
+            raise asyncio.TimeoutError(f"Deadline exceeded before calling {provider}")
+        try:
+            if progress is None:
+                return await asyncio.wait_for(call(), timeout)
+            return await wait_with_progress(call(), timeout, progress)
+        except Exception as e:
+            if is_timeout(e):
+                increment(f"provider_timeouts.{provider}")
+            attempt += 1
+            if not is_retryable(e) or attempt >= RETRY_ATTEMPTS or not can_retry():
+                increment(f"provider_failures.{provider}")
+                raise
+            delay = backoff_delay(attempt - 1, e)
+            if delay >= remaining_time():
+                increment(f"provider_failures.{provider}")
+                raise
+            logger.warning(f"Retrying {provider} in {delay:.1f}s after attempt {attempt} failed: {e!r}")
+            increment(f"provider_retries.{provider}")
+            await asyncio.sleep(delay)
+
+def describe_error(provider: str, error: Exception) -> str:
+    # Short explanation shown to the user instead of a traceback
+    name = provider.title()
+    if is_timeout(error):
+        return f"Sorry, {name} took too long to answer. Please try again."
+    if get_status_code(error) == 429:
+        return f"Sorry, {name} is receiving too many requests right now. Please try again in a moment."
+    return f"Sorry, {name} ran into a problem answering. Please try again."
@@ -0,0 +1,55 @@
+import os
+import asyncio
+from typing import Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates processed at the same time across all users
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 256))
+
+def get_update_key(update: object):
+    # Updates of one user are serialized, updates without a user fall back to their chat
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return ('user', update.effective_user.id)
+        if update.effective_chat is not None:
+            return ('chat', update.effective_chat.id)
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently and those of one user in order.
+
+    Each user gets a lock that is held while their update is handled, so their
+    conversation state and current chat never see interleaved handlers. The lock is
+    taken in do_process_update, after BaseUpdateProcessor gave the update one of the
+    max_concurrent_updates slots, so process_update stays as the base class defines it.
+    An update waiting on the same user's previous one holds its slot while it waits,
+    a user who sends many messages at once takes slots from others until theirs are handled.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        # key -> [lock, number of updates using it]
+        self.locks = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = get_update_key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,5 +1,13 @@
+import sys
+from helpers.profileHelper import start_startup_profiling, stop_startup_profiling, profile_step
+
+# Start timing imports before anything heavy is imported
+if '--profile-startup' in sys.argv:
+    start_startup_profiling()
+
 import logging
 import os
+import asyncio
 import traceback, html, json
 from typing import Final
 from dotenv import load_dotenv
@@ -17,31 +25,41 @@ from telegram.ext import (
 from settings.chatCompletionHandler import (
     settings, 
     settings_menu_handler,
-    kill_connection as settings_kill_connection
     )
-from settings.imageGenHandler import (
-    kill_connection as imageGen_kill_connection
-)
 from chat.chatMenu import (
     start,
     show_chats,
     create_new_chat,
     open_chat,
     show_help,
-    kill_connection as chatMenu_kill_connection
 )
 from chat.chatHandler import (
     get_chat_handlers,
-    kill_connection as chatHandler_kill_connection
 )
-from helpers.userHelper import (
-    kill_connection as user_kill_connection
+from chat.compactionHandler import (
+    compact_chats,
+    COMPACTION_INTERVAL,
+)
+from providers.catalogHandler import (
+    refresh_model_catalog,
+    warm_model_catalog,
+    warm_up_selected_models,
+    check_provider_health,
+    PROVIDER_HEALTH_INTERVAL,
+    MODEL_CATALOG_REFRESH_INTERVAL,
 )
+from providers.providerRegistry import providers
+from helpers.dbHelper import close_databases
+from helpers.contextHelper import load_tokenizer
+from helpers.httpHelper import open_session, close_session
+from helpers.updateHelper import PerUserUpdateProcessor
 from helpers.mainHelper import (
     exit_menu,
     callback,
     admin_add_user,
     admin_reset_user_settings,
+    admin_metrics,
+    load_whitelist,
 )
 
 logging.basicConfig(
@@ -111,10 +129,35 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
                     chat_id=ERROR_CHAT_ID, text=part
                 )
 
+# Open the shared HTTP session and load users once the application and its event loop are running
+async def post_init(application) -> None:
+    await open_session()
+    # Loading the tokenizer may download it, which must not block the event loop
+    with profile_step("load tokenizer"):
+        await asyncio.to_thread(load_tokenizer)
+    with profile_step("load whitelist"):
+        await load_whitelist()
+    # Providers and models in use are loaded in the background so polling starts right away
+    with profile_step("load model catalog"):
+        if '--profile-startup' in sys.argv:
+            await warm_model_catalog()
+        else:
+            application.create_task(warm_model_catalog())
+    application.create_task(warm_up_selected_models())
+    stop_startup_profiling()
+
+# Release long-lived clients and database connections when the application stops
+async def post_shutdown(application) -> None:
+    for provider in providers.values():
+        await provider.close()
+    await close_session()
+    await close_databases()
+
 # Main
 def main() -> None:
     persistence = PicklePersistence(filepath=PICKLE_PATH)
-    application = ApplicationBuilder().token(TOKEN).persistence(persistence).build()
+    # Different users are served in parallel, each user's updates still run one at a time
+    application = ApplicationBuilder().token(TOKEN).persistence(persistence).concurrent_updates(PerUserUpdateProcessor()).post_init(post_init).post_shutdown(post_shutdown).build()
     # application = ApplicationBuilder().token(TOKEN).build()
     callback_handler = TypeHandler(Update, callback)
 
@@ -145,6 +188,7 @@ def main() -> None:
     # Handle adding users by admin
     admin_add_cmd_handler = CommandHandler("admin_add", admin_add_user)
     admin_reset_cmd_handler = CommandHandler("admin_reset", admin_reset_user_settings)
+    admin_metrics_cmd_handler = CommandHandler("admin_metrics", admin_metrics)
 
     # Handle unsupported commands and messages
     # unsupported_cmd_handler = MessageHandler(filters.COMMAND, handle_unsupported_command)
@@ -158,20 +202,25 @@ def main() -> None:
     application.add_handler(settings_handler)
     application.add_handler(admin_add_cmd_handler)
     application.add_handler(admin_reset_cmd_handler)
+    application.add_handler(admin_metrics_cmd_handler)
 
     # Add error handler
     application.add_error_handler(error_handler)
+
+    # Summarize long chats in the background
+    application.job_queue.run_repeating(compact_chats, interval=COMPACTION_INTERVAL, first=COMPACTION_INTERVAL)
+
+    # Keep the model lists of the loaded providers fresh in the background
+    application.job_queue.run_repeating(refresh_model_catalog, interval=MODEL_CATALOG_REFRESH_INTERVAL, first=MODEL_CATALOG_REFRESH_INTERVAL)
+
+    # Eject unhealthy provider backends and bring recovered ones back
+    application.job_queue.run_repeating(check_provider_health, interval=PROVIDER_HEALTH_INTERVAL, first=PROVIDER_HEALTH_INTERVAL)
     
     # Start the bot
     print("Bot polling, will exit on Ctrl+C and continue posting updates if there are warnings or errors")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
     # On Ctrl+C exit
-    chatHandler_kill_connection()
-    chatMenu_kill_connection()
-    settings_kill_connection()
-    imageGen_kill_connection()
-    user_kill_connection()
     print("Bot polling closed. Exiting...")
 
 
@@ -0,0 +1,91 @@
+import os
+import time
+import asyncio
+import logging
+from telegram.ext import ContextTypes
+
+from providers.providerRegistry import PROVIDER_MODULES, load_provider, is_provider_loaded
+from helpers.dbHelper import users_db
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds between two refreshes of the model lists
+MODEL_CATALOG_REFRESH_INTERVAL = int(os.getenv('MODEL_CATALOG_REFRESH_INTERVAL', 900))
+# Seconds a provider gets to return its model list before the last good list is kept
+MODEL_CATALOG_TIMEOUT = float(os.getenv('MODEL_CATALOG_TIMEOUT', 10))
+# Seconds before a provider whose model list could not be loaded is asked again when its menu opens
+MODEL_CATALOG_RETRY_INTERVAL = float(os.getenv('MODEL_CATALOG_RETRY_INTERVAL', 60))
+
+# Seconds between two background health checks of the providers that support them
+PROVIDER_HEALTH_INTERVAL = int(os.getenv('PROVIDER_HEALTH_INTERVAL', 15))
+
+# provider -> last list of models that loaded successfully
+model_catalog = {provider: [] for provider in PROVIDER_MODULES}
+# provider -> refresh started from a menu that is still running
+refresh_tasks = {}
+# provider -> monotonic time before which a failed refresh is not started again from a menu
+retry_after = {}
+
+async def load_models(provider: str) -> list:
+    return await (await load_provider(provider)).list_models()
+
+async def refresh_provider_models(provider: str) -> None:
+    try:
+        models = await asyncio.wait_for(load_models(provider), timeout=MODEL_CATALOG_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Could not refresh {provider} models, keeping the last list: {e!r}")
+        retry_after[provider] = time.monotonic() + MODEL_CATALOG_RETRY_INTERVAL
+        return
+    if models:
+        model_catalog[provider] = models
+        retry_after.pop(provider, None)
+    else:
+        retry_after[provider] = time.monotonic() + MODEL_CATALOG_RETRY_INTERVAL
+
+async def refresh_model_catalog(context: ContextTypes.DEFAULT_TYPE = None) -> None:
+    # Only providers someone has used are refreshed, the others are loaded when first selected
+    providers = [provider for provider in PROVIDER_MODULES if is_provider_loaded(provider)]
+    # Every provider is queried in parallel so one slow provider does not hold up the rest
+    await asyncio.gather(*(refresh_provider_models(provider) for provider in providers))
+
+async def warm_model_catalog() -> None:
+    # Load the providers users currently have selected so their menus are ready
+    rows = await users_db.fetchall("SELECT DISTINCT provider FROM user_preferences")
+    providers = [row[0] for row in rows if row[0] in PROVIDER_MODULES]
+    await asyncio.gather(*(refresh_provider_models(provider) for provider in providers))
+
+async def check_provider_health(context: ContextTypes.DEFAULT_TYPE = None) -> None:
+    # Providers with several backends (Ollama) eject unhealthy ones here
+    for provider in PROVIDER_MODULES:
+        if not is_provider_loaded(provider):
+            continue
+        chat_provider = await load_provider(provider)
+        if hasattr(chat_provider, 'check_health'):
+            try:
+                await chat_provider.check_health()
+            except Exception as e:
+                logger.warning(f"Health check of {provider} failed: {e!r}")
+
+async def warm_up_model(provider: str, model: str) -> None:
+    # Providers that load models on demand (Ollama) preload them so the first message is fast
+    chat_provider = await load_provider(provider)
+    if hasattr(chat_provider, 'warm_up'):
+        await chat_provider.warm_up(model)
+
+async def warm_up_selected_models() -> None:
+    rows = await users_db.fetchall("SELECT DISTINCT provider, model FROM user_preferences")
+    await asyncio.gather(*(warm_up_model(provider, model) for provider, model in rows if provider in PROVIDER_MODULES))
+
+def ensure_models(provider: str) -> list:
+    # Used when a provider is selected: the menu is served from memory straight away, a missing
+    # list is loaded in the background unless loading it failed shortly before
+    if not model_catalog.get(provider) and provider not in refresh_tasks and time.monotonic() >= retry_after.get(provider, 0):
+        task = asyncio.ensure_future(refresh_provider_models(provider))
+        refresh_tasks[provider] = task
+        task.add_done_callback(lambda _: refresh_tasks.pop(provider, None))
+    return get_models(provider)
+
+def get_models(provider: str) -> list:
+    return model_catalog.get(provider, [])
@@ -1,9 +1,12 @@
 import os
-import re
 import logging
 from typing import Final
 from anthropic import AsyncAnthropic
 from helpers.dateHelper import get_current_date, get_current_weekday
+from helpers.contextHelper import count_history_tokens
+from helpers.htmlHelper import sanitize_html
+from helpers.messageListHelper import build_message_list
+from providers.providerRegistry import register_provider, ProviderResponse
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -20,75 +23,102 @@ ANTHROPIC_MODELS: Final = [
 # Set up Claude API credentials
 CLAUDE_API_KEY = os.getenv('CLAUDE_API_KEY')
 
-# Create an instance of the Anthropic API
-anthropic = AsyncAnthropic(api_key=CLAUDE_API_KEY)
+# Create an instance of the Anthropic API, retries are handled by the provider registry
+anthropic = AsyncAnthropic(api_key=CLAUDE_API_KEY, max_retries=0)
+
+# Cache the system prompt and the conversation so far between turns
+CLAUDE_PROMPT_CACHING = os.getenv('CLAUDE_PROMPT_CACHING', 'true').lower() in ('1', 'true', 'yes')
+PROMPT_CACHING_BETA: Final = "prompt-caching-2024-07-31"
 
 def build_message_list_claude(chat_history) -> list:
-    # Claude enforces that assistant must alternate with user
-    messages = []
-    prev_message_type = ""
-    image = None
-    for message_type, message, role in chat_history:
+    return build_message_list("claude", chat_history, append_messages_claude)
+
+def append_messages_claude(messages, rows) -> int:
+    # Claude enforces that assistant must alternate with user, so consecutive rows of one role
+    # (a photo and its caption, or the messages around a failed reply) become one message with several blocks
+    for message_type, message, role in rows:
         if role == 'system':
             continue
-        if len(messages) > 0 and messages[-1].get('role') == 'user' and role == 'user':
-            messages.append( {
-            "role": "assistant",
-            "content": [
-                {"type": "text", "text": "Ignore this message"}
-                ]
-            })
-        elif len(messages) > 0 and messages[-1].get('role') == 'assistant' and role == 'assistant':
-            messages.append( {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": "Ignore this message"}
-                ]
-            })
-        if prev_message_type == "image_url":
-            messages.append({
-            "role": role,
-            "content": [
-                {"type": "image", "source": {
-                    "type": "base64",
-                    "media_type": "image/jpeg",
-                    "data": image,
-                    }
-                },
-                {"type": "text", "text": message}
-                ]
-            })
-            prev_message_type = ""
-            image = None
-            continue
         if message_type == 'text':
+            if not message:
+                continue
+            block = {"type": "text", "text": message}
+        elif message_type == 'image_url':
+            block = {"type": "image", "source": {
+                "type": "base64",
+                "media_type": "image/jpeg",
+                "data": message,
+                }
+            }
+        else:
+            continue
+        if messages and messages[-1]['role'] == role:
+            # Replaced rather than changed, the cached message list may already have been handed out
+            messages[-1] = {**messages[-1], "content": messages[-1]["content"] + [block]}
+        else:
             messages.append({
-            "role": role, 
-            "content": [
-                {"type": message_type, f"{message_type}": message}
-                ]
+            "role": role,
+            "content": [block]
             })
-        elif message_type == 'image_url':
-            prev_message_type = message_type
-            image = message
-    
-    return messages
+    return len(rows)
+
+def build_system_claude(system):
+    # The date changes every day, so it goes in a last uncached block and the prompt before it stays cacheable
+    if not system:
+        return system
+    blocks = []
+    stable = system.replace('{{DATE}}', "today's date (given at the end)").replace('{{DAY}}', "today's weekday (given at the end)")
+    blocks.append({"type": "text", "text": stable, "cache_control": {"type": "ephemeral"}})
+    if stable != system:
+        blocks.append({"type": "text", "text": f"Today is {get_current_weekday()}, {get_current_date()}."})
+    return blocks
+
+def add_cache_breakpoint_claude(messages) -> list:
+    # Everything up to the newest turn is sent unchanged next turn, so it is cached here and read back then.
+    # The message lists are cached per chat, so the last message is copied instead of changed
+    if not messages:
+        return messages
+    last = messages[-1]
+    content = [dict(block) for block in last["content"]]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return messages[:-1] + [{**last, "content": content}]
+
+def build_request_claude(messages, system) -> dict:
+    if not CLAUDE_PROMPT_CACHING:
+        system = system.replace('{{DATE}}', get_current_date()).replace('{{DAY}}', get_current_weekday())
+        return {"system": system, "messages": messages}
+    return {
+        "system": build_system_claude(system),
+        "messages": add_cache_breakpoint_claude(messages),
+        "extra_headers": {"anthropic-beta": PROMPT_CACHING_BETA},
+    }
 
 # function to interact with Claude
 async def chat_with_claude(messages, model='claude-3-haiku-20240307', temperature=0.5, max_tokens=100, system="") -> str:
-    system = system.replace('{{DATE}}', get_current_date()).replace('{{DAY}}', get_current_weekday())
     response = await anthropic.messages.create(
         model=model,
         max_tokens=max_tokens,
         temperature=temperature,
-        system=system,
-        messages=messages
+        **build_request_claude(messages, system)
     )
     if response.type == 'error':
         print("Error: " + response.error)
         return None
     return process_response_from_claude(response)
 
+# Stream a reply from Claude, passing each text delta to on_delta as it arrives
+async def stream_with_claude(messages, on_delta, model='claude-3-haiku-20240307', temperature=0.5, max_tokens=100, system="") -> tuple:
+    async with anthropic.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        **build_request_claude(messages, system)
+    ) as stream:
+        async for text in stream.text_stream:
+            await on_delta(text)
+        response = await stream.get_final_message()
+    return process_response_from_claude(response)
+
 def get_available_claude_models() -> list:
     return ANTHROPIC_MODELS
 
@@ -97,8 +127,27 @@ def process_response_from_claude(response) -> tuple:
     output_tokens = response.usage.output_tokens
     role = response.role
     message = response.content[0].text
-    # To manage the case where GPT still outputs unwanted tags that 
-    # may cause telegram to fail to format the message properly
-    message = re.sub(r'<(a|article|p|br|li|sup|sub|abbr|small|ul|/a|/article|/p|/li|/sup|/sub|/abbr|/small|/ul)>', '', message)
-    message = message.replace('<h1>', '<b><u>').replace('</h1>', '</u></b>').replace('<h2>', '<b>').replace('</h2>', '</b>').replace('<h3>', '<u>').replace('</h3>', '</u>').replace('<h4>', '<i>').replace('</h4>', '</i>').replace('<h5>', '').replace('</h5>', '').replace('<h6>', '').replace('</h6>', '').replace('<big>', '<b>').replace('</big>', '</b>')
-    return input_tokens, output_tokens, role, message
\ No newline at end of file
+    message = sanitize_html(message)
+    # Only reported while the prompt caching beta is enabled
+    cache_read_tokens = getattr(response.usage, 'cache_read_input_tokens', None) or 0
+    cache_write_tokens = getattr(response.usage, 'cache_creation_input_tokens', None) or 0
+    return input_tokens, output_tokens, role, message, cache_read_tokens, cache_write_tokens
+
+@register_provider("claude")
+class ClaudeProvider:
+    async def complete(self, chat_history, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_claude(chat_history)
+        return ProviderResponse(*await chat_with_claude(messages, model=model, temperature=temperature, max_tokens=max_tokens, system=system))
+
+    async def stream(self, chat_history, on_delta, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_claude(chat_history)
+        return ProviderResponse(*await stream_with_claude(messages, on_delta, model=model, temperature=temperature, max_tokens=max_tokens, system=system))
+
+    async def count_tokens(self, chat_history, model):
+        return count_history_tokens(chat_history)
+
+    async def list_models(self):
+        return get_available_claude_models()
+
+    async def close(self):
+        await anthropic.close()
@@ -0,0 +1,51 @@
+import os
+import asyncio
+from typing import Final
+from helpers.contextHelper import count_history_tokens, count_tokens
+from providers.providerRegistry import register_provider, ProviderResponse
+
+FAKE_MODELS: Final = [
+    'fake-echo',
+]
+
+# Seconds the fake provider waits before answering and between two streamed words
+FAKE_PROVIDER_LATENCY = float(os.getenv('FAKE_PROVIDER_LATENCY', 0))
+
+def build_reply_fake(chat_history) -> str:
+    # Echo the newest user text so replies are predictable
+    for message_type, message, role in reversed(chat_history):
+        if role == 'user' and message_type == 'text':
+            return f"Echo: {message}"
+    return "Echo:"
+
+@register_provider("fake")
+class FakeProvider:
+    """
+    In-process provider that never touches the network.
+
+    Select it by setting a user's provider to "fake" to exercise the chat pipeline
+    in tests and benchmarks without API keys or provider latency.
+    """
+
+    async def complete(self, chat_history, model, temperature, max_tokens, n=1, system=""):
+        await asyncio.sleep(FAKE_PROVIDER_LATENCY)
+        message = build_reply_fake(chat_history)
+        return ProviderResponse(count_history_tokens(chat_history), count_tokens('text', message), "assistant", message)
+
+    async def stream(self, chat_history, on_delta, model, temperature, max_tokens, n=1, system=""):
+        await asyncio.sleep(FAKE_PROVIDER_LATENCY)
+        message = build_reply_fake(chat_history)
+        words = message.split(' ')
+        for i, word in enumerate(words):
+            await on_delta(word if i == 0 else f" {word}")
+            await asyncio.sleep(FAKE_PROVIDER_LATENCY)
+        return ProviderResponse(count_history_tokens(chat_history), count_tokens('text', message), "assistant", message)
+
+    async def count_tokens(self, chat_history, model):
+        return count_history_tokens(chat_history)
+
+    async def list_models(self):
+        return FAKE_MODELS
+
+    async def close(self):
+        pass
@@ -1,9 +1,12 @@
 import os
-import re
 import logging
-import requests
 from google.generativeai.types import HarmBlockThreshold, HarmCategory
 import google.generativeai as gemini
+from helpers.contextHelper import count_history_tokens
+from helpers.httpHelper import get_session
+from helpers.htmlHelper import sanitize_html
+from helpers.messageListHelper import build_message_list
+from providers.providerRegistry import register_provider, ProviderResponse
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -15,13 +18,14 @@ GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 # Create an instance of the Gemini API
 gemini.configure(api_key=GEMINI_API_KEY)
 
-def build_message_list_gemini(chat_history, user_message) -> list:
-    messages = []
-    length_of_history = len(chat_history)
-    for i in range(length_of_history):
-        if i == 0 or i == length_of_history:
+def build_message_list_gemini(chat_history) -> list:
+    return build_message_list("google", chat_history, append_messages_gemini)
+
+def append_messages_gemini(messages, rows) -> int:
+    # The system prompt is passed to the model separately
+    for message_type, message, role in rows:
+        if role == 'system':
             continue
-        message_type, message, role = chat_history[i]
         if role == 'assistant':
             role = "model"
         if message_type == 'text':
@@ -38,16 +42,9 @@ def build_message_list_gemini(chat_history, user_message) -> list:
                 f"Image was skipped due to technical limitation", 
                 ]
             })
-    messages.append({
-    "role": "user", 
-    "parts": [
-        f"{user_message}", 
-        ]
-    })
-    return messages
+    return len(rows)
 
-# function to interact with Gemini
-async def chat_with_gemini(model='gemini-1.5-flash', temperature=0.5, max_tokens=100, message_history=[], system="") -> str:
+def build_model_gemini(model, temperature, max_tokens, system):
     generation_config = {
         "temperature": temperature,
         "top_p": 0.95,
@@ -61,22 +58,43 @@ async def chat_with_gemini(model='gemini-1.5-flash', temperature=0.5, max_tokens
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
     }
-    model = gemini.GenerativeModel(
+    return gemini.GenerativeModel(
         model_name=model,
         generation_config=generation_config,
         safety_settings=safety_settings,
         system_instruction=system,
     )
+
+# function to interact with Gemini
+async def chat_with_gemini(model='gemini-1.5-flash', temperature=0.5, max_tokens=100, message_history=[], system="") -> str:
+    model = build_model_gemini(model, temperature, max_tokens, system)
     response = await model.generate_content_async(message_history)
     # chat_session = model.start_chat(history=message_history)
     # response = await chat_session.send_message_async(input_message)
     return process_response_from_gemini(response)
 
-def get_available_gemini_models() -> list:
+# Stream a reply from Gemini, passing each text delta to on_delta as it arrives
+async def stream_with_gemini(on_delta, model='gemini-1.5-flash', temperature=0.5, max_tokens=100, message_history=[], system="") -> tuple:
+    model = build_model_gemini(model, temperature, max_tokens, system)
+    response = await model.generate_content_async(message_history, stream=True)
+    async for chunk in response:
+        # Chunks without text parts (e.g. the final usage chunk) raise on .text
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            await on_delta(text)
+    # Once iterated the response holds the aggregated text and usage
+    return process_response_from_gemini(response)
+
+async def get_available_gemini_models() -> list:
     # REST API version
-    response = requests.get(f"https://generativelanguage.googleapis.com/v1beta/models?key={GEMINI_API_KEY}")
+    async with get_session().get(f"https://generativelanguage.googleapis.com/v1beta/models?key={GEMINI_API_KEY}") as response:
+        response.raise_for_status()
+        data = await response.json()
     available_models = []
-    for model in response.json()['models']:
+    for model in data['models']:
         available_models.append(model['name'].split('/')[-1])
     available_models = sorted([model for model in available_models if 'gemini' and '1.5' in model])
     # for model in response:
@@ -91,13 +109,9 @@ def process_response_from_gemini(response) -> tuple:
     output_tokens = response.usage_metadata.candidates_token_count
     role = "assistant" if response.candidates[0].content.role == "model" else response.candidates[0].content.role
     message = response.text
-    # To manage the case where GPT still outputs unwanted tags that 
-    # may cause telegram to fail to format the message properly
-    message = re.sub(r'<(a|article|p|br|li|sup|sub|abbr|small|ul|/a|/article|/p|/li|/sup|/sub|/abbr|/small|/ul)>', '', message)
-    message = message.replace('<h1>', '<b><u>').replace('</h1>', '</u></b>').replace('<h2>', '<b>').replace('</h2>', '</b>').replace('<h3>', '<u>').replace('</h3>', '</u>').replace('<h4>', '<i>').replace('</h4>', '</i>').replace('<h5>', '').replace('</h5>', '').replace('<h6>', '').replace('</h6>', '').replace('<big>', '<b>').replace('</big>', '</b>')
+    message = sanitize_html(message)
     return input_tokens, output_tokens, role, message
 
-
 def get_available_gemini_models_for_testing() -> list:
     # # Disabled due to serverside issues it is returning nonsense
     response = gemini.list_models()
@@ -116,7 +130,21 @@ def get_available_gemini_models_for_testing() -> list:
     #     available_models.append(model['name'])
     # return available_models
 
-try:
-    print(get_available_gemini_models_for_testing())
-except Exception as e:
-    print(e)
\ No newline at end of file
+@register_provider("google")
+class GeminiProvider:
+    async def complete(self, chat_history, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_gemini(chat_history)
+        return ProviderResponse(*await chat_with_gemini(model=model, temperature=temperature, max_tokens=max_tokens, message_history=messages, system=system))
+
+    async def stream(self, chat_history, on_delta, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_gemini(chat_history)
+        return ProviderResponse(*await stream_with_gemini(on_delta, model=model, temperature=temperature, max_tokens=max_tokens, message_history=messages, system=system))
+
+    async def count_tokens(self, chat_history, model):
+        return count_history_tokens(chat_history)
+
+    async def list_models(self):
+        return await get_available_gemini_models()
+
+    async def close(self):
+        pass
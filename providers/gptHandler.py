@@ -1,12 +1,16 @@
 import os
-import re
 import aiohttp
-import base64
+import httpx
 import logging
 from io import BytesIO
 from PIL import Image
-from openai import OpenAI
+from openai import AsyncOpenAI
 from helpers.dateHelper import get_current_date, get_current_weekday
+from helpers.contextHelper import count_history_tokens
+from helpers.httpHelper import get_session
+from helpers.htmlHelper import sanitize_html
+from helpers.messageListHelper import build_message_list
+from providers.providerRegistry import register_provider, ProviderResponse
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -19,13 +23,37 @@ logger = logging.getLogger(__name__)
 # Set up your OpenAI API credentials
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# Create an instance of the OpenAI API
-openai = OpenAI()
+# Timeouts (in seconds) and connection pool limits for the shared OpenAI client
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 10))
+OPENAI_IMAGE_TIMEOUT = float(os.getenv('OPENAI_IMAGE_TIMEOUT', 120))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', 30))
+
+# Create a single long-lived async instance of the OpenAI API so that every request
+# reuses the same pooled keep-alive connections instead of blocking the event loop
+openai = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    # Retries are handled by the provider registry
+    max_retries=0,
+    timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    http_client=httpx.AsyncClient(
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+    ),
+)
 
 # Message list builder for gpt
 def build_message_list_gpt(chat_history) -> list:
-    messages = []
-    for message_type, message, role in chat_history:
+    return build_message_list("openai", chat_history, append_messages_gpt)
+
+def append_messages_gpt(messages, rows) -> int:
+    for message_type, message, role in rows:
         if role == 'system':
             day = get_current_weekday()
             date = get_current_date()
@@ -48,29 +76,60 @@ def build_message_list_gpt(chat_history) -> list:
                 }}
                 ]
             })
-    return messages
+    return len(rows)
 
 # Define to interact with OpenAI GPT
-async def chat_with_gpt(messages, model='gpt-3.5-turbo', temperature=0.5, max_tokens=100, n=1) -> str:
+async def chat_with_gpt(messages, model='gpt-3.5-turbo', temperature=0.5, max_tokens=100, n=1, timeout=OPENAI_TIMEOUT) -> str:
     # print(messages)
-    response = openai.chat.completions.create(
+    response = await openai.chat.completions.create(
         model=model,  # Specify the GPT-4 engine
         messages=messages,
         max_tokens=max_tokens,  # Set the maximum number of tokens in the response
         temperature=temperature,  # Control the randomness of the response
         n=n,  # Generate a single response
+        timeout=timeout,
     )
     return process_response_from_openai(response)
 
+# Stream a chat completion from OpenAI, passing each text delta to on_delta as it arrives
+async def stream_with_gpt(messages, on_delta, model='gpt-3.5-turbo', temperature=0.5, max_tokens=100, n=1, timeout=OPENAI_TIMEOUT) -> tuple:
+    stream = await openai.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        n=n,
+        timeout=timeout,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    input_tokens, output_tokens, role = 0, 0, "assistant"
+    message = ""
+    async for chunk in stream:
+        if chunk.usage:
+            input_tokens = chunk.usage.prompt_tokens
+            output_tokens = chunk.usage.completion_tokens
+        for choice in chunk.choices:
+            # Only the first choice is shown to the user
+            if choice.index != 0:
+                continue
+            if choice.delta.role:
+                role = choice.delta.role
+            if choice.delta.content:
+                message += choice.delta.content
+                await on_delta(choice.delta.content)
+    return input_tokens, output_tokens, role.strip(), sanitize_html(message.strip())
+
 # function to interact with openai's dalle
-async def image_gen_with_openai(prompt, model='dall-e-3',n=1, size="1024x1024") -> str:
-    response = openai.images.generate(
+async def image_gen_with_openai(prompt, model='dall-e-3',n=1, size="1024x1024", timeout=OPENAI_IMAGE_TIMEOUT) -> bytes:
+    response = await openai.images.generate(
         model=model,
         prompt=prompt,
         n=n,
-        size=size
+        size=size,
+        timeout=timeout,
     )
-    # Download the file and convert to base64
+    # Download the file and convert to jpeg bytes
     image_url = response.data[0].url
     
     # image_url = "https://www.gstatic.com/webp/gallery/1.jpg" # DEBUG PLACEHOLDER URL
@@ -78,25 +137,23 @@ async def image_gen_with_openai(prompt, model='dall-e-3',n=1, size="1024x1024")
     # if response.data:
     if image_url:
         # image_url = response.data[0].url
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url) as resp:
-                if resp.status == 200:
-                    image_data = await resp.read()
-                    image = Image.open(BytesIO(image_data))
-                    buffered = BytesIO()
-                    image.save(buffered, format="jpeg")
-                    img_str = base64.b64encode(buffered.getvalue()).decode()
-                    return img_str
-                else:
-                    print(f"Failed to download image: HTTP {resp.status}")
-                    return None
+        async with get_session().get(image_url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            if resp.status == 200:
+                image_data = await resp.read()
+                image = Image.open(BytesIO(image_data))
+                buffered = BytesIO()
+                image.save(buffered, format="jpeg")
+                return buffered.getvalue()
+            else:
+                print(f"Failed to download image: HTTP {resp.status}")
+                return None
     else:
         print("No image data in the response")
         return None
     
 # Function to get the available models
-def get_available_openai_models() -> list:
-    response = openai.models.list()
+async def get_available_openai_models() -> list:
+    response = await openai.models.list()
     available_models = []
     for model in response.data:
         available_models.append(model.id)
@@ -109,8 +166,32 @@ def process_response_from_openai(response) -> tuple:
     output_tokens = response.usage.completion_tokens
     role = response.choices[0].message.role.strip()
     message = response.choices[0].message.content.strip()
-    # To manage the case where GPT still outputs unwanted tags that 
-    # may cause telegram to fail to format the message properly
-    message = re.sub(r'<(a|article|p|br|li|sup|sub|abbr|small|ul|/a|/article|/p|/li|/sup|/sub|/abbr|/small|/ul)>', '', message)
-    message = message.replace('<h1>', '<b><u>').replace('</h1>', '</u></b>').replace('<h2>', '<b>').replace('</h2>', '</b>').replace('<h3>', '<u>').replace('</h3>', '</u>').replace('<h4>', '<i>').replace('</h4>', '</i>').replace('<h5>', '').replace('</h5>', '').replace('<h6>', '').replace('</h6>', '').replace('<big>', '<b>').replace('</big>', '</b>')
-    return input_tokens, output_tokens, role, message
\ No newline at end of file
+    message = sanitize_html(message)
+    return input_tokens, output_tokens, role, message
+
+async def close_client() -> None:
+    await openai.close()
+    print("OpenAI client closed")
+
+@register_provider("openai")
+class OpenAIProvider:
+    async def complete(self, chat_history, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_gpt(chat_history)
+        return ProviderResponse(*await chat_with_gpt(messages, model=model, temperature=temperature, max_tokens=max_tokens, n=n))
+
+    async def stream(self, chat_history, on_delta, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_gpt(chat_history)
+        return ProviderResponse(*await stream_with_gpt(messages, on_delta, model=model, temperature=temperature, max_tokens=max_tokens, n=n))
+
+    async def count_tokens(self, chat_history, model):
+        return count_history_tokens(chat_history)
+
+    async def list_models(self):
+        return await get_available_openai_models()
+
+    async def generate_image(self, prompt, model, n=1, size="1024x1024"):
+        # Only OpenAI generates images, so this is not part of the Provider contract
+        return await image_gen_with_openai(prompt=prompt, model=model, n=n, size=size)
+
+    async def close(self):
+        await close_client()
@@ -1,21 +1,128 @@
-import re
 import os
+import json
+import time
+import asyncio
 import aiohttp
-import requests
 import logging
+from helpers.httpHelper import get_session
+from helpers.resilienceHelper import CircuitBreaker, ProviderError
+from helpers.contextHelper import count_history_tokens
+from helpers.htmlHelper import sanitize_html
+from helpers.messageListHelper import build_message_list
+from providers.providerRegistry import register_provider, ProviderResponse, ProviderUnavailableError
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Set up url to Ollama API
-OLLAMA_URL = os.getenv('OLLAMA_URL')
+# Set up urls of the Ollama backends, a comma separated list
+OLLAMA_URLS = [url.strip().rstrip('/') for url in os.getenv('OLLAMA_URL', '').split(',') if url.strip()]
+
+# How long Ollama keeps a model loaded after a request, e.g. "10m", "1h" or -1 for forever
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '10m')
+if OLLAMA_KEEP_ALIVE.lstrip('-').isdigit():
+    # Plain numbers are seconds and must be sent as a number
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)
+# Bytes read from a streamed response at a time
+OLLAMA_CHUNK_SIZE = int(os.getenv('OLLAMA_CHUNK_SIZE', 4096))
+
+# Seconds a health check result is reused and allowed to take
+OLLAMA_HEALTH_TTL = float(os.getenv('OLLAMA_HEALTH_TTL', 10))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv('OLLAMA_HEALTH_TIMEOUT', 2))
+# Consecutive failures that open a backend's circuit, and seconds before it is tried again
+OLLAMA_FAILURE_THRESHOLD = int(os.getenv('OLLAMA_FAILURE_THRESHOLD', 3))
+OLLAMA_RESET_TIMEOUT = float(os.getenv('OLLAMA_RESET_TIMEOUT', 30))
+# Extra outstanding requests a backend that already has the model loaded may carry before a less busy one is preferred
+OLLAMA_AFFINITY_SLACK = int(os.getenv('OLLAMA_AFFINITY_SLACK', 2))
+
+class OllamaBackend:
+    """
+    One Ollama server of the pool.
+
+    Tracks the requests in flight, the models it currently has loaded (from /api/ps)
+    and its health. A failing backend is ejected until a health check passes again,
+    and its circuit breaker makes requests skip it while it keeps failing.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.loaded_models = set()
+        self.healthy = False
+        self.checked_at = 0.0
+        self.breaker = CircuitBreaker(OLLAMA_FAILURE_THRESHOLD, OLLAMA_RESET_TIMEOUT)
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.breaker.state != "open"
+
+    async def check_health(self) -> bool:
+        try:
+            async with get_session().get(f'{self.url}/api/ps', timeout=aiohttp.ClientTimeout(total=OLLAMA_HEALTH_TIMEOUT)) as response:
+                self.healthy = response.status == 200
+                if self.healthy:
+                    data = await response.json()
+                    self.loaded_models = {model['name'] for model in data.get('models', [])}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Ollama health check of {self.url} failed: {e!r}")
+            self.healthy = False
+        self.checked_at = time.monotonic()
+        if self.healthy:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        return self.healthy
+
+    def record_failure(self, error) -> None:
+        # A failed request ejects the backend until the next health check passes
+        logger.warning(f"Ollama request to {self.url} failed: {error!r}")
+        self.healthy = False
+        self.checked_at = 0.0
+        self.breaker.record_failure()
+
+class OllamaPool:
+    """Routes requests to the least busy healthy backend, preferring those with the model loaded."""
+
+    def __init__(self, urls: list):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.lock = asyncio.Lock()
+
+    async def check_health(self) -> None:
+        await asyncio.gather(*(backend.check_health() for backend in self.backends))
+
+    async def refresh_health(self) -> None:
+        # Concurrent callers share one round of checks, and fresh results are reused
+        async with self.lock:
+            stale = [backend for backend in self.backends
+                     if backend.breaker.state != "open" and time.monotonic() - backend.checked_at >= OLLAMA_HEALTH_TTL]
+            if stale:
+                await asyncio.gather(*(backend.check_health() for backend in stale))
+
+    def healthy_backends(self) -> list:
+        return [backend for backend in self.backends if backend.available]
+
+    def choose(self, model: str, exclude=()) -> OllamaBackend:
+        candidates = [backend for backend in self.healthy_backends() if backend not in exclude]
+        if not candidates:
+            return None
+        least_busy = min(candidates, key=lambda backend: backend.outstanding)
+        loaded = [backend for backend in candidates if model in backend.loaded_models]
+        if loaded:
+            best_loaded = min(loaded, key=lambda backend: backend.outstanding)
+            # Loading a model costs seconds, so a slightly busier backend that has it still wins
+            if best_loaded.outstanding <= least_busy.outstanding + OLLAMA_AFFINITY_SLACK:
+                return best_loaded
+        return least_busy
+
+pool = OllamaPool(OLLAMA_URLS)
 
 def build_message_list_ollama(chat_history) -> list:
-    messages = []
+    return build_message_list("ollama", chat_history, append_messages_ollama)
+
+def append_messages_ollama(messages, rows) -> int:
     prev_message_type = ""
     image = None
-    for message_type, message, role in chat_history:
+    for message_type, message, role in rows:
         if prev_message_type == "image_url":
             messages.append({
             "role": role,
@@ -33,44 +140,146 @@ def build_message_list_ollama(chat_history) -> list:
         elif message_type == 'image_url':
             prev_message_type = message_type
             image = message
+    # An image is sent together with the text that follows it, leave a trailing one for the next turn
+    return len(rows) - 1 if image is not None else len(rows)
+
+class NDJSONParser:
+    """
+    Incremental parser for newline delimited JSON.
+
+    Chunks can end anywhere, so the unfinished last line is kept until the rest
+    of it arrives and only that partial line is ever buffered.
+    """
+
+    def __init__(self):
+        self.buffer = b""
 
-    return messages
+    def feed(self, chunk: bytes) -> list:
+        lines = (self.buffer + chunk).split(b"\n")
+        self.buffer = lines.pop()
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def close(self) -> list:
+        line, self.buffer = self.buffer, b""
+        return [json.loads(line)] if line.strip() else []
+
+def build_request_ollama(messages, model, temperature, max_tokens) -> dict:
+    return {
+        "model": model,
+        "messages": messages,
+        "options": {
+            "temperature": temperature,
+            # Ollama ignores max_tokens, its limit is called num_predict
+            "num_predict": max_tokens,
+        },
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "stream": True,
+    }
+
+async def handle_stream_object(data: dict, role: str, message_parts: list, on_delta) -> str:
+    # Collect and pass on the content of one streamed object, returns the role of the reply
+    if 'error' in data:
+        # Ollama reports failures that happen after the 200 status as an object in the stream
+        raise ProviderError(f"Ollama returned an error: {data['error']}")
+    content = data.get('message', {}).get('content')
+    if content:
+        message_parts.append(content)
+        if on_delta is not None:
+            await on_delta(content)
+    return data.get('message', {}).get('role', role)
 
 async def chat_with_ollama(messages, model, temperature=0.5, max_tokens=100) -> str:
+    return await stream_with_ollama(messages, None, model=model, temperature=temperature, max_tokens=max_tokens)
+
+# Stream a reply from Ollama, passing each text delta to on_delta as it arrives
+async def stream_with_ollama(messages, on_delta, model, temperature=0.5, max_tokens=100) -> tuple:
     # Check if Ollama is available
-    if check_server_status() == False:
+    if not await check_server_status():
         return -1, -1, "assistant", "Ollama is not available. Please try again later."
-    
-    jsonData = {
-            "model": model,
-            "messages": messages,
-            "options": {
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            },
-            "keep_alive": "10m",
-            "stream": False,
-        }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f'{OLLAMA_URL}/api/chat', json=jsonData) as response:
-            data = await response.json()
-            if data:
-                return process_response_from_ollama(data)
+
+    jsonData = build_request_ollama(messages, model, temperature, max_tokens)
+    role = "assistant"
+    message_parts = []
+    data = {}
+    tried = []
+    # A backend that fails before sending anything is skipped and the next one is tried,
+    # one that fails after the first delta fails the reply
+    while not message_parts:
+        backend = pool.choose(model, exclude=tried)
+        if backend is None:
+            return -1, -1, "assistant", "Ollama is not available. Please try again later."
+        tried.append(backend)
+        parser = NDJSONParser()
+        backend.outstanding += 1
+        try:
+            async with get_session().post(f'{backend.url}/api/chat', json=jsonData) as response:
+                if response.status != 200:
+                    raise ProviderError(f"Ollama returned HTTP {response.status}: {await response.text()}", response.status, response.headers)
+                # Ollama streams one JSON object per line, parsed as the chunks arrive
+                done = False
+                async for chunk in response.content.iter_chunked(OLLAMA_CHUNK_SIZE):
+                    for data in parser.feed(chunk):
+                        role = await handle_stream_object(data, role, message_parts, on_delta)
+                        done = data.get('done', False)
+                    if done:
+                        break
+                # The last line may arrive without a trailing newline
+                for data in parser.close():
+                    role = await handle_stream_object(data, role, message_parts, on_delta)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            backend.record_failure(e)
+            if message_parts:
+                # Part of the reply is already shown, another backend would start it over
+                raise ProviderError(f"Ollama stopped answering mid-reply: {e!r}") from e
+            continue
+        finally:
+            backend.outstanding -= 1
+        backend.breaker.record_success()
+        backend.loaded_models.add(model)
+        break
+    data['message'] = {"role": role, "content": "".join(message_parts)}
+    return process_response_from_ollama(data)
+
+async def warm_up_ollama(model) -> None:
+    # A request without messages loads the model and keeps it in memory for OLLAMA_KEEP_ALIVE
+    if not await check_server_status():
+        return
+    backend = pool.choose(model)
+    if backend is None or model in backend.loaded_models:
+        return
+    try:
+        async with get_session().post(f'{backend.url}/api/chat', json={"model": model, "messages": [], "keep_alive": OLLAMA_KEEP_ALIVE}) as response:
+            await response.read()
+            if response.status == 200:
+                backend.loaded_models.add(model)
+                logger.info(f"Warmed up Ollama model {model} on {backend.url}")
             else:
-                return 0, 0, "assistant", f"An error occurred while interacting with Ollama. Please try again later. Error code: {response.status_code}"
+                logger.warning(f"Could not warm up Ollama model {model} on {backend.url}: HTTP {response.status}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Could not warm up Ollama model {model} on {backend.url}: {e!r}")
 
-def get_available_ollama_models() -> list:
-    # Check if Ollama is available
-    if check_server_status() == False:
-        return []
-
-    # Get this via POST request
-    available_models = []
-    res = requests.get(f'{OLLAMA_URL}/api/tags')
-    if res.status_code == 200:
-        data = res.json().get('models', [])
-        available_models = [data[i]['name'] for i in range(len(data)) if 'embed' not in data[i]['name']]
-        available_models = sorted(available_models)
+async def get_backend_models(backend: OllamaBackend) -> list:
+    async with get_session().get(f'{backend.url}/api/tags') as response:
+        response.raise_for_status()
+        data = (await response.json()).get('models', [])
+    return [model['name'] for model in data]
+
+async def get_available_ollama_models() -> list:
+    # Union of the models of every healthy backend
+    await pool.refresh_health()
+    backends = pool.healthy_backends()
+    if not backends:
+        raise ConnectionError("No Ollama backend is available")
+    results = await asyncio.gather(*(get_backend_models(backend) for backend in backends), return_exceptions=True)
+    models = set()
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Could not list the models of an Ollama backend: {result!r}")
+            continue
+        models.update(result)
+    if not models and all(isinstance(result, Exception) for result in results):
+        raise results[0]
+    available_models = sorted(model for model in models if 'embed' not in model)
     return available_models
 
 def process_response_from_ollama(response) -> tuple:
@@ -78,15 +287,48 @@ def process_response_from_ollama(response) -> tuple:
     output_tokens = response.get('eval_count')
     role = response.get('message').get('role')
     message = response.get('message').get('content')
-    # To manage the case where GPT still outputs unwanted tags that 
-    # may cause telegram to fail to format the message properly
-    message = re.sub(r'<(a|article|p|br|li|sup|sub|abbr|small|ul|/a|/article|/p|/li|/sup|/sub|/abbr|/small|/ul)>', '', message)
-    message = message.replace('<h1>', '<b><u>').replace('</h1>', '</u></b>').replace('<h2>', '<b>').replace('</h2>', '</b>').replace('<h3>', '<u>').replace('</h3>', '</u>').replace('<h4>', '<i>').replace('</h4>', '</i>').replace('<h5>', '').replace('</h5>', '').replace('<h6>', '').replace('</h6>', '').replace('<big>', '<b>').replace('</big>', '</b>')
+    message = sanitize_html(message)
     return input_tokens, output_tokens, role, message
 
-def check_server_status() -> bool:
-    res = requests.get(f'{OLLAMA_URL}/api')
-    if res.status_code == 200:
-        return True
-    else:
-        return False
\ No newline at end of file
+async def check_server_status() -> bool:
+    # Health is cached for a few seconds, backends with an open circuit are not checked
+    await pool.refresh_health()
+    return bool(pool.healthy_backends())
+
+async def check_ollama_health() -> None:
+    # Run periodically so unhealthy backends are ejected and recovered ones rejoin
+    await pool.check_health()
+
+@register_provider("ollama")
+class OllamaProvider:
+    async def complete(self, chat_history, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_ollama(chat_history)
+        response = ProviderResponse(*await chat_with_ollama(messages, model=model, temperature=temperature, max_tokens=max_tokens))
+        if response.input_tokens == -1:
+            raise ProviderUnavailableError("Ollama is not available")
+        return response
+
+    async def stream(self, chat_history, on_delta, model, temperature, max_tokens, n=1, system=""):
+        messages = build_message_list_ollama(chat_history)
+        response = ProviderResponse(*await stream_with_ollama(messages, on_delta, model=model, temperature=temperature, max_tokens=max_tokens))
+        if response.input_tokens == -1:
+            raise ProviderUnavailableError("Ollama is not available")
+        return response
+
+    async def count_tokens(self, chat_history, model):
+        return count_history_tokens(chat_history)
+
+    async def list_models(self):
+        return await get_available_ollama_models()
+
+    async def warm_up(self, model):
+        await warm_up_ollama(model)
+
+    async def check_health(self):
+        await check_ollama_health()
+
+    async def is_available(self):
+        return await check_server_status()
+
+    async def close(self):
+        pass
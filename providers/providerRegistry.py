@@ -0,0 +1,133 @@
+import asyncio
+import importlib
+from typing import Final, NamedTuple, Protocol, Awaitable, Callable
+from helpers.resilienceHelper import call_with_retries, is_retryable, CircuitBreaker, StreamProgress, PROVIDER_FAILURE_THRESHOLD, PROVIDER_RESET_TIMEOUT
+
+# provider -> handler module, imported the first time the provider is used so
+# that starting the bot does not pay for SDKs nobody has selected
+PROVIDER_MODULES: Final = {
+    "openai": "providers.gptHandler",
+    "claude": "providers.claudeHandler",
+    "google": "providers.geminiHandler",
+    "ollama": "providers.ollamaHandler",
+    "fake": "providers.fakeHandler",
+}
+
+# provider -> instance registered by its handler module
+providers = {}
+
+class ProviderResponse(NamedTuple):
+    input_tokens: int
+    output_tokens: int
+    role: str
+    message: str
+    # Input tokens served from and written to the provider's prompt cache, not part of input_tokens
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+
+class ProviderUnavailableError(Exception):
+    """Raised when a provider cannot serve requests right now."""
+
+class Provider(Protocol):
+    """
+    Contract every chat provider implements.
+
+    chat_history is a list of (type, message, role) rows in chat order with images
+    already base64 encoded. It may start with a system row; system is the same prompt
+    for the providers that take it separately.
+    """
+
+    async def complete(self, chat_history: list, model: str, temperature: float, max_tokens: int, n: int = 1, system: str = "") -> ProviderResponse:
+        ...
+
+    async def stream(self, chat_history: list, on_delta: Callable[[str], Awaitable[None]], model: str, temperature: float, max_tokens: int, n: int = 1, system: str = "") -> ProviderResponse:
+        ...
+
+    async def count_tokens(self, chat_history: list, model: str) -> int:
+        ...
+
+    async def list_models(self) -> list:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+class ResilientProvider:
+    """
+    Wraps a registered provider with its timeout, retries, circuit breaker and metrics.
+
+    A stream is only retried while nothing has been shown to the user, a retry after
+    the first delta would repeat text that is already on screen. Once the provider keeps
+    failing its circuit opens and calls are rejected with ProviderUnavailableError.
+    """
+
+    def __init__(self, name: str, provider):
+        self.name = name
+        self.provider = provider
+        self.breaker = CircuitBreaker(PROVIDER_FAILURE_THRESHOLD, PROVIDER_RESET_TIMEOUT)
+
+    def __getattr__(self, attribute):
+        # Optional extras such as warm_up or generate_image are passed straight through
+        return getattr(self.provider, attribute)
+
+    async def call(self, call, can_retry=lambda: True, progress=None):
+        if not self.breaker.allow_request():
+            raise ProviderUnavailableError(f"{self.name} is failing, its circuit is open")
+        try:
+            result = await call_with_retries(self.name, call, can_retry, progress)
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            # Only failures of the provider itself count, not bad requests
+            if isinstance(e, ProviderUnavailableError) or is_retryable(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_cancelled()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def complete(self, *args, **kwargs) -> ProviderResponse:
+        return await self.call(lambda: self.provider.complete(*args, **kwargs))
+
+    async def stream(self, chat_history, on_delta, *args, **kwargs) -> ProviderResponse:
+        progress = StreamProgress()
+        async def tracked_delta(text):
+            progress.touch()
+            await on_delta(text)
+        return await self.call(
+            lambda: self.provider.stream(chat_history, tracked_delta, *args, **kwargs),
+            can_retry=lambda: not progress.started,
+            progress=progress,
+        )
+
+    async def count_tokens(self, chat_history: list, model: str) -> int:
+        return await self.provider.count_tokens(chat_history, model)
+
+    async def list_models(self) -> list:
+        return await self.call(self.provider.list_models)
+
+    async def close(self) -> None:
+        await self.provider.close()
+
+def register_provider(name: str):
+    # Class decorator, the handler module registers one instance when it is imported
+    def decorator(cls):
+        providers[name] = ResilientProvider(name, cls())
+        return cls
+    return decorator
+
+def get_provider(provider: str) -> Provider:
+    if provider not in providers:
+        importlib.import_module(PROVIDER_MODULES[provider])
+    return providers[provider]
+
+async def load_provider(provider: str) -> Provider:
+    # The first import of an SDK can take a second, run it off the event loop
+    if provider in providers:
+        return providers[provider]
+    return await asyncio.to_thread(get_provider, provider)
+
+def is_provider_loaded(provider: str) -> bool:
+    return provider in providers
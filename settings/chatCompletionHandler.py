@@ -1,11 +1,15 @@
-import sqlite3
 import os
 from typing import Final
+from cachetools import LRUCache
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 
 import settings.settingMenu as settingMenu
+from helpers.dbHelper import users_db
+from helpers.promptHelper import get_default_system_prompt
+from providers.catalogHandler import ensure_models, warm_up_model
+from providers.providerRegistry import load_provider
 from settings.imageGenHandler import (
     image_size_selected,
     image_option_selected,
@@ -16,52 +20,21 @@ from settings.imageGenHandler import (
 # Define conversation states
 SELECTING_OPTION, SELECTING_MODEL, ENTERING_TEMPERATURE, ENTERING_MAX_TOKENS, ENTERING_N, ENTERING_START_PROMPT, SELECT_RESET, SELECTING_PROVIDER, SELECTING_IMAGE_SETTINGS, SELECTING_IMAGE_MODEL, SELECTING_IMAGE_SIZE = range(4, 15)
 
-# Initialise path to db
-DB_DIR = os.getenv('DB_DIR')
-DB_FILE = 'user_preferences.db'
-DB_PATH = os.path.join(DB_DIR, DB_FILE)
-
-os.makedirs(DB_DIR, exist_ok=True)
-
-# Initialise path to system prompt
-PROMPT_DIR = os.getenv('PROMPT_DIR')
-PROMPT_FILE = 'system_prompt.txt'
-PROMPT_PATH = os.path.join(PROMPT_DIR, PROMPT_FILE)
+COLUMNS: Final = 2
 
-os.makedirs(PROMPT_DIR, exist_ok=True)
+# Columns of user_preferences in table order
+SETTINGS_COLUMNS: Final = ['user_id', 'provider', 'model', 'temperature', 'max_tokens', 'n', 'start_prompt']
 
-# start sqlite3
-conn_settinngs = sqlite3.connect(DB_PATH)
+# user_id -> user_preferences row
+SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', 1024))
+settings_cache = LRUCache(maxsize=SETTINGS_CACHE_SIZE)
 
-COLUMNS: Final = 2
-
-# Default starting message from file system_prompt.txt
-DEFAULT_STARTING_MESSAGE = open(PROMPT_PATH, 'r').read()
 DEFAULT_MAX_TOKENS = 512
 
-# Store user preferences in database
-c = conn_settinngs.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS user_preferences 
-        (user_id INTEGER PRIMARY KEY, 
-        provider TEXT DEFAULT "openai", 
-        model TEXT DEFAULT "gpt-3.5-turbo", 
-        temperature FLOAT DEFAULT 0.7, 
-        max_tokens INTEGER DEFAULT 512, 
-        n INTEGER DEFAULT 1, 
-        start_prompt TEXT DEFAULT ""
-        )''')
-
 # Settings 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id: int = update.effective_user.id
-    c.execute('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    if result is None:
-        print(f"User {user_id} not found in user_preferences table")
-        c.execute('INSERT INTO user_preferences (user_id, start_prompt) VALUES (?, ?)', (user_id, DEFAULT_STARTING_MESSAGE))
-        conn_settinngs.commit()
-        c.execute('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
+    result = await get_current_settings(user_id)
     _, provider, model, temperature, max_tokens, n, start_prompt = result
 
     context.user_data['settings'] = [provider, model, temperature, max_tokens, n, start_prompt]
@@ -174,8 +147,9 @@ async def model_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Update the database
     user_id = update.effective_user.id
-    c.execute('UPDATE user_preferences SET model = ? WHERE user_id = ?', (selected_model, user_id))
-    conn_settinngs.commit()
+    await update_setting(user_id, 'model', selected_model)
+    # Load the model in the background so the first message does not wait for it
+    context.application.create_task(warm_up_model(context.user_data['settings'][0], selected_model))
     
     await query.edit_message_text(f"Model updated to: {selected_model}")
     await settingMenu.show_current_settings(update, context)
@@ -189,8 +163,8 @@ async def provider_selected(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await settingMenu.show_current_settings(update, context)
         return SELECTING_OPTION
     elif query.data == "ollama":
-        from providers.ollamaHandler import check_server_status
-        if not check_server_status():
+        ollama = await load_provider("ollama")
+        if not await ollama.is_available():
             message = await query.message.reply_text("Ollama is currently unavailable. Please try again later.")
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
             return SELECTING_PROVIDER
@@ -200,9 +174,16 @@ async def provider_selected(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Update the database
     user_id = update.effective_user.id
-    c.execute('UPDATE user_preferences SET provider = ? WHERE user_id = ?', (selected_provider, user_id))
-    conn_settinngs.commit()
+    await update_setting(user_id, 'provider', selected_provider)
     
+    # The provider's SDK and model list are loaded in the background the first time it is picked
+    if not ensure_models(selected_provider):
+        await query.edit_message_text(
+            f"The models of {selected_provider.title()} are still loading or unavailable. Please try again in a moment.",
+            reply_markup=settingMenu.back_keyboard(),
+            )
+        return SELECTING_MODEL
+
     # move to model selection
     await query.edit_message_text(
         f"<b><u>Current Provider</u>: </b>{context.user_data['settings'][0]} \n"
@@ -222,8 +203,7 @@ async def temperature_entered(update: Update, context: ContextTypes.DEFAULT_TYPE
             
             # Update the database
             user_id = update.effective_user.id
-            c.execute('UPDATE user_preferences SET temperature = ? WHERE user_id = ?', (temperature, user_id))
-            conn_settinngs.commit()
+            await update_setting(user_id, 'temperature', temperature)
 
             message = await update.message.reply_text(f"Temperature updated to: {temperature}")
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
@@ -249,8 +229,7 @@ async def max_tokens_entered(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             # Update the database
             user_id = update.effective_user.id
-            c.execute('UPDATE user_preferences SET max_tokens = ? WHERE user_id = ?', (max_tokens, user_id))
-            conn_settinngs.commit()
+            await update_setting(user_id, 'max_tokens', max_tokens)
             
             message = await update.message.reply_text(f"Max tokens updated to: {max_tokens}")
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
@@ -277,8 +256,7 @@ async def n_entered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             context.user_data['settings'][4] = n
             # Update the database
             user_id = update.effective_user.id
-            c.execute('UPDATE user_preferences SET n = ? WHERE user_id = ?', (n, user_id))
-            conn_settinngs.commit()
+            await update_setting(user_id, 'n', n)
             message = await update.message.reply_text(f"N updated to: {n}")
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
 
@@ -303,8 +281,7 @@ async def start_prompt_entered(update: Update, context: ContextTypes.DEFAULT_TYP
             context.user_data['settings'][5] = ''
             # Update the database
             user_id = update.effective_user.id
-            c.execute('UPDATE user_preferences SET start_prompt = ? WHERE user_id = ?', ('', user_id))
-            conn_settinngs.commit()
+            await update_setting(user_id, 'start_prompt', '')
             message = await update.message.reply_text("Starting prompt cleared.")
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
             await settingMenu.show_current_settings(update, context)
@@ -313,8 +290,7 @@ async def start_prompt_entered(update: Update, context: ContextTypes.DEFAULT_TYP
             context.user_data['settings'][5] = user_input
             # Update the database
             user_id = update.effective_user.id
-            c.execute('UPDATE user_preferences SET start_prompt = ? WHERE user_id = ?', (user_input, user_id))
-            conn_settinngs.commit()
+            await update_setting(user_id, 'start_prompt', user_input)
             message = await update.message.reply_text("Starting prompt updated.")
             context.user_data.setdefault('sent_messages', []).append(message.message_id)
 
@@ -330,12 +306,12 @@ async def start_prompt_entered(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def reset_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    c.execute('DELETE FROM user_preferences WHERE user_id = ?', (user_id,))
-    conn_settinngs.commit()
-    c.execute('INSERT INTO user_preferences (user_id, max_tokens, start_prompt) VALUES (?, ?, ?)', (user_id, DEFAULT_MAX_TOKENS, DEFAULT_STARTING_MESSAGE))
-    conn_settinngs.commit()
-    c.execute('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
-    row = c.fetchone()
+    def _reset(conn):
+        conn.execute('DELETE FROM user_preferences WHERE user_id = ?', (user_id,))
+        conn.execute('INSERT INTO user_preferences (user_id, max_tokens, start_prompt) VALUES (?, ?, ?)', (user_id, DEFAULT_MAX_TOKENS, get_default_system_prompt()))
+    await users_db.transaction(_reset)
+    row = await users_db.fetchone('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
+    settings_cache[user_id] = row
     _, provider, model, temperature, max_tokens, n, start_prompt = row
     context.user_data['settings'] = [provider, model, temperature, max_tokens, n, start_prompt]
     await settingMenu.show_current_settings(update, context)
@@ -418,29 +394,36 @@ def settings_menu_handler():
         ],
     }
 
-def get_current_settings(user_id) -> tuple:
-    c.execute('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
-    row = c.fetchone()
+async def get_current_settings(user_id) -> tuple:
+    # Served from memory after the first lookup, kept up to date by update_setting
+    row = settings_cache.get(user_id)
     if row is not None:
         return row
-    else:
-        c.execute('INSERT INTO user_preferences (user_id, start_prompt) VALUES (?, ?)', (user_id, DEFAULT_STARTING_MESSAGE))
-        conn_settinngs.commit()
-        c.execute('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
-        row = c.fetchone()
+    row = await users_db.fetchone('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
+    if row is None:
+        print(f"User {user_id} not found in user_preferences table")
+        await users_db.execute('INSERT INTO user_preferences (user_id, start_prompt) VALUES (?, ?)', (user_id, get_default_system_prompt()))
+        row = await users_db.fetchone('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
+    settings_cache[user_id] = row
     return row
 
-def reset_user_settings(user_id) -> bool:
+async def update_setting(user_id, column: str, value) -> None:
+    # Write through to the database and the cache
+    await users_db.execute(f'UPDATE user_preferences SET {column} = ? WHERE user_id = ?', (value, user_id))
+    row = settings_cache.get(user_id)
+    if row is not None:
+        row = list(row)
+        row[SETTINGS_COLUMNS.index(column)] = value
+        settings_cache[user_id] = tuple(row)
+
+async def reset_user_settings(user_id) -> bool:
     try:
-        c.execute('DELETE FROM user_preferences WHERE user_id = ?', (user_id,))
-        conn_settinngs.commit()
-        c.execute('INSERT INTO user_preferences (user_id, start_prompt) VALUES (?, ?)', (user_id, DEFAULT_STARTING_MESSAGE))
-        conn_settinngs.commit()
+        def _reset(conn):
+            conn.execute('DELETE FROM user_preferences WHERE user_id = ?', (user_id,))
+            conn.execute('INSERT INTO user_preferences (user_id, start_prompt) VALUES (?, ?)', (user_id, get_default_system_prompt()))
+        await users_db.transaction(_reset)
+        settings_cache.pop(int(user_id), None)
         return True
     except Exception as e:
         print(f"Error resetting user settings: {e}")
-        return False
-
-def kill_connection() -> None:
-    conn_settinngs.close()
-    print("Settings DB Connection Closed")
\ No newline at end of file
+        return False
\ No newline at end of file
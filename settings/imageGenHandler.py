@@ -1,15 +1,20 @@
-import sqlite3
 import os
 from typing import Final
+from cachetools import LRUCache
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 import settings.settingMenu as settingMenu
+from helpers.dbHelper import users_db
 
 
 SELECTING_IMAGE_SETTINGS, SELECTING_IMAGE_MODEL, SELECTING_IMAGE_SIZE = range(12,15)
 SELECTING_OPTION = 4
 
+# user_id -> image_gen_user_preferences row
+IMAGE_SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', 1024))
+image_settings_cache = LRUCache(maxsize=IMAGE_SETTINGS_CACHE_SIZE)
+
 # DEFINE LIST OF MODELS, SIZES
 IMAGE_MODELS: Final = [
     "dall-e-2",
@@ -28,28 +33,10 @@ IMAGE_SIZES_DALLE3: Final = [
     "1792x1024",
 ]
 
-# Initialise path to db
-DB_DIR = os.getenv('DB_DIR')
-DB_FILE = 'user_preferences.db'
-DB_PATH = os.path.join(DB_DIR, DB_FILE)
-
-os.makedirs(DB_DIR, exist_ok=True)
-
-# start sqlite3
-conn_settinngs = sqlite3.connect(DB_PATH)
-
-
-# Store user preferences in database
-c = conn_settinngs.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS image_gen_user_preferences 
-        (user_id INTEGER PRIMARY KEY,
-        model TEXT DEFAULT "dall-e-2", 
-        size TEXT DEFAULT "256x256"
-        )''')
 
 async def image_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    _, model, size = get_image_settings(user_id)
+    _, model, size = await get_image_settings(user_id)
 
     context.user_data['image_settings'] = [model, size]
     if update.message is None:
@@ -105,8 +92,7 @@ async def image_model_selected(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Update the database
     user_id = update.effective_user.id
-    c.execute('UPDATE image_gen_user_preferences SET model = ?, size = ? WHERE user_id = ?', (selected_model, context.user_data['image_settings'][1], user_id))
-    conn_settinngs.commit()
+    await update_image_settings(user_id, model=selected_model, size=context.user_data['image_settings'][1])
     
     await query.edit_message_text(f"Image model updated to: {selected_model} \nImage size has been updated to default: {context.user_data['image_settings'][1]}")
     await image_settings(update, context)
@@ -125,8 +111,7 @@ async def image_size_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Update the database
     user_id = update.effective_user.id
-    c.execute('UPDATE image_gen_user_preferences SET size = ? WHERE user_id = ?', (selected_size, user_id))
-    conn_settinngs.commit()
+    await update_image_settings(user_id, size=selected_size)
     
     await query.edit_message_text(f"Image size updated to: {selected_size}")
     await image_settings(update, context)
@@ -138,29 +123,35 @@ async def back_to_image_settings(update: Update, context: ContextTypes.DEFAULT_T
     await image_settings(update, context)
     return SELECTING_IMAGE_SETTINGS
 
-def get_image_settings(user_id):
+async def get_image_settings(user_id):
+    # Served from memory after the first lookup, kept up to date by update_image_settings
+    result = image_settings_cache.get(user_id)
+    if result is not None:
+        return result
     # Ensure the user_id has a row in the database
-    c.execute('SELECT * FROM image_gen_user_preferences WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
+    result = await users_db.fetchone('SELECT * FROM image_gen_user_preferences WHERE user_id = ?', (user_id,))
     if result is None:
-        c.execute('INSERT INTO image_gen_user_preferences (user_id) VALUES (?)', (user_id,))
-        conn_settinngs.commit()
-        c.execute('SELECT * FROM image_gen_user_preferences WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
+        await users_db.execute('INSERT INTO image_gen_user_preferences (user_id) VALUES (?)', (user_id,))
+        result = await users_db.fetchone('SELECT * FROM image_gen_user_preferences WHERE user_id = ?', (user_id,))
+    image_settings_cache[user_id] = result
     return result
 
-def reset_user_image_settings(user_id) -> bool:
+async def update_image_settings(user_id, model=None, size=None) -> None:
+    # Write through to the database and the cache
+    _, current_model, current_size = await get_image_settings(user_id)
+    model = model or current_model
+    size = size or current_size
+    await users_db.execute('UPDATE image_gen_user_preferences SET model = ?, size = ? WHERE user_id = ?', (model, size, user_id))
+    image_settings_cache[user_id] = (user_id, model, size)
+
+async def reset_user_image_settings(user_id) -> bool:
     try:
-        c.execute('DELETE FROM image_gen_user_preferences WHERE user_id = ?', (user_id,))
-        conn_settinngs.commit()
-        c.execute('INSERT INTO image_gen_user_preferences (user_id) VALUES (?)', (user_id,))
-        conn_settinngs.commit()
+        def _reset(conn):
+            conn.execute('DELETE FROM image_gen_user_preferences WHERE user_id = ?', (user_id,))
+            conn.execute('INSERT INTO image_gen_user_preferences (user_id) VALUES (?)', (user_id,))
+        await users_db.transaction(_reset)
+        image_settings_cache.pop(int(user_id), None)
         return True
     except Exception as e:
         print(f"Error resetting image gen settings: {e}")
         return False
-
-
-def kill_connection() -> None:
-    conn_settinngs.close()
-    print("Image Gen Settings DB Connection Closed")
\ No newline at end of file
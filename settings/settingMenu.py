@@ -3,10 +3,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-import providers.gptHandler as gpt
-import providers.claudeHandler as claude
-import providers.geminiHandler as gemini
-import providers.ollamaHandler as ollama
+from providers.catalogHandler import get_models
 
 COLUMNS: Final = 2
 
@@ -76,7 +73,7 @@ def provider_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 def claude_model_keyboard() -> InlineKeyboardMarkup:
-    models = claude.get_available_claude_models()
+    models = get_models("claude")
     keyboard = [
         [InlineKeyboardButton(model, callback_data=f"select_model:{model}") for model in models[model_pair*COLUMNS:model_pair*COLUMNS+COLUMNS]]
         for model_pair in range(len(models))
@@ -84,7 +81,7 @@ def claude_model_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 def openai_model_keyboard() -> InlineKeyboardMarkup:
-    models = gpt.get_available_openai_models()
+    models = get_models("openai")
     keyboard = [
         [InlineKeyboardButton(model, callback_data=f"select_model:{model}") for model in models[model_pair*COLUMNS:model_pair*COLUMNS+COLUMNS]]
         for model_pair in range(len(models))
@@ -92,7 +89,7 @@ def openai_model_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 def google_model_keyboard() -> InlineKeyboardMarkup:
-    models = gemini.get_available_gemini_models()
+    models = get_models("google")
     keyboard = [
         [InlineKeyboardButton(model, callback_data=f"select_model:{model}") for model in models[model_pair*COLUMNS:model_pair*COLUMNS+COLUMNS]]
         for model_pair in range(len(models))
@@ -100,7 +97,7 @@ def google_model_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 def ollama_model_keyboard() -> InlineKeyboardMarkup:
-    models = ollama.get_available_ollama_models()
+    models = get_models("ollama")
     keyboard = [
         [InlineKeyboardButton(model, callback_data=f"select_model:{model}") for model in models[model_pair*COLUMNS:model_pair*COLUMNS+COLUMNS]]
         for model_pair in range(len(models))
@@ -108,6 +105,7 @@ def ollama_model_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 def provider_model_keyboard_switch(provider : str) -> InlineKeyboardMarkup:
+    # Model lists are served from the catalog in memory, never from the network
     if provider == "openai":
         return openai_model_keyboard()
     elif provider == "claude":
@@ -0,0 +1,50 @@
+import os
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("telegram")
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+import providers.catalogHandler as catalogHandler
+from providers.catalogHandler import ensure_models
+
+def test_menu_is_served_at_once_and_failures_are_not_retried_straight_away(monkeypatch):
+    calls = []
+
+    async def failing_load_models(provider):
+        calls.append(provider)
+        await asyncio.sleep(0.05)
+        raise ConnectionError("provider is down")
+
+    monkeypatch.setattr(catalogHandler, 'load_models', failing_load_models)
+    monkeypatch.setattr(catalogHandler, 'model_catalog', {'fake': []})
+    monkeypatch.setattr(catalogHandler, 'retry_after', {})
+
+    async def scenario():
+        # Opening the menu does not wait for the provider, and a running refresh is not started twice
+        assert ensure_models('fake') == []
+        assert ensure_models('fake') == []
+        await asyncio.sleep(0.1)
+        assert not catalogHandler.refresh_tasks
+        # The failure is remembered, the next menu open does not ask again
+        assert ensure_models('fake') == []
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert calls == ['fake']
+
+def test_loaded_list_is_returned_from_memory(monkeypatch):
+    async def load_models(provider):
+        return ['fake-echo']
+
+    monkeypatch.setattr(catalogHandler, 'load_models', load_models)
+    monkeypatch.setattr(catalogHandler, 'model_catalog', {'fake': []})
+    monkeypatch.setattr(catalogHandler, 'retry_after', {})
+
+    async def scenario():
+        ensure_models('fake')
+        await asyncio.sleep(0.01)
+        return ensure_models('fake')
+
+    assert asyncio.run(scenario()) == ['fake-echo']
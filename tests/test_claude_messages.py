@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("cachetools")
+os.environ.setdefault('CLAUDE_API_KEY', 'test')
+
+from helpers.contextHelper import count_tokens
+from helpers.messageListHelper import cached_message_lists, message_list_cache
+from providers.claudeHandler import append_messages_claude, build_message_list_claude
+
+# Tokens Claude adds around every message besides its content
+MESSAGE_OVERHEAD = 4
+
+# Histories in the shape they are stored, with image data shortened
+RECORDED_HISTORIES = {
+    "captioned photos": [
+        ("text", "You are a helpful assistant.", "system"),
+        ("image_url", "aW1hZ2UgMQ==", "user"),
+        ("text", "What breed is this dog?", "user"),
+        ("text", "It looks like a border collie, judging by the coat and the ears.", "assistant"),
+        ("image_url", "aW1hZ2UgMg==", "user"),
+        ("text", "And this one?", "user"),
+        ("text", "That one is a golden retriever.", "assistant"),
+    ],
+    "failed reply": [
+        ("text", "You are a helpful assistant.", "system"),
+        ("text", "Summarise the plot of Hamlet.", "user"),
+        ("text", "Please keep it short.", "user"),
+        ("text", "A prince avenges his father's murder, and nearly everyone dies.", "assistant"),
+        ("text", "Who kills Polonius?", "user"),
+    ],
+    "two replies in a row": [
+        ("text", "You are a helpful assistant.", "system"),
+        ("text", "I'll send you a picture of my receipt.", "user"),
+        ("text", "Sure, send it over.", "assistant"),
+        ("image_url", "cmVjZWlwdA==", "user"),
+        ("text", "What is the total?", "user"),
+        ("text", "The total is 23.40.", "assistant"),
+        ("text", "The VAT is 3.90 of that.", "assistant"),
+        ("text", "Thanks!", "user"),
+    ],
+}
+
+def append_messages_with_filler(messages, rows) -> int:
+    # The builder before same-role rows were merged, kept to compare against
+    prev_message_type = ""
+    image = None
+    for message_type, message, role in rows:
+        if role == 'system':
+            continue
+        if len(messages) > 0 and messages[-1].get('role') == 'user' and role == 'user':
+            messages.append({"role": "assistant", "content": [{"type": "text", "text": "Ignore this message"}]})
+        elif len(messages) > 0 and messages[-1].get('role') == 'assistant' and role == 'assistant':
+            messages.append({"role": "user", "content": [{"type": "text", "text": "Ignore this message"}]})
+        if prev_message_type == "image_url":
+            messages.append({"role": role, "content": [
+                {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": image}},
+                {"type": "text", "text": message},
+            ]})
+            prev_message_type = ""
+            image = None
+            continue
+        if message_type == 'text':
+            messages.append({"role": role, "content": [{"type": message_type, f"{message_type}": message}]})
+        elif message_type == 'image_url':
+            prev_message_type = message_type
+            image = message
+    return len(rows) - 1 if image is not None else len(rows)
+
+def count_input_tokens(messages: list) -> int:
+    tokens = 0
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD
+        for block in message['content']:
+            tokens += count_tokens('image_url', None) if block['type'] == 'image' else count_tokens('text', block['text'])
+    return tokens
+
+def alternates(messages: list) -> bool:
+    return all(a['role'] != b['role'] for a, b in zip(messages, messages[1:])) and (not messages or messages[0]['role'] == 'user')
+
+@pytest.mark.parametrize('name', RECORDED_HISTORIES)
+def test_merged_messages_alternate_and_cost_fewer_tokens(name):
+    history = RECORDED_HISTORIES[name]
+    merged, filled = [], []
+    append_messages_claude(merged, history)
+    append_messages_with_filler(filled, history)
+    print(f"{name}: {count_input_tokens(filled)} input tokens with filler, {count_input_tokens(merged)} merged")
+
+    assert alternates(merged)
+    assert not any(block.get('text') == "Ignore this message" for message in merged for block in message['content'])
+    # A captioned photo already was one message, the filler was added around repeated roles
+    if any(a[2] == b[2] and a[0] == b[0] == 'text' for a, b in zip(history, history[1:])):
+        assert count_input_tokens(merged) < count_input_tokens(filled)
+    else:
+        assert count_input_tokens(merged) == count_input_tokens(filled)
+    # Every row's content is still sent, in order
+    contents = [block.get('text') or block['source']['data'] for message in merged for block in message['content']]
+    assert contents == [message for _, message, role in history if role != 'system']
+
+@pytest.mark.parametrize('name', RECORDED_HISTORIES)
+def test_cached_message_list_alternates_on_every_turn(name):
+    # Replay the history one row at a time through the cached builder, as the chat grows
+    message_list_cache.clear()
+    history = RECORDED_HISTORIES[name]
+    for end in range(2, len(history) + 1):
+        with cached_message_lists(1):
+            messages = build_message_list_claude(history[:end])
+        assert alternates(messages)
+        assert messages == build_message_list_claude(history[:end])
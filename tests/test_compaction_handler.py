@@ -0,0 +1,84 @@
+import os
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("cachetools")
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+os.environ.setdefault('PROMPT_DIR', tempfile.mkdtemp())
+
+import chat.compactionHandler as compactionHandler
+import helpers.resilienceHelper as resilienceHelper
+from helpers.dbHelper import Database, WriteBehindQueue, CHATS_MIGRATIONS
+from helpers.resilienceHelper import PROVIDER_FAILURE_THRESHOLD
+from providers.providerRegistry import ProviderResponse, ResilientProvider, providers
+
+CHUNK_TOKENS = 100
+ROW_TOKENS = 30
+
+class SummaryProvider:
+    # Numbers its summaries and records the prompts, or fails every request
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.prompts = []
+
+    async def complete(self, chat_history, model, **kwargs):
+        if self.fail:
+            raise TimeoutError("summary timed out")
+        prompt = chat_history[-1][1]
+        self.prompts.append(prompt)
+        return ProviderResponse(10, 5, "assistant", f"summary {len(self.prompts)}")
+
+def fill_chat(conn, rows: int) -> None:
+    with conn:
+        conn.executemany(
+            "INSERT INTO chat_history (message_id, chat_id, type, message, role, tokens) VALUES (?, 1, 'text', ?, ?, ?)",
+            ((i + 1, f"message {i}", 'user' if i % 2 == 0 else 'assistant', ROW_TOKENS) for i in range(rows)))
+
+@pytest.fixture
+def compaction_setup(monkeypatch, tmp_path):
+    database = Database(str(tmp_path / 'chats.db'), CHATS_MIGRATIONS)
+    monkeypatch.setattr(compactionHandler, 'chats_db', database)
+    monkeypatch.setattr(compactionHandler, 'chat_writes', WriteBehindQueue(database))
+    monkeypatch.setattr(compactionHandler, 'set_chat_summary', lambda chat_id, summary: None)
+    monkeypatch.setattr(compactionHandler, 'COMPACTION_PROVIDER', 'summaries')
+    monkeypatch.setattr(compactionHandler, 'COMPACTION_CHUNK_TOKENS', CHUNK_TOKENS)
+    monkeypatch.setattr(compactionHandler, 'COMPACTION_KEEP_TURNS', 2)
+    monkeypatch.setattr(compactionHandler, 'COMPACTION_TOKEN_THRESHOLD', 500)
+    monkeypatch.setattr(compactionHandler, 'compaction_provider', None)
+    return database
+
+def run_compaction(database: Database, provider: SummaryProvider, monkeypatch, runs: int = 1) -> tuple:
+    registered = ResilientProvider('summaries', provider)
+    monkeypatch.setitem(providers, 'summaries', registered)
+
+    async def scenario():
+        await database.run(fill_chat, 40)
+        try:
+            for _ in range(runs):
+                # The job logs a failed chat and moves on
+                await compactionHandler.compact_chats(None)
+            return await database.fetchone("SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = 1")
+        finally:
+            await database.close()
+
+    return asyncio.run(scenario()), registered
+
+def test_long_backlog_is_folded_into_the_summary_in_chunks(compaction_setup, monkeypatch):
+    provider = SummaryProvider()
+    row, _ = run_compaction(compaction_setup, provider, monkeypatch)
+    # 38 rows of 30 tokens before the kept turns, at most 3 fit in a chunk
+    assert len(provider.prompts) == 13
+    assert all(prompt.split("Conversation:\n")[1].count("\n") < 3 for prompt in provider.prompts)
+    # Every chunk after the first carries the summary written so far
+    assert all(prompt.startswith(f"Previous summary:\nsummary {i}\n") for i, prompt in enumerate(provider.prompts[1:], 1))
+    assert row == ("summary 13", 38)
+
+def test_failing_summaries_leave_the_chat_circuit_closed(compaction_setup, monkeypatch):
+    monkeypatch.setattr(resilienceHelper, 'RETRY_ATTEMPTS', 1)
+    row, registered = run_compaction(compaction_setup, SummaryProvider(fail=True), monkeypatch, runs=PROVIDER_FAILURE_THRESHOLD + 1)
+    assert row is None
+    assert not compactionHandler.compaction_provider.breaker.allow_request()
+    # Replies to users still go through the provider
+    assert registered.breaker.allow_request()
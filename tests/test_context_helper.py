@@ -0,0 +1,44 @@
+import helpers.contextHelper as contextHelper
+from helpers.contextHelper import fit_to_budget, turn_start
+
+def history_with_images(images: int) -> list:
+    rows = [(1, 'text', 'system prompt', 'system', 10)]
+    for index in range(images):
+        message_id = 2 + index * 3
+        rows.append((message_id, 'image_url', f'hash{index}', 'user', 765))
+        rows.append((message_id + 1, 'text', f'caption {index}', 'user', 5))
+        rows.append((message_id + 2, 'text', f'answer {index}', 'assistant', 50))
+    return rows
+
+def test_history_that_fits_keeps_every_image(monkeypatch):
+    monkeypatch.setattr(contextHelper, 'CONTEXT_TOKEN_BUDGET', '100000')
+    rows = history_with_images(5)
+    selected = fit_to_budget(rows, 'gpt-4o', 1000)
+    assert len(selected) == len(rows)
+    assert sum(1 for message_type, _, _ in selected if message_type == 'image_url') == 5
+
+def test_history_over_budget_drops_old_images_first(monkeypatch):
+    monkeypatch.setattr(contextHelper, 'CONTEXT_TOKEN_BUDGET', '3000')
+    selected = fit_to_budget(history_with_images(5), 'gpt-4o', 1000)
+    images = [message for message_type, message, _ in selected if message_type == 'image_url']
+    assert images == ['hash3', 'hash4']
+    # Captions of dropped images are kept while they fit
+    assert ('text', 'caption 0', 'user') in selected
+    assert selected[0][2] == 'system'
+
+def test_trimmed_history_starts_with_a_user_turn(monkeypatch):
+    monkeypatch.setattr(contextHelper, 'CONTEXT_TOKEN_BUDGET', '120')
+    rows = [(1, 'text', 'system prompt', 'system', 10)]
+    for index in range(10):
+        rows.append((2 + index * 2, 'text', f'question {index}', 'user', 20))
+        rows.append((3 + index * 2, 'text', f'answer {index}', 'assistant', 30))
+    selected = fit_to_budget(rows, 'gpt-4o', 0)
+    assert selected[1][2] == 'user'
+    assert selected[-1] == ('text', 'answer 9', 'assistant')
+
+def test_turn_start_keeps_images_with_their_caption():
+    rows = history_with_images(3)[1:]
+    # Row 4 is the caption after the second image, the cut moves back to the image
+    assert turn_start(rows, 4) == 3
+    assert turn_start(rows, 5) == 3
+    assert turn_start(rows, 3) == 3
@@ -0,0 +1,42 @@
+import os
+import asyncio
+import tempfile
+
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+
+from helpers.dbHelper import Database, WriteBehindQueue, CHATS_MIGRATIONS
+
+INSERT_MESSAGE = "INSERT INTO chat_history (message_id, chat_id, type, message, role, tokens) VALUES (?, 1, 'text', ?, 'user', 1)"
+
+def test_failed_write_does_not_drop_the_rest_of_its_batch(tmp_path, caplog):
+    database = Database(str(tmp_path / 'chats.db'), CHATS_MIGRATIONS)
+    writes = WriteBehindQueue(database, flush_interval=60)
+
+    async def scenario():
+        writes.add(INSERT_MESSAGE, (1, 'first'))
+        # Same message_id again, fails the unique constraint
+        writes.add(INSERT_MESSAGE, (1, 'duplicate'))
+        writes.add(INSERT_MESSAGE, (2, 'second'))
+        await writes.flush()
+        rows = await database.fetchall("SELECT message FROM chat_history ORDER BY message_id")
+        await database.close()
+        return [row[0] for row in rows]
+
+    assert asyncio.run(scenario()) == ['first', 'second']
+    assert "Dropped queued write" in caplog.text
+
+def test_full_batch_is_flushed_in_the_background(tmp_path):
+    database = Database(str(tmp_path / 'chats.db'), CHATS_MIGRATIONS)
+    writes = WriteBehindQueue(database, flush_interval=60, batch_size=2)
+
+    async def scenario():
+        writes.add(INSERT_MESSAGE, (1, 'first'))
+        writes.add(INSERT_MESSAGE, (2, 'second'))
+        assert writes.tasks
+        await writes.close()
+        assert not writes.tasks
+        count = await database.fetchone("SELECT COUNT(*) FROM chat_history")
+        await database.close()
+        return count[0]
+
+    assert asyncio.run(scenario()) == 2
@@ -0,0 +1,98 @@
+import os
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("cachetools")
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+import chat.hedgeHandler as hedgeHandler
+import helpers.queueHelper as queueHelper
+from chat.hedgeHandler import hedged_stream
+from helpers.queueHelper import FairScheduler, provider_slot
+from providers.providerRegistry import ProviderResponse, ResilientProvider, providers
+
+class ScriptedProvider:
+    # Answers after a fixed delay and records how many streams it served
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.streams = 0
+
+    async def stream(self, chat_history, on_delta, model, **kwargs):
+        self.streams += 1
+        await asyncio.sleep(self.delay)
+        await on_delta(f"from {model}")
+        return ProviderResponse(10, 2, "assistant", f"from {model}")
+
+    async def count_tokens(self, chat_history, model):
+        return 10
+
+@pytest.fixture
+def hedge_setup(monkeypatch):
+    primary, fallback = ScriptedProvider(0.2), ScriptedProvider(0)
+    monkeypatch.setitem(providers, 'primary', ResilientProvider('primary', primary))
+    monkeypatch.setitem(providers, 'backup', ResilientProvider('backup', fallback))
+    monkeypatch.setattr(hedgeHandler, 'HEDGE_FALLBACK', 'backup:backup-model')
+    monkeypatch.setattr(hedgeHandler, 'get_hedge_delay', lambda provider, model: 0.02)
+    # One request at a time on the fallback
+    monkeypatch.setattr(queueHelper, 'schedulers', {'backup': FairScheduler('backup', 1, {})})
+    return primary, fallback
+
+async def collect(provider: str):
+    deltas = []
+    async def on_delta(text):
+        deltas.append(text)
+    async with provider_slot(provider, 'primary-model', 'alice') as slot:
+        response, answered_provider, _ = await hedged_stream(provider, 'primary-model', [("text", "hi", "user")], on_delta, 1, slot, 'alice')
+    return answered_provider, deltas
+
+def test_hedge_waits_for_a_free_fallback_slot_instead_of_jumping_its_queue(hedge_setup):
+    primary, fallback = hedge_setup
+
+    async def scenario():
+        # Someone else holds the fallback's only slot
+        async with provider_slot('backup', 'backup-model', 'bob'):
+            return await collect('primary')
+
+    answered_provider, deltas = asyncio.run(scenario())
+    assert answered_provider == 'primary'
+    assert deltas == ["from primary-model"]
+    assert fallback.streams == 0
+
+def test_hedge_takes_a_free_fallback_slot(hedge_setup, monkeypatch):
+    primary, fallback = hedge_setup
+    logged = []
+    monkeypatch.setattr(hedgeHandler, 'log_request', lambda chat_id, attempt, hedged, wasted_tokens: logged.append((attempt.provider, hedged, wasted_tokens)))
+    answered_provider, deltas = asyncio.run(collect('primary'))
+    assert answered_provider == 'backup'
+    assert fallback.streams == 1
+    assert queueHelper.schedulers['backup'].active == 0
+    # The cancelled attempt was sent the winner's 10 prompt tokens and produced nothing yet
+    assert logged == [('backup', True, 10)]
+
+def test_failover_gives_back_the_selected_slot_and_queues_for_the_fallback(monkeypatch):
+    class BrokenModelProvider(ScriptedProvider):
+        async def stream(self, chat_history, on_delta, model, **kwargs):
+            if model == 'broken-model':
+                raise ValueError("model failed to load")
+            return await super().stream(chat_history, on_delta, model, **kwargs)
+
+    shared = BrokenModelProvider(0)
+    monkeypatch.setitem(providers, 'shared', ResilientProvider('shared', shared))
+    monkeypatch.setattr(hedgeHandler, 'HEDGE_FALLBACK', 'shared:good-model')
+    # The fallback needs the provider's only slot, which the failed request is holding
+    monkeypatch.setattr(queueHelper, 'schedulers', {'shared': FairScheduler('shared', 1, {})})
+
+    async def scenario():
+        deltas = []
+        async def on_delta(text):
+            deltas.append(text)
+        async with provider_slot('shared', 'broken-model', 'alice') as slot:
+            response, answered_provider, answered_model = await asyncio.wait_for(
+                hedged_stream('shared', 'broken-model', [("text", "hi", "user")], on_delta, 1, slot, 'alice'), timeout=1)
+        return answered_model, deltas
+
+    answered_model, deltas = asyncio.run(scenario())
+    assert answered_model == 'good-model'
+    assert deltas == ["from good-model"]
+    assert queueHelper.schedulers['shared'].active == 0
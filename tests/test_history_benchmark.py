@@ -0,0 +1,63 @@
+import os
+import time
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("cachetools")
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+
+import helpers.historyHelper as historyHelper
+from helpers.dbHelper import Database, WriteBehindQueue, CHATS_MIGRATIONS
+
+ROWS_PER_CHAT = 100
+MESSAGES = 200
+
+def fill_history(conn, rows: int) -> None:
+    # Synthetic chats of ROWS_PER_CHAT alternating user and assistant rows
+    with conn:
+        conn.executemany(
+            "INSERT INTO chat_history (message_id, chat_id, type, message, role, tokens) VALUES (?, ?, 'text', ?, ?, 12)",
+            ((i + 1, i // ROWS_PER_CHAT, f"message {i}", 'user' if i % 2 == 0 else 'assistant') for i in range(rows)))
+
+async def measure(database: Database, rows: int) -> tuple:
+    # Seconds to open a chat, and per new message to save it and read the history back
+    await database.run(fill_history, rows)
+    chat_ids = [chat * 37 % (rows // ROWS_PER_CHAT) for chat in range(50)]
+    historyHelper.history_cache.clear()
+    started = time.perf_counter()
+    for chat_id in chat_ids:
+        assert len(await historyHelper.get_chat_history(chat_id)) == ROWS_PER_CHAT
+    open_time = (time.perf_counter() - started) / len(chat_ids)
+
+    started = time.perf_counter()
+    for i in range(MESSAGES):
+        chat_id = chat_ids[i % len(chat_ids)]
+        await historyHelper.save_chat_message(chat_id, f"new message {i}", 'user')
+        await historyHelper.get_chat_history(chat_id)
+    message_time = (time.perf_counter() - started) / MESSAGES
+    await historyHelper.chat_writes.flush()
+    return open_time, message_time
+
+def test_benchmark_history_latency_stays_flat(monkeypatch, tmp_path):
+    results = {}
+    for size in (10_000, 1_000_000):
+        database = Database(str(tmp_path / f'chats_{size}.db'), CHATS_MIGRATIONS)
+        monkeypatch.setattr(historyHelper, 'chats_db', database)
+        monkeypatch.setattr(historyHelper, 'chat_writes', WriteBehindQueue(database))
+        monkeypatch.setattr(historyHelper, 'last_message_id', None)
+
+        async def scenario():
+            try:
+                return await measure(database, size)
+            finally:
+                await database.close()
+
+        results[size] = asyncio.run(scenario())
+        print(f"{size} rows: open a chat {results[size][0] * 1000:.2f} ms, per message {results[size][1] * 1000:.3f} ms")
+    # Chats are read through the (chat_id, message_id) index and then kept in memory,
+    # so neither depends on the size of the table
+    small, large = results[10_000], results[1_000_000]
+    assert large[0] < small[0] * 3 + 0.002
+    assert large[1] < small[1] * 3 + 0.001
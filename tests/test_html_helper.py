@@ -0,0 +1,68 @@
+import re
+import time
+
+from helpers.htmlHelper import sanitize_html, markdown_to_html, is_telegram_html
+
+def clean_message_chain(message: str) -> str:
+    # The regex and str.replace chain every provider used before sanitize_html, kept as the benchmark baseline
+    message = re.sub(r'<(a|article|p|br|li|sup|sub|abbr|small|ul|/a|/article|/p|/li|/sup|/sub|/abbr|/small|/ul)>', '', message)
+    message = message.replace('<h1>', '<b><u>').replace('</h1>', '</u></b>').replace('<h2>', '<b>').replace('</h2>', '</b>').replace('<h3>', '<u>').replace('</h3>', '</u>').replace('<h4>', '<i>').replace('</h4>', '</i>').replace('<h5>', '').replace('</h5>', '').replace('<h6>', '').replace('</h6>', '').replace('<big>', '<b>').replace('</big>', '</b>')
+    return message
+
+def test_maps_and_strips_unsupported_tags():
+    assert sanitize_html("<h1>Title</h1><p>Hello & welcome, 1 < 2 > 0</p>") == "<b><u>Title</u></b>Hello &amp; welcome, 1 &lt; 2 &gt; 0"
+    assert sanitize_html("<ul><li>a</li></ul>line<br/>next") == "aline\nnext"
+    assert sanitize_html("<span>s</span><span class=\"tg-spoiler\">sp</span>") == 's<span class="tg-spoiler">sp</span>'
+
+def test_balances_tags():
+    assert sanitize_html("<b>open <i>both") == "<b>open <i>both</i></b>"
+    assert sanitize_html("text</b> stray") == "text stray"
+    assert sanitize_html("<b>x<i>y</b>z</i>") == "<b>x<i>y</i></b>z"
+
+def test_keeps_supported_attributes_only():
+    assert sanitize_html("<a>x</a> <a href='http://a?x=1&y=2' target=_blank>l</a>") == 'x <a href="http://a?x=1&amp;y=2">l</a>'
+    assert sanitize_html('<pre><code class="language-py">x<y</code></pre>') == '<pre><code class="language-py">x&lt;y</code></pre>'
+
+def test_escapes_text_that_only_looks_like_markup():
+    assert sanitize_html("List<String> &nbsp; &amp; &#123;") == "List&lt;String&gt; &amp;nbsp; &amp; &#123;"
+    assert sanitize_html("<code>if a<b and <div></code>") == "<code>if a&lt;b and &lt;div&gt;</code>"
+
+def test_valid_and_plain_replies_are_returned_unchanged():
+    valid = "<b>Bold</b> and <i>it &amp; <code>x &lt; y</code></i> &#128512;"
+    assert is_telegram_html(valid)
+    assert sanitize_html(valid) is valid
+    plain = "No markup here."
+    assert sanitize_html(plain) is plain
+    assert not is_telegram_html("<b>unclosed")
+    assert not is_telegram_html("<code><b>x</b></code>")
+
+def test_markdown_conversion():
+    assert markdown_to_html("Some **bold** and *it* and `a<b` snake_case 2*3*4") == "Some <b>bold</b> and <i>it</i> and <code>a&lt;b</code> snake_case 2*3*4"
+    assert markdown_to_html("```python\nprint('<x>')\n```") == "<pre><code class=\"language-python\">print('&lt;x&gt;')</code></pre>"
+    assert sanitize_html("# Head [l](https://x.y)", markdown=True) == '<b>Head <a href="https://x.y">l</a></b>'
+
+def best_time(function, text: str) -> float:
+    times = []
+    for _ in range(5):
+        started = time.perf_counter()
+        function(text)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def test_benchmark_against_the_replace_chain():
+    # Replies are prompted to be Telegram HTML, those take the quick check; others need the full pass
+    replies = {
+        "plain": "Just a long plain answer without any markup, sentence after sentence. " * 800,
+        "valid": "<b>Section</b>\nSome <b>bold</b> text &amp; more, with <code>x &lt; y</code>. <i>item</i>\n" * 800,
+        "invalid": "<h2>Section</h2><p>Some <b>bold</b> text &amp; more, with <code>x &lt; y</code>.</p><ul><li>item</li></ul>\n" * 600,
+    }
+    ratios = {}
+    for name, reply in replies.items():
+        chain_time = best_time(clean_message_chain, reply)
+        sanitize_time = best_time(sanitize_html, reply)
+        ratios[name] = sanitize_time / chain_time
+        print(f"{name} {len(reply)} chars: chain {chain_time * 1000:.2f} ms, sanitize_html {sanitize_time * 1000:.2f} ms")
+        # Even the full pass stays far below a rejected sendMessage round trip
+        assert sanitize_time < 0.1
+    assert ratios["plain"] < 1
+    assert ratios["valid"] < ratios["invalid"]
@@ -0,0 +1,39 @@
+import os
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("cachetools")
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+
+import helpers.imageHelper as imageHelper
+from helpers.dbHelper import Database, WriteBehindQueue, CHATS_MIGRATIONS
+
+INSERT_MESSAGE = "INSERT INTO chat_history (message_id, chat_id, type, message, role, tokens) VALUES (?, ?, 'image_url', ?, 'user', 765)"
+
+def test_only_unreferenced_images_are_deleted(monkeypatch, tmp_path):
+    database = Database(str(tmp_path / 'chats.db'), CHATS_MIGRATIONS)
+    writes = WriteBehindQueue(database, flush_interval=60)
+    monkeypatch.setattr(imageHelper, 'chats_db', database)
+    monkeypatch.setattr(imageHelper, 'chat_writes', writes)
+    monkeypatch.setattr(imageHelper, 'recently_stored', {})
+
+    async def scenario():
+        shared = await imageHelper.store_image(b'shared')
+        queued = await imageHelper.store_image(b'queued')
+        unused = await imageHelper.store_image(b'unused')
+        fresh = await imageHelper.store_image(b'fresh')
+        await database.execute(INSERT_MESSAGE, (1, 2, shared))
+        # Stored long ago, only fresh was just uploaded again
+        for image_hash in (shared, queued, unused):
+            imageHelper.recently_stored[image_hash] -= imageHelper.IMAGE_DELETE_GRACE
+        # A message saved just before the delete is still waiting in the write queue
+        writes.add(INSERT_MESSAGE, (2, 3, queued))
+        await imageHelper.delete_unused_images([shared, queued, unused, fresh])
+        kept = {row[0] for row in await database.fetchall("SELECT hash FROM images")}
+        await database.close()
+        return kept, {shared, queued, fresh}
+
+    kept, expected = asyncio.run(scenario())
+    assert kept == expected
@@ -0,0 +1,111 @@
+import time
+
+import pytest
+
+pytest.importorskip("cachetools")
+
+from helpers.contextHelper import turn_start
+from helpers.metricsHelper import counters
+from helpers.messageListHelper import build_message_list, cached_message_lists, invalidate_message_list, message_list_cache
+
+def append_merged(messages, rows) -> int:
+    # Like Claude: consecutive rows of one role become one message
+    for message_type, message, role in rows:
+        if messages and messages[-1]['role'] == role:
+            messages[-1] = {**messages[-1], 'content': messages[-1]['content'] + [message]}
+        else:
+            messages.append({'role': role, 'content': [message]})
+    return len(rows)
+
+def append_paired(messages, rows) -> int:
+    # Like Ollama: an image is sent together with the row after it
+    image = None
+    for message_type, message, role in rows:
+        if image is not None:
+            messages.append({'role': role, 'content': message, 'images': [image]})
+            image = None
+        elif message_type == 'image_url':
+            image = message
+        else:
+            messages.append({'role': role, 'content': message})
+    return len(rows) - 1 if image is not None else len(rows)
+
+def chat_turns(count: int) -> list:
+    rows = [(0, 'text', 'system prompt', 'system')]
+    for turn in range(count):
+        if turn % 3 == 0:
+            rows.append((len(rows), 'image_url', f'image {turn}', 'user'))
+        rows.append((len(rows), 'text', f'question {turn}', 'user'))
+        if turn % 7 == 3:
+            # A failed reply leaves two user rows in a row
+            continue
+        rows.append((len(rows), 'text', f'answer {turn}', 'assistant'))
+    return rows
+
+def windows(rows: list, window: int):
+    # Yield the history of each turn as fit_to_budget keeps it: the system row and the newest turns
+    for end in range(2, len(rows) + 1):
+        if rows[end - 1][3] != 'user' or (end < len(rows) and rows[end][3] == 'user'):
+            continue
+        start = turn_start(rows, max(end - window, 1))
+        if start < 1:
+            start = 1
+        yield [rows[0][1:]] + [row[1:] for row in rows[start:end]]
+
+@pytest.mark.parametrize('append_messages', [append_merged, append_paired])
+def test_cached_list_matches_a_fresh_build_while_the_window_slides(append_messages):
+    message_list_cache.clear()
+    counters.clear()
+    turns = 0
+    for history in windows(chat_turns(200), 40):
+        with cached_message_lists(1):
+            cached = build_message_list('test', history, append_messages)
+        assert cached == build_message_list('test', history, append_messages)
+        turns += 1
+    # Only the first turn builds the list from scratch, later ones extend it or drop turns from its head
+    assert counters['message_list_rebuilds.test'] == 1
+    assert counters['message_list_hits.test'] + counters['message_list_slides.test'] == turns - 1
+    assert counters['message_list_slides.test'] > turns / 2
+
+def test_history_changed_in_the_middle_is_rebuilt():
+    message_list_cache.clear()
+    counters.clear()
+    history = [row[1:] for row in chat_turns(10)]
+    # An old image dropped from the middle of the window
+    changed = history[:8] + history[9:]
+    with cached_message_lists(1):
+        build_message_list('test', history, append_merged)
+        cached = build_message_list('test', changed, append_merged)
+    assert cached == build_message_list('test', changed, append_merged)
+    assert counters['message_list_rebuilds.test'] == 2
+
+def test_providers_of_one_chat_keep_their_own_list():
+    message_list_cache.clear()
+    counters.clear()
+    history = [row[1:] for row in chat_turns(10)]
+    # A hedged request builds the fallback's list on every turn next to the primary's
+    for end in (10, 12, 14):
+        with cached_message_lists(1):
+            build_message_list('test', history[:end], append_merged)
+            build_message_list('other', history[:end], append_paired)
+    assert counters['message_list_rebuilds.test'] == 1
+    assert counters['message_list_rebuilds.other'] == 1
+    invalidate_message_list(1)
+    assert not message_list_cache
+
+def test_benchmark_sliding_window():
+    rows = chat_turns(2000)
+    histories = list(windows(rows, 1000))[-200:]
+    started = time.perf_counter()
+    for history in histories:
+        build_message_list('test', history, append_merged)
+    uncached = time.perf_counter() - started
+
+    message_list_cache.clear()
+    started = time.perf_counter()
+    for history in histories:
+        with cached_message_lists(1):
+            build_message_list('test', history, append_merged)
+    cached = time.perf_counter() - started
+    print(f"200 turns of a 1000 row window: rebuilt {uncached * 1000:.1f} ms, cached {cached * 1000:.1f} ms")
+    assert cached < uncached / 2
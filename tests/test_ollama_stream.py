@@ -0,0 +1,65 @@
+import json
+import asyncio
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("cachetools")
+
+import helpers.httpHelper as httpHelper
+import providers.ollamaHandler as ollamaHandler
+from helpers.resilienceHelper import ProviderError
+
+def ndjson(*objects) -> bytes:
+    return "\n".join(json.dumps(data) for data in objects).encode()
+
+async def stream_from(body: bytes, monkeypatch) -> tuple:
+    # Serve body as the /api/chat stream of a single backend and collect the deltas
+    async def ps(request):
+        return web.json_response({"models": []})
+
+    async def chat(request):
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/api/ps', ps)
+    app.router.add_post('/api/chat', chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    monkeypatch.setattr(ollamaHandler, 'pool', ollamaHandler.OllamaPool([f"http://{host}:{port}"]))
+    monkeypatch.setattr(httpHelper, 'session', None)
+    deltas = []
+
+    async def on_delta(text):
+        deltas.append(text)
+
+    try:
+        response = await ollamaHandler.stream_with_ollama([{"role": "user", "content": "hi"}], on_delta, model='llama')
+        return response, deltas
+    finally:
+        await httpHelper.close_session()
+        await runner.cleanup()
+
+def test_last_line_without_newline_is_shown(monkeypatch):
+    body = ndjson(
+        {"message": {"role": "assistant", "content": "Hello"}, "done": False},
+        {"message": {"role": "assistant", "content": " there"}, "done": True, "prompt_eval_count": 5, "eval_count": 2},
+    )
+    response, deltas = asyncio.run(stream_from(body, monkeypatch))
+    assert deltas == ["Hello", " there"]
+    assert response == (5, 2, "assistant", "Hello there")
+
+def test_error_in_the_stream_raises(monkeypatch):
+    body = ndjson(
+        {"message": {"role": "assistant", "content": "Hel"}, "done": False},
+        {"error": "model runner has unexpectedly stopped"},
+    )
+    with pytest.raises(ProviderError, match="unexpectedly stopped"):
+        asyncio.run(stream_from(body, monkeypatch))
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("openai")
+web = pytest.importorskip("aiohttp.web")
+os.environ.setdefault('DB_DIR', tempfile.mkdtemp())
+os.environ.setdefault('PROMPT_DIR', tempfile.mkdtemp())
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+import providers.gptHandler as gptHandler
+from chat.chatHandler import handle_chat_completion
+
+USERS = 10
+# Seconds the fake server takes before it starts answering
+SERVER_LATENCY = 0.5
+
+class FakeOpenAIServer:
+    # Streams a fixed reply for every chat completion and records how many requests overlap
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        assert body['stream']
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(SERVER_LATENCY)
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            chunks = [{"role": "assistant", "content": ""}, {"content": "Hello"}, {"content": " there"}]
+            for delta in chunks:
+                chunk = {"id": "1", "object": "chat.completion.chunk", "created": 0, "model": body['model'],
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            usage = {"id": "1", "object": "chat.completion.chunk", "created": 0, "model": body['model'], "choices": [],
+                     "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}}
+            await response.write(f"data: {json.dumps(usage)}\n\ndata: [DONE]\n\n".encode())
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+class FakeMessage:
+    message_id = 1
+
+    def __init__(self, text: str = ""):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage(text)
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+class FakeUpdate:
+    def __init__(self, user_id: int):
+        self.message = FakeMessage()
+        self.effective_user = FakeUser(user_id)
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+def test_concurrent_users_get_overlapping_requests(monkeypatch):
+    server = FakeOpenAIServer()
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', server.chat_completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        monkeypatch.setattr(gptHandler, 'openai', gptHandler.openai.with_options(base_url=f"http://{host}:{port}/v1"))
+        try:
+            updates = [FakeUpdate(user) for user in range(USERS)]
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                handle_chat_completion('openai', 'gpt-4o', 0.5, 100, 1, "", [("text", f"Hi from {user}", "user")], 1000 + user, update, FakeContext())
+                for user, update in enumerate(updates)
+            ))
+            return time.perf_counter() - started, updates
+        finally:
+            await runner.cleanup()
+
+    elapsed, updates = asyncio.run(scenario())
+    assert all("Hello there" in update.message.replies[0].text for update in updates)
+    # Every user's request is in flight at the same time, so they take about as long as one
+    assert server.max_in_flight == USERS
+    assert elapsed < SERVER_LATENCY * USERS / 3
@@ -0,0 +1,54 @@
+import asyncio
+
+from helpers.queueHelper import FairScheduler
+
+def test_waiter_for_free_model_is_not_blocked_by_full_model():
+    async def scenario():
+        scheduler = FairScheduler("ollama", 0, {"llama": 1})
+        await scheduler.acquire("alice", "llama")
+        # Bob waits for llama, which is at its cap of 1
+        bob = asyncio.create_task(scheduler.acquire("bob", "llama"))
+        await asyncio.sleep(0)
+        assert not bob.done()
+        # Carol's model has room, so she must not wait behind Bob
+        await asyncio.wait_for(scheduler.acquire("carol", "mistral"), timeout=0.5)
+        assert not bob.done()
+        scheduler.release("llama")
+        await asyncio.wait_for(bob, timeout=0.5)
+        assert scheduler.active == 2
+
+    asyncio.run(scenario())
+
+def test_slots_are_handed_out_round_robin_across_users():
+    async def scenario():
+        scheduler = FairScheduler("openai", 1, {})
+        await scheduler.acquire("holder", "gpt")
+        order = []
+
+        async def request(user_id):
+            await scheduler.acquire(user_id, "gpt")
+            order.append(user_id)
+
+        tasks = [asyncio.create_task(request(user_id)) for user_id in ("alice", "alice", "alice", "bob")]
+        await asyncio.sleep(0)
+        for _ in tasks:
+            scheduler.release("gpt")
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order[:2] == ["alice", "bob"]
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        scheduler = FairScheduler("openai", 1, {})
+        await scheduler.acquire("holder", "gpt")
+        waiter = asyncio.create_task(scheduler.acquire("alice", "gpt"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.depth == 0
+        scheduler.release("gpt")
+        assert scheduler.active == 0
+
+    asyncio.run(scenario())
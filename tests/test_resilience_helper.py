@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import helpers.resilienceHelper as resilienceHelper
+from helpers.resilienceHelper import call_with_retries, request_deadline, StreamProgress
+
+@pytest.fixture(autouse=True)
+def short_timeouts(monkeypatch):
+    monkeypatch.setattr(resilienceHelper, 'DEFAULT_PROVIDER_TIMEOUT', 0.2)
+    monkeypatch.setattr(resilienceHelper, 'STREAM_IDLE_TIMEOUT', 0.2)
+    monkeypatch.setattr(resilienceHelper, 'RETRY_ATTEMPTS', 2)
+    monkeypatch.setattr(resilienceHelper, 'RETRY_BASE_DELAY', 0)
+
+def fake_stream(progress: StreamProgress, gaps: list, calls: list):
+    async def stream():
+        calls.append(True)
+        for gap in gaps:
+            await asyncio.sleep(gap)
+            progress.touch()
+        return "done"
+    return stream
+
+def test_stream_longer_than_the_timeout_and_deadline_completes():
+    async def scenario():
+        progress = StreamProgress()
+        calls = []
+        with request_deadline(0.2):
+            # 0.6 s in total, but never more than 0.05 s between chunks
+            return await call_with_retries('fake', fake_stream(progress, [0.05] * 12, calls), lambda: not progress.started, progress), calls
+
+    result, calls = asyncio.run(scenario())
+    assert result == "done"
+    assert len(calls) == 1
+
+def test_stalled_stream_times_out_without_retry():
+    async def scenario():
+        progress = StreamProgress()
+        calls = []
+        with pytest.raises(asyncio.TimeoutError):
+            await call_with_retries('fake', fake_stream(progress, [0.01, 0.5], calls), lambda: not progress.started, progress)
+        return calls
+
+    assert len(asyncio.run(scenario())) == 1
+
+def test_stream_that_never_starts_is_retried():
+    async def scenario():
+        progress = StreamProgress()
+        calls = []
+        with pytest.raises(asyncio.TimeoutError):
+            await call_with_retries('fake', fake_stream(progress, [0.5], calls), lambda: not progress.started, progress)
+        return calls
+
+    assert len(asyncio.run(scenario())) == 2
+
+def test_call_without_progress_keeps_the_total_timeout():
+    async def scenario():
+        calls = []
+        with pytest.raises(asyncio.TimeoutError):
+            await call_with_retries('fake', fake_stream(StreamProgress(), [0.05] * 12, calls))
+        return calls
+
+    assert len(asyncio.run(scenario())) == 2
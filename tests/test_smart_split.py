@@ -0,0 +1,106 @@
+import random
+import time
+from html.parser import HTMLParser
+
+import pytest
+
+pytest.importorskip("telegram")
+from helpers.chatHelper import smart_split, MAX_MESSAGE_LENGTH
+
+class TagChecker(HTMLParser):
+    # Records whether every tag is closed in order and the text content without markup
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.balanced = True
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            self.balanced = False
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.text.append(f"&{name};")
+
+    def handle_charref(self, name):
+        self.text.append(f"&#{name};")
+
+def parse(text: str) -> tuple:
+    checker = TagChecker()
+    checker.feed(text)
+    checker.close()
+    return checker.balanced and not checker.stack, "".join(checker.text)
+
+WORDS = ["hello", "world.", "&amp;", "&lt;x&gt;", "foo", "\n", "x" * 50]
+TAGS = [("<b>", "</b>"), ("<i>", "</i>"), ('<a href="https://example.com/a">', "</a>"), ('<pre><code class="language-python">', "</code></pre>")]
+
+def random_html(rng: random.Random) -> str:
+    out, stack = [], []
+    for _ in range(rng.randint(0, 400)):
+        choice = rng.random()
+        if choice < 0.1 and len(stack) < 3:
+            opening, closing = rng.choice(TAGS)
+            out.append(opening)
+            stack.append(closing)
+        elif choice < 0.2 and stack:
+            out.append(stack.pop())
+        else:
+            out.append(rng.choice(WORDS) + rng.choice([" ", "", ". "]))
+    out.extend(reversed(stack))
+    return "".join(out)
+
+def test_parts_are_balanced_keep_content_and_respect_the_limit():
+    rng = random.Random(0)
+    for _ in range(3000):
+        text = random_html(rng)
+        limit = rng.randint(250, 800)
+        parts = smart_split(text, limit)
+        balanced, content = parse(text)
+        assert balanced
+        joined = ""
+        for i, part in enumerate(parts):
+            part_balanced, part_content = parse(part)
+            assert part_balanced, part
+            # Only the last part may run over by the closing tags folded into it
+            assert len(part) <= limit + (0 if i < len(parts) - 1 else 120)
+            assert part.strip() or not content.strip()
+            joined += part_content
+        assert joined == content
+
+def test_entities_and_tags_are_never_cut():
+    text = "<b>" + "a &amp; " * 1000 + "</b>"
+    for part in smart_split(text, 100):
+        assert part.startswith("<b>") and part.endswith("</b>")
+        assert part.count("&") == part.count("&amp;")
+
+def test_prefers_newlines_then_sentences_then_spaces():
+    assert smart_split("a" * 10 + "\n" + "b. " + "c" * 10, 20) == ["a" * 10 + "\n", "b. " + "c" * 10]
+    assert smart_split("a" * 10 + " " + "b" * 10, 12) == ["a" * 10 + " ", "b" * 10]
+    assert smart_split("", 10) == [""]
+
+def test_plain_text_mode_leaves_angle_brackets_alone():
+    assert smart_split("x<y>z " * 5, 12, parse_html=False) == ["x<y>z x<y>z ", "x<y>z x<y>z ", "x<y>z "]
+
+def best_time(text: str) -> float:
+    times = []
+    for _ in range(3):
+        started = time.perf_counter()
+        smart_split(text)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def test_split_time_grows_linearly():
+    # Microbenchmark: 100 KB of HTML, and 4x that should take about 4x as long, not 16x
+    unit = "Some <b>bold text</b> and &amp; entities. "
+    small = (unit * 3000)[:100_000]
+    large = (unit * 12000)[:400_000]
+    small_time = best_time(small)
+    assert len(smart_split(small)) >= len(small) // MAX_MESSAGE_LENGTH
+    assert small_time < 1.0
+    assert best_time(large) < small_time * 8
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("telegram")
+from helpers.chatHelper import StreamEditor, MAX_MESSAGE_LENGTH
+
+class FakeMessage:
+    # Records the texts it was edited to, rejecting any Telegram would find too long
+    next_id = 0
+
+    def __init__(self, fail_edits: bool = False):
+        FakeMessage.next_id += 1
+        self.message_id = FakeMessage.next_id
+        self.fail_edits = fail_edits
+        self.texts = []
+        self.replies = []
+
+    async def edit_text(self, text, **kwargs):
+        if self.fail_edits:
+            raise ConnectionError("edit failed")
+        assert len(text) <= MAX_MESSAGE_LENGTH
+        self.texts.append(text)
+
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage()
+        reply.texts.append(text)
+        self.replies.append(reply)
+        return reply
+
+def test_burst_of_escaped_text_rolls_over_until_it_fits():
+    placeholder = FakeMessage()
+    sent_messages = []
+    # Every & is five characters once escaped, the burst needs several messages
+    text = "a & b " * 2000
+
+    async def scenario():
+        streamer = StreamEditor(placeholder, sent_messages, heading="<b>Heading</b>\n", interval=0)
+        await streamer.push(text)
+        await streamer._task
+        return streamer
+
+    streamer = asyncio.run(scenario())
+    assert len(streamer.messages) > 3
+    assert len(sent_messages) == len(streamer.messages) - 1
+    assert streamer.text[:streamer._offset] + streamer._last_shown == text
+
+def test_finish_replaces_a_failed_edit():
+    placeholder = FakeMessage(fail_edits=True)
+
+    async def scenario():
+        streamer = StreamEditor(placeholder, [], interval=0)
+        await streamer.push("Hello")
+        await asyncio.wait([streamer._task])
+        placeholder.fail_edits = False
+        await streamer.finish(["Hello there"])
+
+    asyncio.run(scenario())
+    assert placeholder.texts == ["Hello there"]
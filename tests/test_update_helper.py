@@ -0,0 +1,64 @@
+import time
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("telegram")
+from telegram import Update, Message, Chat, User
+from helpers.updateHelper import PerUserUpdateProcessor
+
+UPDATES_PER_USER = 5
+# Seconds each update takes, like a reply that waits on a provider
+HANDLER_TIME = 0.05
+
+def make_update(update_id: int, user_id: int) -> Update:
+    user = User(id=user_id, first_name=f"user {user_id}", is_bot=False)
+    message = Message(message_id=update_id, date=datetime.now(), chat=Chat(id=user_id, type='private'), from_user=user, text=f"message {update_id}")
+    return Update(update_id=update_id, message=message)
+
+async def run_users(users: int, max_concurrent_updates: int = 256) -> tuple:
+    # Feed every user's updates the way Application does, one task per update in arrival order
+    processor = PerUserUpdateProcessor(max_concurrent_updates)
+    handled = {user: [] for user in range(users)}
+    running = {user: 0 for user in range(users)}
+    overlapped = []
+
+    async def handle(update: Update):
+        user = update.effective_user.id
+        running[user] += 1
+        if running[user] > 1:
+            overlapped.append(user)
+        await asyncio.sleep(HANDLER_TIME)
+        handled[user].append(update.update_id)
+        running[user] -= 1
+
+    updates = [make_update(i, i % users) for i in range(users * UPDATES_PER_USER)]
+    started = time.perf_counter()
+    tasks = []
+    for update in updates:
+        tasks.append(asyncio.create_task(processor.process_update(update, handle(update))))
+        # Let the task start before the next update arrives
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    assert not processor.locks
+    return len(updates) / elapsed, handled, overlapped
+
+def test_stress_throughput_scales_with_users():
+    throughput = {}
+    for users in (1, 4, 16, 64):
+        throughput[users], handled, overlapped = asyncio.run(run_users(users))
+        print(f"{users} users: {throughput[users]:.0f} updates/s")
+        # Each user's updates ran one at a time and in the order they arrived
+        assert not overlapped
+        assert all(ids == sorted(ids) and len(ids) == UPDATES_PER_USER for ids in handled.values())
+    # One user is limited by its own handlers, more users share none of that wait
+    assert throughput[4] > throughput[1] * 3
+    assert throughput[64] > throughput[1] * 40
+
+def test_updates_stay_in_order_with_fewer_slots_than_updates():
+    # Waiting updates hold their slots, the ones holding a user's lock still get to finish
+    _, handled, overlapped = asyncio.run(run_users(3, max_concurrent_updates=2))
+    assert not overlapped
+    assert all(ids == sorted(ids) and len(ids) == UPDATES_PER_USER for ids in handled.values())